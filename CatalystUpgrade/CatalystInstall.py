@@ -6,13 +6,50 @@ Description:
     connects to each device and stages the software. The output
     is captured and exported to a CSV.
 
+    Before anything is cleaned or copied, each switch is checked for the
+    target image. Switches already provisioned with that version are
+    skipped. When the binary is already in flash and its MD5 (optional
+    third CSV column) checks out with 'verify /md5', it is installed from
+    flash instead of being copied over FTP again. Re-running a partly
+    finished upgrade wave therefore moves almost no data.
+
+    When the images are also reachable from this computer, the expected
+    MD5s can be taken from them instead of the CSV. Each image is hashed
+    once and its digest cached (see imagecatalog.py).
+
+    Images are copied to flash first and then installed from flash. The
+    copies are spread over one or more FTP servers by transfers.py, which
+    caps how many copies each server serves at once. Instead of, or next
+    to, the FTP servers, the images can be served over HTTP by this script
+    itself (see imageserver.py).
+
+    With an optional fourth CSV column, site, each image crosses the WAN
+    once per site: one switch fetches it and the rest of the site copies
+    it from that switch over SCP.
+
+    Every command is followed by installmonitor.py, which answers the
+    device's questions, enforces a timeout per install phase and writes
+    the whole session of each switch to transcripts/.
+
+    Before anything moves, a pre-flight check (preflight.py) logs in to
+    every switch at once and gives each a go/no-go verdict, so switches
+    that would fail mid-install are left out of the wave.
+
+    Once everything is staged, the switches can be reloaded in batches
+    (reloader.py), each checked for the new version before the next
+    batch goes.
+
+    The time each phase takes is added to upgrade_history.csv. A planning
+    mode uses that history to predict how long a wave will take and to
+    order it so that it fits the maintenance window (timings.py).
+
     Multithreading is used so that multiple devices can be upgraded at
     the same time. The user is asked how many threads are to be used so
     the python-hosted computer or network isn't saturated.
 """
 
 __author__ = "Brandon Rumer"
-__version__ = "1.0.1"
+__version__ = "1.1.0"
 __email__ = "brumer@cisco.com"
 __status__ = "Development"
 
@@ -40,29 +77,145 @@ from tkinter import filedialog
 import paramiko
 import requests
 
+""" Import local modules """
+import imagecatalog
+import imageserver
+import installmonitor
+import preflight
+import reloader
+import timings
+import transfers
+from preflight import image_version, normalize_version
+
+
+# Full SSH session of every switch, one file per switch and run
+TRANSCRIPT_FOLDER = 'transcripts'
+
+# (host, binary) of every switch that will boot the new image on its next reload
+ready_to_reload = []
+
+# Platform of each switch, for the timing history
+platforms = {}
+
+
+def has_version(output, version):
+    """ True when version appears in the output, in any spelling """
+    found = [normalize_version(v) for v in re.findall(r'\d+\.\d+\.\d+[a-z]?', output)]
+    return normalize_version(version) in found
+
+
+def check_staged(monitor, binary, md5):
+    """ Summary: Find out how much of the upgrade has already been done
+
+    Description:
+        Returns 'running' when the switch already runs the version of the
+        binary, 'provisioned' when it will boot that version on its next
+        reload, 'staged' when the binary is in flash and
+        matches the expected MD5, or None when it has to be copied.
+        Without an MD5 a file in flash is never trusted, as it may be a
+        partial copy.
+    """
+    version = image_version(binary)
+    monitor.run('terminal length 0')
+
+    if version:
+        if has_version(monitor.run('show version provisioned | i version'), version):
+            running = preflight.parse_show_version(monitor.run('show version | i Version'))[0]
+            if running and normalize_version(running) == normalize_version(version):
+                return 'running'
+            return 'provisioned'
+
+    listing = monitor.run('dir flash:{}'.format(binary))
+    if binary not in listing or 'Error' in listing:
+        return None
+    if not md5:
+        print('{} is in flash but no MD5 was given for it, copying it again'.format(binary))
+        return None
+
+    print('Verifying the MD5 of flash:{}'.format(binary))
+    verify = monitor.run('verify /md5 flash:{} {}'.format(binary, md5))
+    if 'Verified' in verify and md5.lower() in verify.lower():
+        return 'staged'
+    print('flash:{} does not match the expected MD5, copying it again'.format(binary))
+    return None
+
+
+def offer_seed(monitor, host, binary, site, scheduler):
+    """ Summary: Let the rest of the site copy the image from this switch
+
+    Description:
+        Enables the switch's SCP server. The change is not saved, so it is
+        gone again after the upgrade reload.
+    """
+    if not scheduler.needs_seed(binary, site):
+        return
+    monitor.run('configure terminal\nip scp server enable\nend')
+    print(host , 'is now the seed of' , binary , 'for site' , site)
+    scheduler.seed_ready(host, binary, site)
+
+
+def copy_image(monitor, host, binary, md5, size, site, scheduler):
+    """ Summary: Copy the image to flash, holding a slot on an image server for as long as the copy runs
+
+    Description:
+        With site seeding the image is copied from the site's seed switch
+        when there is one. Should that copy fail, the image is fetched
+        from the image servers instead.
+
+    Returns an error message, or None when the image is in flash (and matches the MD5, when given).
+    """
+    seed = scheduler.seed_source(host, binary, site)
+    for servers in ([seed], None) if seed else (None,):
+        with scheduler.transfer(binary, size, servers) as transfer:
+            copycommand = 'copy {} flash:{}'.format(transfer.server.url(binary), binary)
+            print('Running' , copycommand)
+            answers = []
+            if transfer.server.password() is not None:
+                # Typed at the prompt rather than put in the URL, so the switch never echoes it into the transcript
+                answers = [(installmonitor.PASSWORD_RE, transfer.server.password() + '\n')]
+            output = monitor.run(copycommand, answers=answers)
+            copied = re.search(r'(\d+) bytes copied', output)
+            transfer.done(int(copied.group(1)) if copied else None)
+            if 'Error' in output:
+                transfer.fail()
+                error = 'Copy from {} failed: {}'.format(transfer.server, output.strip())
+                print(host , error)
+                continue
+        if transfer.mbps():
+            print('Copied {} from {} at {:.1f} Mbit/s'.format(binary, transfer.server, transfer.mbps()))
+        timings.record(host, platforms.get(host), binary, transfer.size, 'transfer', transfer.seconds)
+        break
+    else:
+        return error
+
+    if md5:
+        verify = monitor.run('verify /md5 flash:{} {}'.format(binary, md5))
+        if not ('Verified' in verify and md5.lower() in verify.lower()):
+            return 'flash:{} does not match the expected MD5 after the copy'.format(binary)
+    if seed is None:
+        offer_seed(monitor, host, binary, site, scheduler)
+    return None
+
+
+def transcript_file(host):
+    """ File the whole SSH session with a switch is written to """
+    if not os.path.isdir(TRANSCRIPT_FOLDER):
+        os.makedirs(TRANSCRIPT_FOLDER, exist_ok=True)
+    name = '{}-{}.log'.format(host, time.strftime('%Y-%m-%d-%H%M%S'))
+    return os.path.join(TRANSCRIPT_FOLDER, name)
+
      
-def ssh_exec_command(host, binary, ftpserver, user, pw, user_timeout, output_q):
+def ssh_exec_command(host, binary, md5, size, site, scheduler, user, pw, user_timeout, output_q):
     """ SSH to the device, send commands, and capture the output """
     output = ''
     output_list = []
     ssh_error = 'SSH Error'
+    transcriptname = transcript_file(host)
 
     # Building install command
-    slash = '/'
-    ftpprefix = 'ftp://'
-    ftpfile = ftpprefix + ftpserver + slash + binary
-
-    packageinstall = 'request platform software package install switch all file ftp://{} on-reboot new auto-copy'.format(ftpfile)
+    flashinstall = 'request platform software package install switch all file flash:{} on-reboot new auto-copy'.format(binary)
     verifycommand = 'show version provisioned | i version'
-    commands = ['request platform software package clean' , packageinstall, verifycommand]
-
-    print('')
-    print('On' , host , ', I am going to run:')
-    for n in commands:
-        print(n)
-    print('')
-        
-    CountOfCommands = len(commands)
+    commands = [flashinstall, verifycommand]
     # print('commands: ' , commands)
     
     try:
@@ -78,36 +231,63 @@ def ssh_exec_command(host, binary, ftpserver, user, pw, user_timeout, output_q):
             print('_____________________________________________________________')
             # Open Shell
             remote_shell = ssh.invoke_shell()
-            #output = remote_shell.recv(10000)
-            time.sleep(2)
-
-            # Clear Output (banner)
-            if remote_shell.recv_ready():
-                output = remote_shell.recv(10000)
-                # Get the router/switches prompt. This will be used later to see if the commands are done.
-                deviceprompt = output.decode('ascii').rsplit('\n' , 1)[1]
-                # print('device prompt var: ' , deviceprompt)
-
-
-            for i in commands:
-                deviceoutput = ''
-                cell = CountOfCommands+1 #CountOfCommands is the count, not the iteration currently on
-                # print('Output put in column ' , cell)
-                # Send the command
-                sendIt = '{}\n'.format(i)
-                remote_shell.send(sendIt)
-                time.sleep(2)
-
-                ''' Capture the screen, insuring that the command is done executing. '''
-                output = CaptureScreen(remote_shell, deviceprompt)
-                #print('Done with command number ' , cell)
-                print('Done with command')
-                print('output is: ' , output)
-                #####go back and add each command's output to a different column. Right now its all in one cell. ####
-
-
-            # Put gathered info into a row
-            output_list = [host, output] 
+
+            with open(transcriptname, 'w', newline='') as transcript:
+                # Wait for the banner and get the router/switches prompt. This is how the monitor sees a command is done.
+                monitor = installmonitor.Monitor(remote_shell, host, transcript)
+                monitor.start()
+
+                # Skip whatever has already been done on an earlier run
+                staged = check_staged(monitor, binary, md5)
+                if staged == 'running':
+                    print(host , 'already runs' , binary , '- skipping')
+                    output_q.put([[host, 'Skipped: already running {}'.format(binary), transcriptname]])
+                    remote_shell.close()
+                    ssh.close()
+                    return
+                elif staged == 'provisioned':
+                    print(host , 'is already provisioned with' , binary , '- skipping')
+                    output_q.put([[host, 'Skipped: already provisioned with {}'.format(binary), transcriptname]])
+                    ready_to_reload.append((host, binary))
+                    remote_shell.close()
+                    ssh.close()
+                    return
+                elif staged == 'staged':
+                    # Cleaning would delete the staged image, so install straight from flash
+                    print(host , 'already has a verified copy of' , binary , 'in flash - skipping the copy')
+                    offer_seed(monitor, host, binary, site, scheduler)
+                else:
+                    # Make room, then copy the image to flash
+                    monitor.run('request platform software package clean')
+                    copy_error = copy_image(monitor, host, binary, md5, size, site, scheduler)
+                    if copy_error:
+                        print(host , copy_error)
+                        output_q.put([[host, copy_error, transcriptname]])
+                        remote_shell.close()
+                        ssh.close()
+                        return
+
+                print('')
+                print('On' , host , ', I am going to run:')
+                for n in commands:
+                    print(n)
+                print('')
+
+                for i in commands:
+                    # Send the command and follow it until it is done executing
+                    started = time.time()
+                    output = monitor.run(i)
+                    print(host , 'done with' , i)
+                    if i == flashinstall:
+                        timings.record(host, platforms.get(host), binary, size, 'install', time.time() - started,
+                                       ok='Error' not in output)
+
+            # The last command shows what the switch will boot next
+            if image_version(binary) and has_version(output, image_version(binary)):
+                ready_to_reload.append((host, binary))
+
+            # Put gathered info into a row. The full output is in the transcript.
+            output_list = [host, output, transcriptname]
             print('Adding this to report:' , output_list)
             output_q.put([output_list])
             
@@ -116,6 +296,11 @@ def ssh_exec_command(host, binary, ftpserver, user, pw, user_timeout, output_q):
             ssh.close()
             print('Closing SSH')
 
+        except installmonitor.MonitorError as e:
+            print(e)
+            output_q.put([[host, '{}. Last output: {}'.format(e, e.tail.strip()[-500:]), transcriptname]])
+            ssh.close()
+            return str(e)
         except socket.error as e:
             ssh_error += ': Cannot connect to {} '.format(host)
             ssh_error += 'Socket error: '
@@ -143,91 +328,6 @@ def ssh_exec_command(host, binary, ftpserver, user, pw, user_timeout, output_q):
         threadLimiter.release()
 
 
-def CaptureScreen(remote_shell, deviceprompt):
-    """ Summary: Capture last line and compare to original prompt. If they
-        match then the command is done.
-
-    Description:
-        Takes the variable from deviceprompt and compares it to the last line
-        of the screen capture. If the line doesn't match then its assumed
-        that the previous command is still executing (it is assumed that the
-        device pompt will return once the command is complete.. When the match
-        is made the last screen is returned. This is used in cases such as
-        an image upgrade on a network device where it takes several minutes to
-        complete.
-
-    Parameters:
-        deviceprompt variable. Example: Switch1#
-    """
-
-    try: 
-        # Capture the screen to see what has changed
-        if remote_shell.recv_ready():
-            outputnasty = remote_shell.recv(50000) # the output type is byte
-            # Save the last line on the screen which will be used to check command's status
-            try:
-                lastline = outputnasty.decode('ascii').rsplit('\n' , 1)[1]
-                if (lastline == None) or (lastline == ''):
-                    lastline == 'PYTHON MESSAGE: No change detected.'
-            except IndexError:
-                lastline = 'PYTHON MESSAGE: No change detected.'
-            except KeyboardInterrupt:
-                print('\n Fine. Exiting')
-                exit(0)
-        else:
-            outputnasty = 'PYTHON MESSAGE: No change detected.'
-
-        # Now we are capturing the screen FOR REPORTING, assuming the command is complete (later)
-        # Clear the first line
-        try:
-            output1 = outputnasty.decode('ascii').split('\n' , 1)[1]
-            #print('output1 var: ' , output1)
-            # Clear the last line
-            output2 = output1.rsplit('\n' , 1)[0]
-            #print('output2 var: ' , )
-            deviceoutput = output2
-            #print('deviceoutput var: ' , deviceoutput)
-        except IndexError:
-            deviceoutput = 'PYTHON MESSAGE: No change detected.'
-        except AttributeError:
-            pass
-        except KeyboardInterrupt:
-            print('\n Fine. Exiting')
-            exit(0)
-        
-        # Compare last line to the device's prompt
-        while (deviceprompt != lastline):
-            # Account for a question, notify the user, and accept the default value
-            if ('[y/n]' in lastline):
-                print('y or n question detected: ' , lastline)
-                print('Sending y')
-                sendenter = 'y\n'
-                remote_shell.send(sendenter)
-                time.sleep(2)
-                return CaptureScreen(remote_shell, deviceprompt)
-            elif ('[' in lastline) and (']' in lastline):
-                print('Open-ended question detected: ' , lastline)
-                print('Sending enter to accept the default value')
-                sendenter = '\n'
-                remote_shell.send(sendenter)
-                time.sleep(2)
-                return CaptureScreen(remote_shell, deviceprompt)
-            else:
-                print('Command not done. Sleeping for 10 seconds.')
-                time.sleep(10)
-                return CaptureScreen(remote_shell, deviceprompt)
-        if deviceprompt == lastline:
-            print('Command complete!')
-            print('Last screen captured: ' , deviceoutput)
-            return deviceoutput
-
-    #except IndexError:
-        #pass
-    except KeyboardInterrupt:
-        print('\n Fine. Exiting')
-        exit(0)
-
-
 def check_pingv2(host):
     """ Checks to see if the IP address responds to a single ping.  """
     with open(os.devnull, 'w') as DEVNULL:
@@ -243,15 +343,28 @@ def check_pingv2(host):
     return pingstatus
 
 
-def WorkIt(host, binary, ftpserver, user, pw, user_timeout, output_q):
+def WorkIt(host, binary, md5, size, site, scheduler, user, pw, user_timeout, output_q):
     """ Placeholder function, primarily needed for multithreading  """
     pingstatus = check_pingv2(host)
     if pingstatus == True:
-        ssh_exec_command(host, binary, ftpserver, user, pw, user_timeout, output_q)
+        try:
+            ssh_exec_command(host, binary, md5, size, site, scheduler, user, pw, user_timeout, output_q)
+        finally:
+            # Hand the seed role on if this switch never got the image
+            scheduler.seed_done(host)
     elif pingstatus == False:
         threadLimiter.release()
 
 
+def ask_servers(prompt):
+    """ Ask for the image servers until the answer can be read. Returns a list of transfers.ImageServer """
+    while True:
+        try:
+            return transfers.parse_servers(input(prompt))
+        except ValueError as err:
+            print(err)
+
+
 def MaxThreads():
     """ Summary: Maximum threads
 
@@ -298,7 +411,7 @@ if __name__ == "__main__":
     # Specifying the CSV export filename
     csvExport = 'results-{}.csv'.format(timestamp)
     writer = csv.writer(open(csvExport, 'w', newline=''))
-    writer.writerow(['Host', 'Results'])
+    writer.writerow(['Host', 'Results', 'Transcript'])
    
 
     print('\n' * 20)
@@ -344,11 +457,17 @@ if __name__ == "__main__":
     print('\n' * 1)
     print('The CSV file should have two columns with column names ip & binary. The first column should have ')
     print('the switch IP Address, and the second the binary file that you want to upgrade to. The binary file ')
-    print('should be at the root directory of the FTP server.')
+    print('should be at the root directory of the FTP server. An optional third column, md5, lets switches')
+    print('that already have the binary in flash skip the copy. An optional fourth column, site, lets the')
+    print('switches of a site copy the binary from one another instead of each pulling it across the WAN.')
+    print('\n')
+    print('Several FTP servers holding the same binaries can be given, separated by commas. Each can be')
+    print('followed by how many copies it serves at once and its uplink speed in Mbit/s, e.g.')
+    print('10.1.1.10:4:1000,10.2.1.10:2 (default {} copies per server, no speed limit).'.format(transfers.DEFAULT_SLOTS))
     print('\n')
-    print('CSV example: ip,binary')
-    print('             10.10.10.1,cat3k_caa-universalk9.16.06.06.SPA.bin')
-    print('             10.10.10.2,cat3k_caa-universalk9.16.06.06.SPA.bin')
+    print('CSV example: ip,binary,md5')
+    print('             10.10.10.1,cat3k_caa-universalk9.16.06.06.SPA.bin,2fc4ad6bd6e5ae8b1e4bd4a51ecf2d5e')
+    print('             10.10.10.2,cat3k_caa-universalk9.16.06.06.SPA.bin,2fc4ad6bd6e5ae8b1e4bd4a51ecf2d5e')
     print('             10.10.10.3,cat3k_caa-universalk9.16.03.08.SPA.bin')
     print('\n' * 1)
     print('///////////////////////////////////////////////////////////////////////////////////////////////////')
@@ -367,8 +486,6 @@ if __name__ == "__main__":
 
 
     # Get credentials for devices & setting some variables
-    ftpserver = input('FTP Server IP Address: ')
-    print('')
     print('Enter username to connect to the switch with.')
     user = input('(typically, the domain is not needed): ')
     print('')
@@ -376,6 +493,23 @@ if __name__ == "__main__":
     #       This is an IDLE problem, not py problem
     pw = getpass.getpass("Enter password: ")
     print('')
+    print('Folder on this computer with the same binaries as the FTP server, used to work out their MD5.')
+    imagefolder = input('(leave blank to only use the md5 column of the CSV): ')
+    print('')
+
+    serve_http = False
+    client_mbps = None
+    if imagefolder:
+        serve_http = input('Serve the binaries from this computer over HTTP? (y/N): ').strip().lower() == 'y'
+        if serve_http:
+            limit = input('Max Mbit/s per switch (blank for no limit): ').strip()
+            client_mbps = float(limit) if limit else None
+        print('')
+
+    servers = ask_servers('FTP Server IP Address(es){}: '.format(' (blank for none)' if serve_http else ''))
+    while not servers and not serve_http:
+        servers = ask_servers('FTP Server IP Address(es): ')
+    print('')
     
 
     # Ask user how many threads they want to spawn
@@ -383,26 +517,112 @@ if __name__ == "__main__":
     threadLimiter = threading.BoundedSemaphore(threads)
 
 
-    # Do the work, while limiting the number of threads
+    # Read the devices up front so every image is hashed before the first switch is touched
+    devices = []
     with open(filename , 'r') as infile:
         reader = csv.reader(infile, delimiter=',')
-
         for row in reader:
-            try:
-                host = row[0]
-                binary = row[1]
-                threadLimiter.acquire()
-                my_thread = threading.Thread(target=WorkIt, args=(host, binary, ftpserver, user, pw, user_timeout, output_q))
-                my_thread.start()
-            except KeyboardInterrupt:
-                print('\n Fine. Exiting')
-                exit(0)
-
-    # Wait for threads to complete
-    main_thread = threading.currentThread()
-    for some_thread in threading.enumerate():
-        if some_thread != main_thread:
-            some_thread.join()
+            if len(row) < 2 or row[0].strip().lower() in ('', 'ip'):
+                # Header or blank line
+                continue
+            devices.append([row[0].strip(), row[1].strip(), row[2].strip() if len(row) > 2 else '', None,
+                            row[3].strip() if len(row) > 3 else ''])
+
+    if imagefolder:
+        catalog = imagecatalog.ImageCatalog(imagefolder)
+        digests = catalog.digests([device[1] for device in devices])
+        for device in devices:
+            entry = digests.get(device[1])
+            if entry is None:
+                print(device[1] , 'is not in' , imagefolder)
+                continue
+            if device[2] and device[2].lower() != entry['md5']:
+                print('The CSV MD5 of' , device[1] , 'for' , device[0] , 'does not match the local copy, using the local copy')
+            device[2] = entry['md5']
+            device[3] = entry['size']
+        print('')
+
+    # Plan the wave from the timings of earlier runs, without touching any switch
+    history = timings.load()
+    estimator = timings.Estimator(history)
+    platforms.update(timings.known_platforms(history))
+    if devices and input('Only plan this wave against a maintenance window? (y/N): ').strip().lower() == 'y':
+        window = input('Maintenance window in minutes (default 240): ').strip()
+        window = (int(window) if window.isdigit() and int(window) > 0 else 240) * 60
+        batch = input('Switches to reload at once (default {}): '.format(reloader.BATCH_SIZE)).strip()
+        batch = int(batch) if batch.isdigit() and int(batch) > 0 else reloader.BATCH_SIZE
+        slots = sum(server.slots for server in servers) + (transfers.DEFAULT_SLOTS if serve_http else 0)
+        result = timings.plan(devices, platforms, estimator, threads, max(1, slots), batch, window)
+        planExport = 'plan-{}.csv'.format(timestamp)
+        timings.write_plan(result, planExport)
+        print('')
+        print('Predicted staging: {:.0f} min, reloads: {:.0f} min, total: {:.0f} min'.format(
+            result['staging'] / 60, result['reloads'] / 60, result['total'] / 60))
+        if result['total'] <= window:
+            print('The wave fits the window.')
+        elif result['fits']:
+            print('It fits with {} concurrent switches and reload batches of {}.'.format(*result['fits']))
+        else:
+            print('It does not fit the window at any concurrency. Split it into smaller waves.')
+        print('Plan saved as:' , planExport , '(it can be run as the upgrade CSV)')
+        exit(0)
+
+    # Check every switch before any bytes move
+    members = {}
+    if devices and input('Run the pre-flight checks first? (Y/n): ').strip().lower() != 'n':
+        print('Checking {} switches...'.format(len(devices)))
+        checks = preflight.run(devices, user, pw)
+        print('')
+        preflight.print_table(checks)
+        preflightExport = 'preflight-{}.csv'.format(timestamp)
+        preflight.write_csv(checks, preflightExport)
+        print('')
+        print('Pre-flight results saved as:' , preflightExport)
+        for check in checks:
+            if check['Result'] == 'DONE':
+                writer.writerow([check['Host'], 'Skipped: {}'.format(check['Reason']), ''])
+            elif check['Result'] == 'NO-GO':
+                writer.writerow([check['Host'], 'No-go: {}'.format(check['Reason']), ''])
+        devices = [device for device, check in zip(devices, checks) if check['Result'] == 'GO']
+        members = {check['Host']: check['Members'] or None for check in checks}
+        platforms.update((check['Host'], check['Model']) for check in checks if check['Model'])
+        if input('Upgrade the {} switches marked GO? (y/N): '.format(len(devices))).strip().lower() != 'y':
+            print('Nothing upgraded. Results saved as:' , csvExport)
+            exit(0)
+        print('')
+
+    if serve_http and devices:
+        httpserver = imageserver.ImageServer(imagefolder, set(device[1] for device in devices),
+                                             client_mbps=client_mbps).start()
+        address = '{}:{}'.format(imageserver.local_address(devices[0][0]), httpserver.server_port)
+        print('Serving the binaries at http://{}/'.format(address))
+        print('')
+        servers.append(transfers.ImageServer(address, scheme='http'))
+    seed_credentials = None
+    if any(device[4] for device in devices):
+        print('Switches of the same site can copy the binaries from one another, so each binary crosses the')
+        print('WAN once per site. This enables the SCP server of one switch per site until it reloads.')
+        if input('Seed the binaries within each site? (y/N): ').strip().lower() == 'y':
+            seed_credentials = (user, pw)
+        print('')
+    scheduler = transfers.TransferScheduler(servers, seed_credentials=seed_credentials)
+
+
+    # Do the work, while limiting the number of threads
+    workers = []
+    for host, binary, md5, size, site in devices:
+        try:
+            threadLimiter.acquire()
+            my_thread = threading.Thread(target=WorkIt, args=(host, binary, md5, size, site, scheduler, user, pw, user_timeout, output_q))
+            my_thread.start()
+            workers.append(my_thread)
+        except KeyboardInterrupt:
+            print('\n Fine. Exiting')
+            exit(0)
+
+    # Wait for threads to complete. The image server's threads run until the script exits.
+    for some_thread in workers:
+        some_thread.join()
 
     # Get everything from the queue
     while not output_q.empty():
@@ -410,6 +630,28 @@ if __name__ == "__main__":
         for datastuff in my_dict:
             writer.writerow(datastuff)
             
+    # Reload what was staged, a batch at a time
+    if ready_to_reload:
+        print('')
+        print('{} switches will boot the new image on their next reload.'.format(len(ready_to_reload)))
+        if input('Reload them now? (y/N): ').strip().lower() == 'y':
+            batch = input('Switches to reload at once (default {}): '.format(reloader.BATCH_SIZE)).strip()
+            # Slowest reloads first, so each batch holds switches that take about as long
+            ready_to_reload.sort(key=lambda switch: estimator.estimate(platforms.get(switch[0], ''), 'reload') +
+                                 estimator.estimate(platforms.get(switch[0], ''), 'verify'), reverse=True)
+            sizes = dict((device[0], device[3]) for device in devices)
+            reloads = reloader.run([(host, binary, members.get(host)) for host, binary in ready_to_reload],
+                                   user, pw, batch_size=int(batch) if batch.isdigit() and int(batch) > 0 else reloader.BATCH_SIZE)
+            for host, ok, message, phases in reloads:
+                writer.writerow([host, message, ''])
+                binary = dict(ready_to_reload)[host]
+                for phase, seconds in phases.items():
+                    timings.record(host, platforms.get(host), binary, sizes.get(host), phase, seconds, ok=ok)
+
     print('\n' * 5)
+    print('Image copies per server:')
+    for line in scheduler.report():
+        print('   ' , line)
+    print('')
     print('Results saved as:' , csvExport)
     print('\n' * 3)
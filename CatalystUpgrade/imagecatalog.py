@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+""" Summary: Catalog of local switch images and their digests
+
+Description:
+    Hashing a multi-hundred-MB .bin takes a while, so each image is hashed
+    once and its MD5 and SHA-512 are kept in a JSON file. An entry is keyed
+    by the image's path and stays valid while its size and modification
+    time are unchanged. If the file is replaced, it is hashed again.
+
+    Images are read through a memory map in large chunks. Both digests
+    come from a single pass. hashlib releases the GIL while it hashes,
+    so several images are hashed in parallel on a thread pool.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Development"
+
+
+""" Importing built-in modules """
+import hashlib
+import json
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+CATALOG_FILE = 'image_digests.json'
+CHUNK_SIZE = 8 * 1024 * 1024
+WORKERS = 4
+
+
+def hash_file(path):
+    '''
+    Hash a file in one pass over a memory map
+    :param path: image file
+    :return: dict with the md5 and sha512 hex digests
+    '''
+    md5 = hashlib.md5()
+    sha512 = hashlib.sha512()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, len(mapped), CHUNK_SIZE):
+                        chunk = view[offset:offset + CHUNK_SIZE]
+                        md5.update(chunk)
+                        sha512.update(chunk)
+                        chunk.release()
+                finally:
+                    view.release()
+    return {'md5': md5.hexdigest(), 'sha512': sha512.hexdigest()}
+
+
+class ImageCatalog:
+    '''
+    :param folder: folder the images are in, as served by the FTP server
+    :param catalogfile: JSON file the digests are cached in
+    '''
+
+    def __init__(self, folder, catalogfile=CATALOG_FILE):
+        self.folder = folder
+        self.catalogfile = catalogfile
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(catalogfile, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def path(self, binary):
+        return os.path.abspath(os.path.join(self.folder, binary))
+
+    def cached(self, binary):
+        ''' Return the cached digests of an image, or None when missing or out of date '''
+        path = self.path(binary)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry
+        return None
+
+    def digest(self, binary):
+        '''
+        Return the digests of an image, hashing it only when the cache is out of date
+        :param binary: image name, relative to the catalog folder
+        :return: dict with md5 and sha512, or None when the image is not in the folder
+        '''
+        entry = self.cached(binary)
+        if entry is not None:
+            return entry
+        path = self.path(binary)
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        print('Hashing' , binary)
+        entry = dict(hash_file(path), size=stat.st_size, mtime=stat.st_mtime)
+        with self.lock:
+            self.entries[path] = entry
+        return entry
+
+    def digests(self, binaries, workers=WORKERS):
+        '''
+        Hash every image that is not cached yet, in parallel, and save the catalog
+        :param binaries: image names, duplicates are hashed once
+        :return: dict of image name to digests, for the images that were found
+        '''
+        binaries = list(dict.fromkeys(binaries))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = dict(zip(binaries, pool.map(self.digest, binaries)))
+        self.save()
+        return {binary: entry for binary, entry in results.items() if entry is not None}
+
+    def save(self):
+        ''' Write the catalog atomically so an interrupted run keeps what it hashed '''
+        tmpfile = self.catalogfile + '.tmp'
+        with self.lock:
+            with open(tmpfile, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+        os.replace(tmpfile, self.catalogfile)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+""" Summary: Small HTTP server for the upgrade images
+
+Description:
+    Serves the images named in the upgrade CSV straight from this computer,
+    so no FTP server has to be set up by hand. The switches copy them with
+    'copy http://...'.
+
+    Files are sent with sendfile(), so the data goes from the page cache
+    to the socket without passing through Python. Range requests are
+    honoured, so an interrupted copy can be resumed. Each client can be
+    held to a rate limit, so that a few fast switches don't take the
+    whole uplink. Only the listed images are served. Any other path gets
+    a 404.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Development"
+
+
+""" Importing built-in modules """
+import os
+import re
+import socket
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+PORT = 8080
+
+# Bytes handed to sendfile() at a time, and between rate limit checks
+BLOCK_SIZE = 1024 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class ClientRate:
+    ''' Token bucket shared by all the connections of one client '''
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        # Allow a burst of one block only, so the limit holds over short copies too
+        self.burst = min(bytes_per_second, BLOCK_SIZE)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self, size):
+        ''' Block until size bytes may be sent '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    ''' Serves the files of server.images, a dict of URL name to local path '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def serve(self, body):
+        name = urllib.parse.unquote(self.path.split('?', 1)[0].lstrip('/'))
+        path = self.server.images.get(name)
+        if path is None:
+            self.send_error(404)
+            return
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404)
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size - 1
+            status = 200
+            match = RANGE_RE.match(self.headers.get('Range', '').strip())
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                else:
+                    # bytes=-N is the last N bytes
+                    start = max(0, size - int(match.group(2)))
+                if start > end or start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{}'.format(size))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            if status == 206:
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+            self.end_headers()
+            if body:
+                self.send_file(f, start, end - start + 1)
+
+    def send_file(self, f, offset, count):
+        self.wfile.flush()
+        rate = self.server.client_rate(self.client_address[0])
+        started = time.time()
+        sent = 0
+        try:
+            while sent < count:
+                block = min(BLOCK_SIZE, count - sent)
+                if rate is not None:
+                    rate.wait(block)
+                # socket.sendfile() uses os.sendfile() where the platform has it
+                written = self.connection.sendfile(f, offset + sent, block)
+                if written == 0:
+                    # The file shrank under us, so Content-Length can't be met
+                    print('Image server: {} ended early, sent {} of {} bytes to {}'.format(
+                        os.path.basename(f.name), sent, count, self.client_address[0]))
+                    self.close_connection = True
+                    return
+                sent += written
+        except (ConnectionError, socket.timeout):
+            print('Image server: {} dropped the connection after {} of {} bytes'.format(
+                self.client_address[0], sent, count))
+            self.close_connection = True
+            return
+        seconds = time.time() - started
+        print('Image server: sent {} bytes of {} to {} at {:.1f} Mbit/s'.format(
+            sent, os.path.basename(f.name), self.client_address[0], sent * 8 / max(seconds, 0.001) / 1000000))
+
+
+class ImageServer(ThreadingHTTPServer):
+    '''
+    :param folder: folder the images are in
+    :param binaries: image names that may be served
+    :param port: TCP port to listen on, 0 for any free port
+    :param client_mbps: most Mbit/s sent to one client, or None for no limit
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, folder, binaries, port=PORT, client_mbps=None):
+        self.images = {binary: os.path.join(folder, binary) for binary in binaries}
+        self.client_bytes = client_mbps * 1000000 / 8 if client_mbps else None
+        self.rates = {}
+        self.rates_lock = threading.Lock()
+        super().__init__(('0.0.0.0', port), ImageHandler)
+
+    def client_rate(self, client):
+        if self.client_bytes is None:
+            return None
+        with self.rates_lock:
+            if client not in self.rates:
+                self.rates[client] = ClientRate(self.client_bytes)
+            return self.rates[client]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def local_address(host):
+    ''' The address of this computer that host would connect back to '''
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Nothing is sent, this only picks the outgoing interface
+        s.connect((host, 22))
+        return s.getsockname()[0]
+    finally:
+        s.close()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+""" Summary: Watches long-running commands on a switch's SSH shell
+
+Description:
+    Runs one command at a time on an interactive shell. Output is read as
+    it arrives, so nothing is lost between polls. The loop handles:
+
+        - confirmation prompts: '[y/n]' and '[yes/no]' are answered yes,
+          and any other '[default]' question is answered with enter
+        - progress markers, e.g. the expand and verify steps of
+          'request platform software package install'. Each marker starts
+          a new phase with its own timeout, so a stuck install is noticed
+          without cutting short an install that is still moving
+        - the device prompt, which ends the command
+
+    Only the last TAIL_SIZE characters of each command are kept in memory.
+    The full transcript of the session goes to a file as it is read. One
+    monitor per switch costs a thread blocked in recv() and a small
+    buffer, so hundreds of installs can run side by side.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Development"
+
+
+""" Importing built-in modules """
+import codecs
+import re
+import socket
+import time
+
+
+# Characters of output kept per command, the rest is only in the transcript
+TAIL_SIZE = 64 * 1024
+
+# recv() wakes up this often to check the deadline
+POLL_SECONDS = 1
+
+# Seconds allowed until the first progress marker
+COMMAND_TIMEOUT = 600
+
+# Progress markers of copies and package installs in the order they appear,
+# and the seconds each phase may take. Phases only ever move forward.
+PHASES = [
+    ('copy', re.compile(r'Accessing \S+://|Downloading file'), 3600),
+    ('expand', re.compile(r'Expanding (image )?(file|bundle)'), 1800),
+    ('verify', re.compile(r'Verifying image|Verifying file|Validating'), 1800),
+    ('sync', re.compile(r'Starting initial file sync|Copying \S+ to'), 1800),
+    ('provision', re.compile(r'Provisioning|Starting Add|Processing image file'), 1800),
+    ('finish', re.compile(r'SUCCESS|Finished|bytes copied'), 600),
+]
+
+# Anchored at the end of the line, so a question followed by its echoed answer isn't answered again
+YES_NO_RE = re.compile(r'\[(y/n|yes/no|confirm)\]\s*[?:]?\s*$', re.IGNORECASE)
+QUESTION_RE = re.compile(r'\[[^\]]*\]\s*[?:]?\s*$')
+
+# Password prompt of a copy from an scp:// URL. Answered through answers=, and never printed.
+PASSWORD_RE = re.compile(r'Password:\s*$', re.IGNORECASE)
+
+
+class MonitorError(Exception):
+    ''' A command did not finish '''
+
+    def __init__(self, message, phase, tail):
+        super().__init__(message)
+        self.phase = phase
+        self.tail = tail
+
+
+class CommandTimeout(MonitorError):
+    pass
+
+
+class ChannelClosed(MonitorError):
+    pass
+
+
+class Monitor:
+    '''
+    :param remote_shell: paramiko channel from invoke_shell()
+    :param host: switch name, for progress messages
+    :param transcript: file the whole session is written to, or None
+    '''
+
+    def __init__(self, remote_shell, host, transcript=None):
+        self.shell = remote_shell
+        self.host = host
+        self.transcript = transcript
+        self.prompt = None
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.shell.settimeout(POLL_SECONDS)
+
+    def read(self):
+        ''' Return the next piece of output, '' when nothing came within POLL_SECONDS '''
+        try:
+            data = self.shell.recv(65536)
+        except socket.timeout:
+            return ''
+        if not data:
+            raise ChannelClosed('{}: the SSH session was closed'.format(self.host), None, '')
+        text = self.decoder.decode(data)
+        if self.transcript is not None:
+            self.transcript.write(text)
+            self.transcript.flush()
+        return text
+
+    def start(self, timeout=30):
+        ''' Wait for the banner and first prompt, and return the prompt, e.g. Switch1# '''
+        output = ''
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            output += self.read()
+            lastline = output.rsplit('\n', 1)[-1].strip()
+            if lastline.endswith(('#', '>')):
+                self.prompt = lastline
+                return self.prompt
+        raise CommandTimeout('{}: no prompt after {} seconds'.format(self.host, timeout), None, output[-TAIL_SIZE:])
+
+    def run(self, command, timeout=COMMAND_TIMEOUT, phases=PHASES, answers=()):
+        '''
+        Send a command and follow it until the prompt is back
+
+        :param command: command to send, several lines are sent one after another
+        :param timeout: seconds allowed until the first progress marker
+        :param phases: list of (phase, marker regex, seconds the phase may take)
+        :param answers: list of (question regex, reply) tried before the default answers. Anchor the
+                        regex at the end of the line, or the echoed reply makes it match again.
+        :return: the output of the command, without the echoed command and the prompt
+        '''
+        self.shell.send('{}\n'.format(command))
+        tail = ''
+        phase = 'command'
+        reached = -1
+        deadline = time.monotonic() + timeout
+
+        while True:
+            if time.monotonic() > deadline:
+                raise CommandTimeout('{}: {} timed out in the {} phase'.format(self.host, command.split('\n')[0], phase),
+                                     phase, tail)
+            text = self.read()
+            if not text:
+                continue
+            # Markers may be split across reads, so look back a little
+            window = tail[-200:] + text
+            tail = (tail + text)[-TAIL_SIZE:]
+
+            for index, (name, marker, seconds) in enumerate(phases):
+                if index > reached and marker.search(window):
+                    reached, phase = index, name
+                    deadline = time.monotonic() + seconds
+                    print('{}: {}'.format(self.host, name))
+
+            # The last line only changes when output arrives, and once the echoed answer follows
+            # the question no pattern matches it any more, so each question is answered once
+            lastline = tail.rsplit('\n', 1)[-1].strip()
+            if lastline == self.prompt and '\n' in tail:
+                break
+            answer = next(((question, reply) for question, reply in answers if question.search(lastline)), None)
+            if answer is not None:
+                question, reply = answer
+                shown = 'the password' if question is PASSWORD_RE else reply.strip() or 'enter'
+                print('{}: answering {} to {}'.format(self.host, shown, lastline))
+                self.shell.send(reply)
+            elif YES_NO_RE.search(lastline):
+                print('{}: answering yes to {}'.format(self.host, lastline))
+                self.shell.send('y\n')
+            elif QUESTION_RE.search(lastline):
+                print('{}: accepting the default of {}'.format(self.host, lastline))
+                self.shell.send('\n')
+
+        # Drop the echoed command and the prompt
+        lines = tail.splitlines()
+        return '\n'.join(lines[1:-1])
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+""" Summary: Pre-flight checks of every switch before an upgrade wave
+
+Description:
+    Logs in to all the switches at once, one short session each, and
+    gathers what decides whether an upgrade can work:
+
+        - current version, mode (INSTALL or BUNDLE) and stack members,
+          all from 'show version'
+        - free space in flash, from 'dir flash: | i bytes'
+
+    Each switch then gets a verdict before any image is copied:
+
+        GO      ready to upgrade
+        DONE    already runs the target version
+        NO-GO   unreachable, in BUNDLE mode, on 3.x code, or short of
+                flash space (the image and its expanded packages need
+                about twice the image size)
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Development"
+
+
+""" Importing built-in modules """
+import csv
+import re
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+""" Import external modules """
+import paramiko
+
+""" Import local modules """
+import installmonitor
+
+
+WORKERS = 32
+CONNECT_TIMEOUT = 20
+
+# The .bin and the packages expanded from it are both in flash during the install
+SPACE_FACTOR = 2
+
+COLUMNS = ['Host', 'Model', 'Binary', 'Version', 'Mode', 'Members', 'Free MB', 'Needed MB', 'Result', 'Reason']
+
+VERSION_RE = re.compile(r'Cisco IOS[ -]XE Software, Version (\S+)|, Version (\d+\.\d+\.\d+\w*)')
+# A member line of the 'show version' table, e.g.
+# *    1 52    C9300-48P          16.12.4           CAT9K_IOSXE        INSTALL
+MEMBER_RE = re.compile(r'^\*?\s*\d+\s+\d+\s+(\S+)\s+(\S+)\s+\S+\s+(INSTALL|BUNDLE)\s*$', re.MULTILINE)
+FREE_RE = re.compile(r'(\d+) bytes total \((\d+) bytes free\)')
+
+
+def image_version(binary):
+    """ Version in an image name, e.g. 16.06.06 from cat3k_caa-universalk9.16.06.06.SPA.bin """
+    match = re.search(r'\.(\d+\.\d+\.\d+[a-z]?)\.', binary)
+    return match.group(1) if match else None
+
+
+def normalize_version(version):
+    """ So that 16.06.06 and 16.6.6 compare equal """
+    return '.'.join(str(int(part)) if part.isdigit() else part for part in version.lower().split('.'))
+
+
+def parse_show_version(output):
+    '''
+    :return: (version, mode, members). mode is INSTALL, BUNDLE or None; members is the stack size.
+    '''
+    match = VERSION_RE.search(output)
+    version = (match.group(1) or match.group(2)).rstrip(',') if match else None
+    members = MEMBER_RE.findall(output)
+    modes = set(mode for model, member_version, mode in members)
+    mode = 'BUNDLE' if 'BUNDLE' in modes else ('INSTALL' if modes else None)
+    return version, mode, max(1, len(members))
+
+
+def parse_model(output):
+    ''' Model of the first stack member, e.g. C9300-48P, or None '''
+    members = MEMBER_RE.findall(output)
+    return members[0][0] if members else None
+
+
+def parse_free(output):
+    ''' Bytes free in flash, or None '''
+    match = FREE_RE.search(output)
+    return int(match.group(2)) if match else None
+
+
+def gather(host, user, pw):
+    '''
+    Collect the facts of one switch in a single SSH session
+    :return: dict with version, mode, members and free, or error
+    '''
+    facts = {'host': host}
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        ssh.connect(host, username=user, password=pw, timeout=CONNECT_TIMEOUT,
+                    banner_timeout=CONNECT_TIMEOUT, auth_timeout=CONNECT_TIMEOUT)
+        monitor = installmonitor.Monitor(ssh.invoke_shell(), host)
+        monitor.start()
+        monitor.run('terminal length 0', timeout=CONNECT_TIMEOUT)
+        showversion = monitor.run('show version', timeout=60)
+        facts['version'], facts['mode'], facts['members'] = parse_show_version(showversion)
+        facts['model'] = parse_model(showversion)
+        facts['free'] = parse_free(monitor.run('dir flash: | i bytes', timeout=60))
+    except paramiko.AuthenticationException as e:
+        facts['error'] = 'Authentication failed: {}'.format(e)
+    except (socket.error, paramiko.SSHException, installmonitor.MonitorError) as e:
+        facts['error'] = 'Cannot connect: {}'.format(e)
+    finally:
+        ssh.close()
+    return facts
+
+
+def decide(facts, binary, size):
+    '''
+    :param facts: from gather()
+    :param binary: target image
+    :param size: image size in bytes, or None when unknown
+    :return: (result, reason)
+    '''
+    if 'error' in facts:
+        return 'NO-GO', facts['error']
+    version = facts.get('version')
+    if not version:
+        return 'NO-GO', 'Could not read the current version'
+    target = image_version(binary)
+    if target and normalize_version(version) == normalize_version(target):
+        return 'DONE', 'Already running {}'.format(version)
+    if version.split('.')[0] == '3' or version.startswith('03.'):
+        return 'NO-GO', '3.x code is not supported by this script'
+    if facts.get('mode') == 'BUNDLE':
+        return 'NO-GO', 'BUNDLE mode, convert to INSTALL mode first'
+    if size and facts.get('free') is not None and facts['free'] < size * SPACE_FACTOR:
+        return 'NO-GO', 'Not enough flash, try request platform software package clean'
+    return 'GO', ''
+
+
+def run(devices, user, pw, workers=WORKERS):
+    '''
+    Check every switch concurrently
+    :param devices: list of [host, binary, md5, size, site]
+    :return: one dict per device, in the same order, with the COLUMNS as keys
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        gathered = list(pool.map(lambda device: gather(device[0], user, pw), devices))
+    rows = []
+    for device, facts in zip(devices, gathered):
+        host, binary, size = device[0], device[1], device[3]
+        result, reason = decide(facts, binary, size)
+        rows.append({
+            'Host': host,
+            'Model': facts.get('model') or '',
+            'Binary': binary,
+            'Version': facts.get('version') or '',
+            'Mode': facts.get('mode') or '',
+            'Members': facts.get('members') or '',
+            'Free MB': facts['free'] // 1000000 if facts.get('free') is not None else '',
+            'Needed MB': size * SPACE_FACTOR // 1000000 if size else '',
+            'Result': result,
+            'Reason': reason,
+        })
+    return rows
+
+
+def print_table(rows):
+    widths = {column: max([len(column)] + [len(str(row[column])) for row in rows]) for column in COLUMNS}
+    print('  '.join(column.ljust(widths[column]) for column in COLUMNS))
+    print('  '.join('-' * widths[column] for column in COLUMNS))
+    for row in rows:
+        print('  '.join(str(row[column]).ljust(widths[column]) for column in COLUMNS))
+
+
+def write_csv(rows, filename):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+""" Summary: Reloads the staged switches in batches and checks they come back upgraded
+
+Description:
+    Switches are reloaded a batch at a time, and every switch of a batch
+    is reloaded at once. For each one, TCP port 22 is probed until the
+    switch has gone down and come back. The probes back off exponentially,
+    so a few hundred waiting switches cost next to nothing. Once SSH
+    answers, 'show version' must show the target version and every stack
+    member. This is the health gate.
+
+    The next batch starts as soon as every switch of the current one has
+    passed or failed its gate. If more switches fail than allowed, the
+    user is asked before the next batch goes.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Development"
+
+
+""" Importing built-in modules """
+import re
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+""" Import external modules """
+import paramiko
+
+""" Import local modules """
+import installmonitor
+import preflight
+
+
+BATCH_SIZE = 10
+
+# Seconds a switch has to go down after the reload, and to come back
+DOWN_TIMEOUT = 300
+UP_TIMEOUT = 1800
+
+# Probe backoff, in seconds
+FIRST_PROBE = 5
+MAX_PROBE = 60
+
+# Never save the configuration on the way down. The seed's SCP server should go away with the reload.
+# Anchored at the end of the line, so the echoed 'no' doesn't make it match again and land on [confirm].
+RELOAD_ANSWERS = [(re.compile(r'(Save\?|save the configuration)[^\]]*\[[^\]]*\]\s*[?:]?\s*$', re.IGNORECASE), 'no\n')]
+
+
+def port_open(host, port=22, timeout=3):
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for(host, up, timeout):
+    '''
+    Probe TCP/22 with exponential backoff until it is open (up) or closed (not up)
+    :return: True when the state was reached before the timeout
+    '''
+    deadline = time.monotonic() + timeout
+    delay = FIRST_PROBE
+    while time.monotonic() < deadline:
+        if port_open(host) == up:
+            return True
+        time.sleep(min(delay, max(0, deadline - time.monotonic())))
+        delay = min(delay * 2, MAX_PROBE)
+    return False
+
+
+def connect(host, user, pw):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(host, username=user, password=pw, timeout=preflight.CONNECT_TIMEOUT,
+                banner_timeout=preflight.CONNECT_TIMEOUT, auth_timeout=preflight.CONNECT_TIMEOUT)
+    monitor = installmonitor.Monitor(ssh.invoke_shell(), host)
+    monitor.start()
+    return ssh, monitor
+
+
+def reload_switch(host, user, pw):
+    ''' Issue the reload. The session ends when the switch goes down. '''
+    ssh, monitor = connect(host, user, pw)
+    try:
+        monitor.run('reload', timeout=120, answers=RELOAD_ANSWERS)
+    except installmonitor.ChannelClosed:
+        pass
+    except installmonitor.CommandTimeout:
+        # Some platforms keep the session open until the reload is well under way
+        pass
+    finally:
+        ssh.close()
+
+
+def check_version(host, user, pw):
+    ''' Return (version, members) as reported by the reloaded switch '''
+    ssh, monitor = connect(host, user, pw)
+    try:
+        monitor.run('terminal length 0', timeout=preflight.CONNECT_TIMEOUT)
+        version, mode, members = preflight.parse_show_version(monitor.run('show version', timeout=60))
+    finally:
+        ssh.close()
+    return version, members
+
+
+def reload_and_verify(host, binary, members, user, pw):
+    '''
+    Reload one switch and wait for it to come back upgraded
+    :param members: stack members expected back, or None when unknown
+    :return: (ok, message, timings), where timings has the seconds of the reload (until SSH is back)
+             and of the verify
+    '''
+    started = time.time()
+    timings = {}
+    target = preflight.image_version(binary)
+    try:
+        print(host , 'reloading')
+        reload_switch(host, user, pw)
+        if not wait_for(host, False, DOWN_TIMEOUT):
+            return False, 'Did not go down after the reload', timings
+        if not wait_for(host, True, UP_TIMEOUT):
+            return False, 'Not back after {} minutes'.format(UP_TIMEOUT // 60), timings
+        timings['reload'] = time.time() - started
+        print(host , 'is back, checking the version')
+        # SSH answers a little before the switch is ready to log in
+        attempts = 5
+        for attempt in range(attempts):
+            try:
+                version, found = check_version(host, user, pw)
+                break
+            except paramiko.AuthenticationException:
+                # A subclass of SSHException, but trying again won't fix the password
+                raise
+            except (socket.error, paramiko.SSHException, installmonitor.MonitorError):
+                if attempt < attempts - 1:
+                    time.sleep(FIRST_PROBE * 2 ** attempt)
+        else:
+            return False, 'Back, but SSH login keeps failing', timings
+    except paramiko.AuthenticationException as e:
+        return False, 'Authentication failed: {}'.format(e), timings
+    except (socket.error, paramiko.SSHException, installmonitor.MonitorError) as e:
+        return False, 'Reload failed: {}'.format(e), timings
+
+    timings['verify'] = time.time() - started - timings['reload']
+    if not version or (target and preflight.normalize_version(version) != preflight.normalize_version(target)):
+        return False, 'Came back running {}'.format(version), timings
+    if members and found < members:
+        return False, 'Running {}, but only {} of {} stack members are back'.format(version, found, members), timings
+    return True, 'Reloaded, running {}'.format(version), timings
+
+
+def run(switches, user, pw, batch_size=BATCH_SIZE, max_failures=0, ask=input):
+    '''
+    Reload the switches a batch at a time
+    :param switches: list of (host, binary, members)
+    :param max_failures: failures per batch before the user is asked whether to go on
+    :param ask: asks the user a question and returns the answer
+    :return: list of (host, ok, message, timings), for the switches that were reloaded
+    '''
+    results = []
+    for start in range(0, len(switches), batch_size):
+        batch = switches[start:start + batch_size]
+        print('')
+        print('Reloading batch {} of {}: {}'.format(start // batch_size + 1, (len(switches) - 1) // batch_size + 1,
+                                                   ', '.join(host for host, binary, members in batch)))
+        with ThreadPoolExecutor(max_workers=len(batch)) as pool:
+            outcomes = list(pool.map(lambda switch: reload_and_verify(switch[0], switch[1], switch[2], user, pw), batch))
+        failed = 0
+        for (host, binary, members), (ok, message, timings) in zip(batch, outcomes):
+            print('   ' , host , message , '({:.0f} s)'.format(sum(timings.values())))
+            results.append((host, ok, message, timings))
+            failed += not ok
+        if failed > max_failures and start + batch_size < len(switches):
+            if ask('{} switches of this batch failed. Reload the next batch? (y/N): '.format(failed)).strip().lower() != 'y':
+                break
+    return results
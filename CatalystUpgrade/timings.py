@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+""" Summary: Upgrade timing history and maintenance window planner
+
+Description:
+    Every run appends how long each phase took on each switch to
+    upgrade_history.csv. The phases are transfer (copying the image),
+    install, reload (until SSH is back) and verify. The platform and
+    image size are recorded with each phase.
+
+    The planner uses that history to predict how long a proposed upgrade
+    CSV will take for a given number of concurrent switches, image server
+    slots and reload batch size:
+
+        - estimates are the median of the past runs of the same platform
+          and phase. Transfers are scaled by image size. Phases that have
+          no history fall back to all platforms, then to rough defaults
+        - staging is simulated: each switch waits for a thread and an
+          image server slot, copies its image, then installs it
+        - reload batches take as long as their slowest switch
+
+    The switches are ordered longest first for staging, and grouped by
+    reload time into batches, so that slow switches don't hold up fast
+    ones. If the plan doesn't fit the window, the planner also works out
+    the concurrency that would make it fit.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Development"
+
+
+""" Importing built-in modules """
+import csv
+import datetime
+import heapq
+import os
+import statistics
+import threading
+
+
+HISTORY_FILE = 'upgrade_history.csv'
+HISTORY_COLUMNS = ['Date', 'Host', 'Platform', 'Binary', 'Size', 'Phase', 'Seconds', 'OK']
+PHASES = ['transfer', 'install', 'reload', 'verify']
+
+# Used until there is history: transfers at 50 Mbit/s, the rest in seconds
+DEFAULT_TRANSFER_BPS = 50000000 / 8
+DEFAULTS = {'install': 900, 'reload': 600, 'verify': 30}
+DEFAULT_SIZE = 800000000
+
+history_lock = threading.Lock()
+
+
+def record(host, platform, binary, size, phase, seconds, ok=True, historyfile=HISTORY_FILE):
+    ''' Append one phase timing to the history. Safe to call from any thread. '''
+    with history_lock:
+        new = not os.path.exists(historyfile)
+        with open(historyfile, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(HISTORY_COLUMNS)
+            writer.writerow([datetime.datetime.now().isoformat(timespec='seconds'), host, platform or '', binary,
+                             size or '', phase, '{:.1f}'.format(seconds), 'y' if ok else 'n'])
+
+
+def load(historyfile=HISTORY_FILE):
+    ''' Return the successful timings of past runs '''
+    try:
+        with open(historyfile, 'r', newline='') as f:
+            return [row for row in csv.DictReader(f) if row['OK'] == 'y']
+    except OSError:
+        return []
+
+
+def known_platforms(history):
+    ''' Platform last seen on each host '''
+    return {row['Host']: row['Platform'] for row in history if row['Platform']}
+
+
+class Estimator:
+    '''
+    :param history: rows from load()
+    '''
+
+    def __init__(self, history):
+        self.samples = {}
+        for row in history:
+            seconds = float(row['Seconds'])
+            if row['Phase'] == 'transfer':
+                # Transfers are kept as bytes per second, so they scale to any image size
+                if not row['Size'] or not seconds:
+                    continue
+                seconds = int(row['Size']) / seconds
+            for platform in (row['Platform'], None):
+                self.samples.setdefault((platform, row['Phase']), []).append(seconds)
+
+    def estimate(self, platform, phase, size=None):
+        ''' Expected seconds of a phase '''
+        samples = self.samples.get((platform, phase)) or self.samples.get((None, phase))
+        if phase == 'transfer':
+            rate = statistics.median(samples) if samples else DEFAULT_TRANSFER_BPS
+            return (size or DEFAULT_SIZE) / rate
+        return statistics.median(samples) if samples else DEFAULTS[phase]
+
+
+def simulate(jobs, threads, slots, batch_size):
+    '''
+    Predict the wall time of a wave
+    :param jobs: list of dicts with transfer, install, reload and verify seconds, in run order
+    :param threads: switches worked on at once
+    :param slots: image server copy slots, over all servers
+    :param batch_size: switches reloaded at once
+    :return: (staging seconds, reload seconds, list of expected staging start per job)
+    '''
+    workers = [0.0] * max(1, threads)
+    servers = [0.0] * max(1, slots)
+    starts = []
+    staged = 0.0
+    for job in jobs:
+        start = heapq.heappop(workers)
+        copy_start = max(start, heapq.heappop(servers))
+        copy_end = copy_start + job['transfer']
+        heapq.heappush(servers, copy_end)
+        end = copy_end + job['install']
+        heapq.heappush(workers, end)
+        starts.append(start)
+        staged = max(staged, end)
+    reloads = 0.0
+    for first in range(0, len(jobs), max(1, batch_size)):
+        batch = jobs[first:first + batch_size]
+        reloads += max(job['reload'] + job['verify'] for job in batch)
+    return staged, reloads, starts
+
+
+def plan(devices, platforms, estimator, threads, slots, batch_size, window_seconds):
+    '''
+    Order a wave and predict how long it takes
+
+    :param devices: list of [host, binary, md5, size, site]
+    :param platforms: dict of host to platform
+    :param estimator: Estimator
+    :param window_seconds: length of the maintenance window
+    :return: dict with the ordered jobs and predicted times. When the plan doesn't fit the window,
+             'fits' holds the (threads, reload batch size) that would make it fit
+    '''
+    jobs = []
+    for device in devices:
+        platform = platforms.get(device[0], '')
+        job = {'device': device, 'platform': platform}
+        for phase in PHASES:
+            job[phase] = estimator.estimate(platform, phase, device[3])
+        jobs.append(job)
+
+    # Longest staging first keeps the tail of the wave short
+    jobs.sort(key=lambda job: job['transfer'] + job['install'], reverse=True)
+    staged, reloads, starts = simulate(jobs, threads, slots, batch_size)
+    for job, start in zip(jobs, starts):
+        job['start'] = start
+
+    # Reload batches of similar switches, so one slow switch doesn't hold up a batch of fast ones
+    reload_order = reload_sort(jobs)
+    for index, job in enumerate(reload_order):
+        job['batch'] = index // max(1, batch_size) + 1
+    reloads = simulate(reload_order, threads, slots, batch_size)[1]
+
+    result = {'jobs': jobs, 'staging': staged, 'reloads': reloads, 'total': staged + reloads, 'fits': None}
+    if staged + reloads > window_seconds:
+        # The least concurrency that fits: more threads first, then bigger reload batches
+        for more in range(threads + 1, len(jobs) + 1):
+            if simulate(jobs, more, slots, batch_size)[0] + reloads <= window_seconds:
+                result['fits'] = (more, batch_size)
+                break
+        else:
+            staged = simulate(jobs, len(jobs), slots, batch_size)[0]
+            for batch in range(batch_size + 1, len(jobs) + 1):
+                if staged + simulate(reload_order, threads, slots, batch)[1] <= window_seconds:
+                    result['fits'] = (len(jobs), batch)
+                    break
+    return result
+
+
+def reload_sort(jobs):
+    ''' Slowest reloads first, so each batch holds switches of about the same reload time '''
+    return sorted(jobs, key=lambda job: job['reload'] + job['verify'], reverse=True)
+
+
+def write_plan(result, filename):
+    ''' Write the plan as an upgrade CSV in run order. The extra columns are ignored when it is run. '''
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ip', 'binary', 'md5', 'site', 'platform', 'expected start (min)', 'reload batch'])
+        for job in result['jobs']:
+            host, binary, md5, size, site = job['device']
+            writer.writerow([host, binary, md5, site, job['platform'], round(job['start'] / 60), job['batch']])
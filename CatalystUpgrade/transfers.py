@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+""" Summary: Schedules image copies across the image servers
+
+Description:
+    When every switch pulls its image from the same FTP server at once,
+    the server's uplink is shared by all of them. Copy times then grow
+    with the number of switches until copies start timing out. The
+    scheduler instead gives every server a number of copy slots. A
+    switch waits for a free slot on the least busy server before it
+    starts its copy, and gives the slot back as soon as the copy is done.
+    The install that follows does not need the server.
+
+    Servers are given as address[/slots[/mbps]], comma separated, e.g.
+
+        10.1.1.10/4/1000,10.2.1.10:2121/2,[2001:db8::10]/2
+
+    The address may carry a port. An IPv6 address with a port goes in
+    brackets.
+
+    If a server's uplink speed (mbps) is given, a copy is only started
+    while every running copy still gets at least MIN_SHARE_MBPS of it.
+    Each finished copy's throughput is recorded so the run can be
+    reviewed and the slots tuned.
+
+    With site seeding, the switches of a site fetch each image across the
+    WAN only once. The first switch of the site to need an image becomes
+    its seed. It copies the image from the image servers, while the other
+    switches of the site wait. Once the seed has the image, it serves
+    them over SCP on the LAN. If the seed fails, the next waiting switch
+    takes over as seed. The SCP URL only holds the username. The password
+    is typed at the switch's Password: prompt, so it never shows up in the
+    echoed command, the transcript or the results.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Development"
+
+
+""" Importing built-in modules """
+import contextlib
+import ipaddress
+import threading
+import time
+
+
+DEFAULT_SLOTS = 4
+
+# Below this a 400 MB image takes over 10 minutes, long enough to hit copy timeouts
+MIN_SHARE_MBPS = 5
+
+# Copies a seed switch serves at once, on top of its own install
+SEED_SLOTS = 4
+
+
+class ImageServer:
+    '''
+    :param address: server address, with the port if it isn't the default. IPv6 with a port in brackets.
+    :param slots: most copies served at the same time
+    :param mbps: uplink speed in Mbit/s, or None when unknown
+    :param scheme: ftp, http for the built-in image server or scp for a seed switch
+    :param credentials: (user, password) the switches log in with, for scp. Only the user goes in the URL.
+    '''
+
+    def __init__(self, address, slots=DEFAULT_SLOTS, mbps=None, scheme='ftp', credentials=None):
+        self.address = address
+        self.slots = slots
+        self.mbps = mbps
+        self.scheme = scheme
+        self.credentials = credentials
+        self.active = 0
+        self.peak = 0
+        self.completed = []
+        self.failed = 0
+
+    def admits(self, min_share):
+        ''' True when one more copy can start without starving the running ones '''
+        if self.active >= self.slots:
+            return False
+        # A server always takes at least one copy, however slow its uplink
+        return self.mbps is None or self.active == 0 or (self.active + 1) * min_share <= self.mbps
+
+    def host(self):
+        ''' The address as it goes in a URL, with a bare IPv6 address in brackets '''
+        if self.address.count(':') > 1 and not self.address.startswith('['):
+            return '[{}]'.format(self.address)
+        return self.address
+
+    def url(self, binary):
+        ''' URL a switch copies the image from. Safe to print, as it never holds the password. '''
+        if self.scheme == 'scp':
+            return 'scp://{}@{}/flash:{}'.format(self.credentials[0], self.host(), binary)
+        return '{}://{}/{}'.format(self.scheme, self.host(), binary)
+
+    def password(self):
+        ''' Password to type at the switch's Password: prompt during the copy, or None '''
+        return self.credentials[1] if self.credentials else None
+
+    def load(self):
+        return self.active / self.slots
+
+    def throughput(self):
+        ''' Average Mbit/s of the copies done so far, or None '''
+        seconds = sum(seconds for size, seconds in self.completed)
+        if not seconds:
+            return None
+        return sum(size for size, seconds in self.completed) * 8 / seconds / 1000000
+
+    def __str__(self):
+        return self.address
+
+
+class Transfer:
+    ''' One image copy holding a slot on a server '''
+
+    def __init__(self, server, binary, size=None):
+        self.server = server
+        self.binary = binary
+        self.size = size
+        self.started = time.time()
+        self.seconds = None
+        self.ok = True
+
+    def done(self, size=None):
+        '''
+        :param size: bytes copied, when the device reported it
+        '''
+        self.seconds = time.time() - self.started
+        if size:
+            self.size = size
+
+    def fail(self):
+        self.ok = False
+
+    def mbps(self):
+        if not self.size or not self.seconds:
+            return None
+        return self.size * 8 / self.seconds / 1000000
+
+
+class SiteSeed:
+    ''' The switch of a site that fetches an image for the whole site '''
+
+    def __init__(self):
+        # Switch currently copying the image from the image servers
+        self.host = None
+        # ImageServer of the seed switch, once it has the image
+        self.server = None
+
+
+class TransferScheduler:
+    '''
+    :param servers: list of ImageServer, each holding every image
+    :param min_share: Mbit/s every running copy should get at least
+    :param seed_credentials: (user, password) for copies between switches, or None to not seed sites
+    '''
+
+    def __init__(self, servers, min_share=MIN_SHARE_MBPS, seed_credentials=None):
+        self.servers = servers
+        self.min_share = min_share
+        self.seed_credentials = seed_credentials
+        self.seeds = {}
+        self.changed = threading.Condition()
+
+    def seeding(self, site):
+        return bool(site) and self.seed_credentials is not None
+
+    def seed_source(self, host, binary, site):
+        '''
+        Find out where host should copy the image from, waiting while another switch of the site fetches it
+
+        :return: the ImageServer of the site's seed, or None when host is the seed and
+                 copies from the image servers itself
+        '''
+        if not self.seeding(site):
+            return None
+        with self.changed:
+            seed = self.seeds.setdefault((site, binary), SiteSeed())
+            while True:
+                if seed.server is not None:
+                    return seed.server
+                if seed.host in (None, host):
+                    seed.host = host
+                    return None
+                self.changed.wait()
+
+    def needs_seed(self, binary, site):
+        ''' True while no switch of the site serves the image yet '''
+        if not self.seeding(site):
+            return False
+        with self.changed:
+            seed = self.seeds.get((site, binary))
+            return seed is None or seed.server is None
+
+    def seed_ready(self, host, binary, site):
+        ''' host has a verified copy of the image, so the rest of its site can copy from it '''
+        with self.changed:
+            seed = self.seeds.setdefault((site, binary), SiteSeed())
+            if seed.server is None:
+                seed.host = host
+                seed.server = ImageServer(host, SEED_SLOTS, scheme='scp', credentials=self.seed_credentials)
+            self.changed.notify_all()
+
+    def seed_done(self, host):
+        ''' Called when host is done. If it was seeding and never got the image, another switch takes over. '''
+        with self.changed:
+            for seed in self.seeds.values():
+                if seed.host == host and seed.server is None:
+                    seed.host = None
+            self.changed.notify_all()
+
+    @contextlib.contextmanager
+    def transfer(self, binary, size=None, servers=None):
+        '''
+        Wait for a free slot on the least busy server and hold it for one copy
+
+        :param binary: image being copied
+        :param size: image size in bytes, if known
+        :param servers: servers to pick from, default the image servers
+        :return: Transfer, whose server the image should be copied from
+        '''
+        with self.changed:
+            while True:
+                candidates = [server for server in servers or self.servers if server.admits(self.min_share)]
+                if candidates:
+                    server = min(candidates, key=ImageServer.load)
+                    break
+                self.changed.wait()
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        transfer = Transfer(server, binary, size)
+        try:
+            yield transfer
+        except BaseException:
+            transfer.fail()
+            raise
+        finally:
+            with self.changed:
+                server.active -= 1
+                if transfer.seconds is None:
+                    transfer.done()
+                if transfer.ok and transfer.size:
+                    server.completed.append((transfer.size, transfer.seconds))
+                elif not transfer.ok:
+                    server.failed += 1
+                self.changed.notify_all()
+
+    def report(self):
+        ''' Return one summary line per server, including the seed switches '''
+        lines = []
+        seeds = [seed.server for seed in self.seeds.values() if seed.server is not None]
+        for server in self.servers + seeds:
+            throughput = server.throughput()
+            lines.append('{}{}: {} copies, {} failed, at most {} at once, {}'.format(
+                'seed ' if server.scheme == 'scp' else '', server.address, len(server.completed), server.failed, server.peak,
+                'average {:.1f} Mbit/s per copy'.format(throughput) if throughput else 'no throughput measured'))
+        return lines
+
+
+def parse_servers(text):
+    '''
+    Parse the servers typed at the prompt. Raises ValueError on an entry that can't be read.
+    :param text: comma separated address[/slots[/mbps]]. The address may end in :port,
+                 an IPv6 address with a port is written [address]:port.
+    :return: list of ImageServer
+    '''
+    servers = []
+    for item in text.split(','):
+        parts = [part.strip() for part in item.strip().split('/')]
+        if not parts[0]:
+            continue
+        example = 'e.g. 10.1.1.10/4/1000 for 4 copies at once over a 1000 Mbit/s uplink'
+        if len(parts) > 3:
+            raise ValueError('{}: expected address/copies/mbps, {}'.format(item.strip(), example))
+        if parts[0].count(':') > 1 and not parts[0].startswith('['):
+            # Only a bare IPv6 address has several colons. Catches the old address:copies:mbps form too.
+            try:
+                ipaddress.IPv6Address(parts[0])
+            except ValueError:
+                raise ValueError('{}: not an address. Separate copies and mbps with /, {}'.format(item.strip(), example))
+        try:
+            slots = int(parts[1]) if len(parts) > 1 and parts[1] else DEFAULT_SLOTS
+            mbps = float(parts[2]) if len(parts) > 2 and parts[2] else None
+        except ValueError:
+            raise ValueError('{}: copies and mbps must be numbers, {}'.format(item.strip(), example))
+        servers.append(ImageServer(parts[0], max(1, slots), mbps))
+    return servers
@@ -20,129 +20,115 @@ __status__ = "Production"
 
 
 """ Importing built-in modules"""
-import json
+import os
 import sys
 import csv
 import datetime
 import time
 
 """ Import external modules """
-import requests
 import configparser
 
+""" Import local modules """
+# The API helpers shared by the tools live in the common folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import apitoken
+import ratelimit
+import supportapi
+
+
+MAX_BATCH = supportapi.EOX_MAX_BATCH
+
+# Shared by every call so the API's per-second and per-day quotas are respected
+limiter = ratelimit.from_config()
+
+CSV_HEADER = ['Device', 'Product ID', 'Description', 'End of Sale',
+              'End of Software Maint', 'End of Security Vul Support', 'End of Routine Failure',
+              'End of Service Contract', 'Last Date of Support', 'End of Service Attach',
+              'Migratin PID']
+
 
 def get_csv(datafile):
+    '''
+    This function streams the input CSV rather than loading it into memory
 
-    devices = []
-    print('Using' + datafile + ' as version input file.')
+    :param datafile: CSV with a 'serial' or 'pid' header and one value per line
+    :return: the search type, and a generator of the remaining values
+    '''
+    print('Using ' + datafile + ' as version input file.')
     print('')
-    with open(datafile, 'r', newline='') as infile:
-        for row in csv.reader(infile):
+    infile = open(datafile, 'r', newline='')
+    rows = (row[0].strip() for row in csv.reader(infile)
             # Remove any blank lines
-            if any(entry.strip() for entry in row):
-                devices.append(row[0])
-    title = devices[0]
-    if title.lower() == 'serial':
-        searchtype = 'serial'
-    if title.lower() == 'pid':
-        searchtype = 'pid'
-    del devices[0]
-    return searchtype, devices
-
-
-def get_access_token(client_id, client_secret):
-    '''
-    This function will get the access token from Cisco to be used in further queries
+            if any(entry.strip() for entry in row))
+    title = next(rows, '')
+    if title.lower() not in ['serial', 'pid']:
+        infile.close()
+        print("The first line of " + datafile + " must be either 'serial' or 'pid'.")
+        sys.exit(1)
 
-    :param client_id: the client id that was created on the apiconsole.cisco.com
-    :param client_secret: the client secret that was created in apiconsole.cisco.com
+    def devices():
+        with infile:
+            yield from rows
 
-    :return: access token to be used in other queries
-    '''
+    return title.lower(), devices()
 
-    url = "https://cloudsso.cisco.com/as/token.oauth2?grant_type=client_credentials&client_id=" + \
-        client_id + \
-        "&client_secret=" + \
-        client_secret
 
-    headers = {
-        'accept': "application/json",
-        'content-type': "application/x-www-form-urlencoded",
-        'cache-control': "no-cache"
-    }
+def get_eox_details(token, inputvalue, searchtype, pageindex=1):
+    ''' One page of EOX records for up to MAX_BATCH comma separated values, see supportapi.get_eox_details '''
+    return supportapi.get_eox_details(limiter, token, inputvalue, searchtype, pageindex)
 
-    response = requests.request("POST", url, headers=headers)
 
-    if (response.status_code == 200):
-        return response.json()['access_token']
-    else:
-        response.raise_for_status()
+def get_eox_batch(token, batch, searchtype):
+    ''' Every EOX record of a batch of values, see supportapi.get_eox_batch '''
+    return supportapi.get_eox_batch(limiter, token, batch, searchtype)
 
 
-def get_eox_details(access_token, inputvalue, searchtype):
+def print_eox_details(data, export):
     '''
-    This function will get the EOX record for a particular search
+    This function will parse the desired value from a particular search
 
-    :param access_token: Access Token retrieved from cisco to query the searchtypes
-    :param inputvalue: The serial number of pid that is used to query
-    :param searchtype: The type of search type to perform.   Either pid or serial
-    :return: json format of the retrieved data
+    :param data: the json data returned from the get_eox_detailsget_eox_details function
+    :param export: the user's y/n input for exporting all the results to a csv
+    :return: list of desired values from the device
     '''
-    if searchtype in ["pid"]:
-        url = "https://api.cisco.com/supporttools/eox/rest/5/EOXByProductID/1/" + inputvalue + "?responseencoding=json"
-    elif searchtype in ["serial"]:
-        url = "https://api.cisco.com/supporttools/eox/rest/5/EOXBySerialNumber/1/" + inputvalue + "?responseencoding=json"
-    else:
-        return
-
-    headers = {
-        'authorization': "Bearer " + access_token,
-        'accept': "application/json",
-    }
-
-    response = requests.request("POST", url, headers=headers)
-
-    if (response.status_code == 200):
-        # Uncomment to debug
-        # sys.stderr.write(response.text)
-        # print (response.text)
-        return json.loads(response.text)
-    else:
-        response.raise_for_status()
-        return
+    try:
+        return print_eox_record(data['EOXRecord'][0], export)
+    except Exception:
+        return None
 
 
-def print_eox_details(data, export):
+def print_eox_record(record, export):
     '''
-    This function will parse the desired value from a particular search
+    This function will parse the desired value from a single EOX record
 
-    :param data: the json data returned from the get_eox_detailsget_eox_details function
+    :param record: one entry of the EOXRecord list returned by the API
     :param export: the user's y/n input for exporting all the results to a csv
     :return: list of desired values from the device
     '''
     try:
-        EOLProductID = data['EOXRecord'][0]['EOLProductID']
+        EOLProductID = record['EOLProductID']
         if EOLProductID == "":
+            status = 'Lookup Failed' if record.get('LookupFailed') else 'Not Found'
             print("No Records Found!")
             if export == 'y':
-                devicedata = [data['EOXRecord'][0]['EOXInputValue'], 'Not Found', 'Not Found', 'Not Found',
-                'Not Found', 'Not Found', 'Not Found', 'Not Found', 'Not Found', 'Not Found', 'Not Found']
+                devicedata = [record['EOXInputValue']] + [status] * 10
                 return devicedata
             else:
                 return None
         else:
-            EOXInputValue = data['EOXRecord'][0]['EOXInputValue']
-
-            ProductIDDescr = data['EOXRecord'][0]['ProductIDDescription']
-            EOSDate = data['EOXRecord'][0]['EndOfSaleDate']['value']
-
-            EOSWMDate = data['EOXRecord'][0]['EndOfSWMaintenanceReleases']['value']
-            EOSSVulDate = data['EOXRecord'][0]['EndOfSecurityVulSupportDate']['value']
-            EORoutineFailureDate = data['EOXRecord'][0]['EndOfRoutineFailureAnalysisDate']['value']
-            EOSCRDate = data['EOXRecord'][0]['EndOfServiceContractRenewal']['value']
-            LDOSDate = data['EOXRecord'][0]['LastDateOfSupport']['value']
-            EOSvcAttachDate = data['EOXRecord'][0]['EndOfSvcAttachDate']['value']
-            MigrationDetails = data['EOXRecord'][0]['EOXMigrationDetails']['MigrationProductId']
+            EOXInputValue = record['EOXInputValue']
+
+            ProductIDDescr = record['ProductIDDescription']
+            EOSDate = record['EndOfSaleDate']['value']
+
+            EOSWMDate = record['EndOfSWMaintenanceReleases']['value']
+            EOSSVulDate = record['EndOfSecurityVulSupportDate']['value']
+            EORoutineFailureDate = record['EndOfRoutineFailureAnalysisDate']['value']
+            EOSCRDate = record['EndOfServiceContractRenewal']['value']
+            LDOSDate = record['LastDateOfSupport']['value']
+            EOSvcAttachDate = record['EndOfSvcAttachDate']['value']
+            MigrationDetails = record['EOXMigrationDetails']['MigrationProductId']
             print("Search Value: " + EOXInputValue)
             print("Product ID: " + EOLProductID)
             print("Product Description: " + ProductIDDescr)
@@ -184,11 +170,12 @@ def getClient():
         print("Unexpected Error")
         sys.exit(1)
 
-    access_token = get_access_token(client_id, client_secret)
-    return access_token
+    # Cached on disk between runs, and refreshed in the background mid-run
+    token = apitoken.TokenProvider(client_id, client_secret)
+    return token.start()
 
 
-def getdata(searchtype, device, access_token):
+def getdata(searchtype, device, token):
     try:
         if searchtype is None:
             data = input("Enter search string (ex: 'serial {serialnumber}' or 'pid {pid}' or 'quit'): ")
@@ -198,21 +185,51 @@ def getdata(searchtype, device, access_token):
             searchtype = searchtype.lower()
             if searchtype not in ['serial', 'pid']:
                 print("Unknown search type: " + searchtype + ". Please try again")
-                getdata(searchtype, device, access_token)
+                getdata(searchtype, device, token)
         else:
             inputstring = device
 
         print("Performing " + searchtype + " search for: '" + inputstring.upper() + "':")
-        order_text = get_eox_details(access_token, str(inputstring.upper()), searchtype)
+        order_text = get_eox_details(token, str(inputstring.upper()), searchtype)
         # print_eox_details(order_text)
         return order_text
 
-    except Exception:
-        print('Unknown Error. Sleeping for 10 seconds. Hoping things clear up.')
-        time.sleep(10)
+    except Exception as e:
+        print('Lookup failed: ' + str(e))
         return None
 
 
+def getbatch(searchtype, batch, token):
+    try:
+        print("Performing " + searchtype + " search for: '" + ','.join(batch) + "':")
+        return list(get_eox_batch(token, batch, searchtype))
+
+    except Exception as e:
+        # The limiter already retried, so report the batch as failed rather than dropping it
+        print('Lookup failed: ' + str(e))
+        return [failed_record(device) for device in batch]
+
+
+def batch_records(searchtype, batch, token):
+    '''
+    This function looks up a batch and returns one EOX record per value, in order,
+    as looking up each value on its own would
+
+    :param searchtype: pid or serial
+    :param batch: list of at most MAX_BATCH values
+    :param token: apitoken.TokenProvider handing out the access token used to query
+    :return: list of EOX records. A value the API didn't answer gets an empty record (Not Found).
+    '''
+    records = supportapi.eox_records_by_value(getbatch(searchtype, batch, token), batch)
+    # A record answering several values lists them all in EOXInputValue, so each row gets its own value
+    return [dict(records.get(device, {'EOLProductID': ''}), EOXInputValue=device) for device in batch]
+
+
+def failed_record(device):
+    ''' Stand-in EOX record for a value whose lookup failed '''
+    return {'EOXInputValue': device, 'EOLProductID': '', 'LookupFailed': True}
+
+
 def ManualOrCSV():
     print('\n')
     print('Would you like to use a:')
@@ -232,8 +249,7 @@ def main():
 
     device = None
     searchtype = None
-    devicetable = []
-    access_token = getClient()
+    token = getClient()
     SourceList = ManualOrCSV()
 
     # Defining date & time
@@ -244,41 +260,38 @@ def main():
         # Use a CSV for the source. This also allows the results to be exported to a CSV.
         if SourceList.lower() == '1':
             export = input('Would you like to save the results in a CSV? (y/n) ')
+            if export != 'y':
+                export = 'n'
+
+            searchtype, devices = get_csv(datafile)
+            f = None
             if export == 'y':
                 csvExport = 'outfile-{}.csv'.format(timestamp)
                 # Specifying the CSV export filename
-                writer = csv.writer(open(csvExport, 'w', newline=''))
-                writer.writerow(['Device', 'Product ID', 'Description', 'End of Sale',
-                'End of Software Maint', 'End of Security Vul Support', 'End of Routine Failure',
-                'End of Service Contract', 'Last Date of Support', 'End of Service Attach',
-                'Migratin PID'])
-            else:
-                export == 'n'
-
-            searchtype, devices = get_csv(datafile)
-            for device in devices:
-                try:
-                    order_text = getdata(searchtype, device, access_token)
-                except KeyboardInterrupt:
-                    print('Keyboard Interrupt. Exiting...\n')
-                    break
-                finally:
-                    devicedata = print_eox_details(order_text, export)
-                    devicetable.append(devicedata)
+                f = open(csvExport, mode='w', newline='')
+                writer = csv.writer(f)
+                writer.writerow(CSV_HEADER)
+
+            try:
+                # Rows stream through in batches, and each batch is written as soon as
+                # it is looked up so partial results survive an interrupted run.
+                for batch in supportapi.batched(supportapi.dedupe(devices), MAX_BATCH):
+                    try:
+                        records = batch_records(searchtype, batch, token)
+                    except KeyboardInterrupt:
+                        print('Keyboard Interrupt. Exiting...\n')
+                        break
+                    for record in records:
+                        devicedata = print_eox_record(record, export)
+                        if devicedata is not None:
+                            writer.writerow(devicedata)
+                    if f is not None:
+                        f.flush()
+            finally:
+                if f is not None:
+                    f.close()
 
             if export == 'y':
-                with open(csvExport, mode='w', newline='') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(['Device', 'Product ID', 'Description', 'End of Sale',
-                    'End of Software Maint', 'End of Security Vul Support', 'End of Routine Failure',
-                    'End of Service Contract', 'Last Date of Support', 'End of Service Attach',
-                    'Migratin PID'])
-                    for item in devicetable:
-                        if item is None:
-                            # Accounts for a 'No records found'
-                            pass
-                        else:
-                            writer.writerow(item)
                 print(f'CSV saved at: {csvExport}')
             sys.exit(0)
 
@@ -286,12 +299,12 @@ def main():
         if SourceList.lower() == '2':
             export = 'n'
             done = False
-            order_text = getdata(searchtype, device, access_token)
+            order_text = getdata(searchtype, device, token)
             print_eox_details(order_text, export)
             while not done:
                 again = input('Run again?  (y/n)   ').lower()
                 if again.lower() == 'y':
-                    order_text = getdata(searchtype, device, access_token)
+                    order_text = getdata(searchtype, device, token)
                     print_eox_details(order_text, export)
                 else:
                     print('\n')
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+""" Summary: Latency and throughput benchmark for the EOX REST lookup API
+
+Description:
+    Sends lookups to a running EOX service from many concurrent clients
+    and reports throughput and latency percentiles. Every run is done
+    twice: the first pass fills the shared cache (cold), the second is
+    answered from it (warm).
+
+Usage:
+    api_benchmark.py --url http://127.0.0.1:5000 --values data.csv
+                     [--clients 16] [--requests 2000] [--batch 0]
+
+    --values is a CSV in the same format the service accepts (a 'pid' or
+    'serial' header and one value per line). With --batch 0 every request
+    is a single GET; otherwise values are POSTed in batches of that size.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Development"
+
+
+""" Importing built-in modules """
+import argparse
+import csv
+import itertools
+import json
+import statistics
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description='Benchmark the EOX REST lookup API.')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='Base URL of the service')
+    parser.add_argument('--values', required=True, help='CSV of pids or serials with a header line')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent clients (default 16)')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per pass (default 2000)')
+    parser.add_argument('--batch', type=int, default=0, help='Values per POST, 0 for single GETs')
+    return parser.parse_args()
+
+
+def read_values(filename):
+    with open(filename, 'r', newline='') as f:
+        rows = [row[0].strip() for row in csv.reader(f) if row and row[0].strip()]
+    return rows[0].lower(), rows[1:]
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def send(url, body=None):
+    ''' Send one request, returning (seconds, ok) '''
+    data = None if body is None else json.dumps(body).encode('utf-8')
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=120) as resp:
+            resp.read()
+        ok = True
+    except urllib.error.HTTPError as err:
+        # 404 is a valid answer for an unknown pid
+        ok = err.code == 404
+    except OSError:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def run_pass(args, searchtype, values):
+    if args.batch:
+        batches = itertools.cycle([values[i:i + args.batch] for i in range(0, len(values), args.batch)])
+        work = [(args.url + '/api/eox/' + searchtype, {'values': next(batches)}) for _ in range(args.requests)]
+    else:
+        cycle = itertools.cycle(values)
+        work = [(args.url + '/api/eox/' + searchtype + '/' + urllib.parse.quote(next(cycle), safe=''), None)
+                for _ in range(args.requests)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        results = list(pool.map(lambda item: send(*item), work))
+    elapsed = time.perf_counter() - start
+
+    latencies = [seconds * 1000 for seconds, ok in results]
+    return {
+        'requests': len(results),
+        'errors': sum(1 for seconds, ok in results if not ok),
+        'throughput': len(results) / elapsed,
+        'mean': statistics.mean(latencies),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def report(name, stats):
+    print('{:<6} {requests:>8} {errors:>7} {throughput:>10.1f} {mean:>9.1f} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f}'
+          .format(name, **stats))
+
+
+def main():
+    args = process_args()
+    searchtype, values = read_values(args.values)
+    print('{} distinct {} values, {} clients, {} requests per pass, batch {}'.format(
+        len(set(values)), searchtype, args.clients, args.requests, args.batch or 'off'))
+    print('')
+    print('{:<6} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+        'pass', 'requests', 'errors', 'req/s', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms'))
+    report('cold', run_pass(args, searchtype, values))
+    report('warm', run_pass(args, searchtype, values))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+""" Summary: Offline load test of the EOX_Docker web service
+
+Description:
+    Runs the service code from ../src against a local stub of the Cisco
+    token and EOX endpoints, so nothing leaves the machine and no
+    credentials are needed. The stub's latency and error rate are
+    configurable.
+
+    Concurrent clients then drive each part of the service in turn:
+
+        lookup      GET  /api/eox/pid/<pid>
+        batch       POST /api/eox/pid with 20 pids
+        upload      POST /jobs with a generated inventory CSV
+        download    GET  /jobs/<id>/download, streamed until the job ends
+
+    For every phase it reports the throughput, p50/p95/p99 latency and
+    error count, and the peak resident memory of the process. The stub,
+    the service and the clients share one process, so the memory figure
+    is an upper bound for the service.
+
+Usage:
+    loadtest.py [--clients 16] [--requests 500] [--uploads 8] [--rows 2000]
+                [--distinct 300] [--api-latency 0.2] [--error-rate 0.01]
+                [--quota 100]
+
+Requirements:
+    flask (the service's own dependencies)
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Development"
+
+
+""" Importing built-in modules """
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+EOX_PATH = re.compile(r'^/supporttools/eox/rest/5/EOXBy(ProductID|SerialNumber)/(\d+)/([^?]+)')
+
+
+def process_args():
+    parser = argparse.ArgumentParser(description='Offline load test of the EOX_Docker web service.')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent clients (default 16)')
+    parser.add_argument('--requests', type=int, default=500, help='Lookup and batch requests per phase (default 500)')
+    parser.add_argument('--uploads', type=int, default=8, help='Inventories uploaded (default 8)')
+    parser.add_argument('--rows', type=int, default=2000, help='Rows per uploaded inventory (default 2000)')
+    parser.add_argument('--distinct', type=int, default=300, help='Distinct pids in the test data (default 300)')
+    parser.add_argument('--api-latency', type=float, default=0.2, help='Mean stub API latency in seconds (default 0.2)')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='Share of stub API calls that fail (default 0.01)')
+    parser.add_argument('--not-found-rate', type=float, default=0.05, help='Share of pids with no EOX record (default 0.05)')
+    parser.add_argument('--quota', type=float, default=100, help='API calls per second the service may make (default 100)')
+    parser.add_argument('--cache-ttl', type=int, default=86400, help='Shared cache TTL, 0 disables it (default 86400)')
+    return parser.parse_args()
+
+
+class StubCisco(BaseHTTPRequestHandler):
+    ''' Answers like cloudsso.cisco.com and the EOX API, with configurable latency and errors '''
+
+    latency = 0.2
+    error_rate = 0.01
+    not_found = set()
+    calls = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.startswith('/token'):
+            return self.reply(200, {'access_token': 'stub-token', 'token_type': 'Bearer', 'expires_in': 3599})
+        match = EOX_PATH.match(self.path)
+        if match is None:
+            return self.reply(404, {'error': 'unknown path'})
+
+        with StubCisco.lock:
+            StubCisco.calls += 1
+        time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.error_rate:
+            if random.random() < 0.5:
+                return self.reply(503, {'error': 'busy'}, {'Retry-After': '0'})
+            return self.reply(500, {'error': 'stub failure'})
+
+        values = urllib.parse.unquote(match.group(3)).split(',')
+        records = [self.record(value) for value in values]
+        self.reply(200, {'PaginationResponseRecord': {'PageIndex': 1, 'LastIndex': 1,
+                                                      'TotalRecords': len(records), 'PageRecords': len(records)},
+                         'EOXRecord': records})
+
+    def record(self, value):
+        if value in self.not_found:
+            return {'EOXInputValue': value, 'EOLProductID': '',
+                    'EOXError': {'ErrorID': 'SSA_ERR_026', 'ErrorDescription': 'EOX information does not exist'}}
+        date = {'value': '2025-01-31', 'dateFormat': 'YYYY-MM-DD'}
+        return {
+            'EOXInputValue': value, 'EOLProductID': value, 'ProductIDDescription': 'Stub product ' + value,
+            'EndOfSaleDate': date, 'EndOfSWMaintenanceReleases': date, 'EndOfSecurityVulSupportDate': date,
+            'EndOfRoutineFailureAnalysisDate': date, 'EndOfServiceContractRenewal': date,
+            'LastDateOfSupport': date, 'EndOfSvcAttachDate': date,
+            'EOXMigrationDetails': {'MigrationProductId': value + '-NEW'},
+        }
+
+
+def start_server(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_service(args, workdir, stub_url):
+    ''' Import the service from ../src, point it at the stub and serve it on a free port '''
+    os.environ['EOX_SRC'] = workdir
+    os.environ['EOX_PROCESSES'] = '1'
+    os.environ['EOX_CACHE_TTL'] = str(args.cache_ttl)
+    with open(os.path.join(workdir, 'package_config.ini'), 'w') as f:
+        f.write('[application]\nclient_id = loadtest\nclient_secret = loadtest\n\n'
+                '[limits]\nper_second = {}\nper_day = 1000000000\n'.format(args.quota))
+
+    sys.path.insert(0, os.path.abspath(SRC_DIR))
+    import eoxquery
+    import apitoken
+    import eoxservice
+    from werkzeug.serving import make_server
+
+    apitoken.TOKEN_URL = stub_url + '/token'
+    eoxquery.EOX_URL = stub_url + '/supporttools/eox/rest/5/'
+    eoxservice.token = apitoken.TokenProvider('loadtest', 'loadtest', cachefile=os.path.join(workdir, 'token.json'))
+    return start_server(make_server('127.0.0.1', 0, eoxservice.app, threaded=True))
+
+
+def timed(func):
+    ''' Run func, returning (seconds, ok) '''
+    start = time.perf_counter()
+    try:
+        func()
+        ok = True
+    except urllib.error.HTTPError as err:
+        # An unknown pid is a valid answer
+        ok = err.code == 404
+    except OSError:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=600) as resp:
+        return resp.read()
+
+
+def post_json(url, body):
+    req = urllib.request.Request(url, data=json.dumps(body).encode('utf-8'),
+                                 headers={'Content-Type': 'application/json', 'Accept': 'application/json'})
+    with urllib.request.urlopen(req, timeout=600) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+
+def post_file(url, filename, content):
+    boundary = uuid.uuid4().hex
+    body = ('--{0}\r\nContent-Disposition: form-data; name="file"; filename="{1}"\r\n'
+            'Content-Type: text/csv\r\n\r\n').format(boundary, filename).encode('utf-8')
+    body += content.encode('utf-8') + '\r\n--{}--\r\n'.format(boundary).encode('utf-8')
+    req = urllib.request.Request(url, data=body,
+                                 headers={'Content-Type': 'multipart/form-data; boundary=' + boundary})
+    with urllib.request.urlopen(req, timeout=600) as resp:
+        return json.loads(resp.read().decode('utf-8'))
+
+
+def stream(url):
+    ''' Read a streamed download to the end, returning (seconds to first byte, bytes) '''
+    start = time.perf_counter()
+    first = None
+    size = 0
+    with urllib.request.urlopen(url, timeout=600) as resp:
+        while True:
+            chunk = resp.read1(65536)
+            if not chunk:
+                break
+            if first is None:
+                first = time.perf_counter() - start
+            size += len(chunk)
+    return first or 0, size
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))] if samples else 0
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def run_phase(name, clients, work):
+    ''' Run the work items on concurrent clients, returning the phase's statistics '''
+    calls_before = StubCisco.calls
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(timed, work))
+    elapsed = time.perf_counter() - start
+    latencies = [seconds * 1000 for seconds, ok in results]
+    return {
+        'phase': name,
+        'requests': len(results),
+        'errors': sum(1 for seconds, ok in results if not ok),
+        'throughput': len(results) / elapsed if elapsed else 0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'api_calls': StubCisco.calls - calls_before,
+        'rss': max_rss_mb(),
+    }
+
+
+def report(stats):
+    print('{phase:<9} {requests:>8} {errors:>7} {throughput:>9.1f} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} '
+          '{api_calls:>9} {rss:>8.1f}'.format(**stats), file=sys.__stdout__, flush=True)
+
+
+def main():
+    args = process_args()
+    workdir = tempfile.mkdtemp(prefix='eox-loadtest-')
+    pids = ['STUB-{:05d}'.format(i) for i in range(args.distinct)]
+    StubCisco.latency = args.api_latency
+    StubCisco.error_rate = args.error_rate
+    StubCisco.not_found = set(random.sample(pids, int(len(pids) * args.not_found_rate)))
+
+    try:
+        stub = start_server(ThreadingHTTPServer(('127.0.0.1', 0), StubCisco))
+        stub_url = 'http://127.0.0.1:{}'.format(stub.server_port)
+        # The service prints every record it looks up; keep that out of the report
+        with contextlib.redirect_stdout(io.StringIO()) as log:
+            service = start_service(args, workdir, stub_url)
+            url = 'http://127.0.0.1:{}'.format(service.server_port)
+
+            print('Stub API latency {}s, error rate {}, quota {}/s, {} distinct pids, {} clients'.format(
+                args.api_latency, args.error_rate, args.quota, args.distinct, args.clients), file=sys.__stdout__)
+            print('', file=sys.__stdout__)
+            print('{:<9} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+                'phase', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'API calls', 'RSS MB'),
+                file=sys.__stdout__)
+
+            lookups = [lambda pid=random.choice(pids): get(url + '/api/eox/pid/' + pid)
+                       for _ in range(args.requests)]
+            report(run_phase('lookup', args.clients, lookups))
+
+            batches = [lambda values=random.sample(pids, min(20, len(pids))):
+                       post_json(url + '/api/eox/pid', {'values': values})
+                       for _ in range(args.requests)]
+            report(run_phase('batch', args.clients, batches))
+
+            jobs = []
+
+            def upload():
+                inventory = 'pid\n' + '\n'.join(random.choice(pids) for _ in range(args.rows)) + '\n'
+                jobs.append(post_file(url + '/jobs', 'inventory.csv', inventory)['id'])
+
+            report(run_phase('upload', args.clients, [upload] * args.uploads))
+
+            first_bytes = []
+
+            def download(job_id):
+                first, size = stream(url + '/jobs/' + job_id + '/download')
+                first_bytes.append(first * 1000)
+
+            report(run_phase('download', args.clients, [lambda job_id=job_id: download(job_id) for job_id in jobs]))
+            print('', file=sys.__stdout__)
+            print('Download time to first byte: p50 {:.1f} ms, p95 {:.1f} ms'.format(
+                percentile(first_bytes, 50), percentile(first_bytes, 95)), file=sys.__stdout__)
+            print('Service log lines suppressed: {}'.format(log.getvalue().count('\n')), file=sys.__stdout__)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,141 +14,134 @@ Description:
 """
 
 __author__ = "Brandon Rumer"
-__version__ = "2.0.0"
+__version__ = "2.1.0"
 __email__ = "brumer@cisco.com"
 __status__ = "Production"
 
 
 """ Importing built-in modules """
-import json
+import os
 import sys
 import csv
 import datetime
 import time
 import subprocess
-import glob
+import threading
 
 """ Import external modules """
-import requests
 import configparser
+from werkzeug.serving import make_server
 
 """ Import flask app """
 import singlefileupload
 
+""" Import local modules """
+# The API helpers shared by the tools live in the common folder of this repository,
+# two levels up. The image has them in /common, which /src/../.. also resolves to.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'common'))
+import apitoken
+import ratelimit
+import supportapi
+
+
+# Where the app lives. Set EOX_SRC to run outside the container.
+SRC = os.environ.get('EOX_SRC', '/src')
+
+# The load test points this at a stub of the API
+EOX_URL = supportapi.EOX_URL
+
+MAX_BATCH = supportapi.EOX_MAX_BATCH
+
+# Shared by every call so the API's per-second and per-day quotas are respected
+limiter = ratelimit.from_config(os.path.join(SRC, 'package_config.ini'))
+
+CSV_HEADER = ['Device', 'Product ID', 'Description', 'End of Sale',
+              'End of Software Maint', 'End of Security Vul Support', 'End of Routine Failure',
+              'End of Service Contract', 'Last Date of Support', 'End of Service Attach',
+              'Migratin PID']
+
 
 def get_csv(datafile):
+    '''
+    This function streams the input CSV rather than loading it into memory
 
-    devices = []
-    # print('Using' + datafile + ' as version input file.')
+    :param datafile: CSV with a 'serial' or 'pid' header and one value per line
+    :return: the search type, and a generator of the remaining values. Raises ValueError on a bad header.
+    '''
+    # print('Using ' + datafile + ' as version input file.')
     print('')
-    with open(datafile, 'r', newline='') as infile:
-        for row in csv.reader(infile):
+    infile = open(datafile, 'r', newline='')
+    rows = (row[0].strip() for row in csv.reader(infile)
             # Remove any blank lines
-            if any(entry.strip() for entry in row):
-                devices.append(row[0])
-    title = devices[0]
-    if title.lower() == 'serial':
-        searchtype = 'serial'
-    if title.lower() == 'pid':
-        searchtype = 'pid'
-    del devices[0]
-    return searchtype, devices
-
-
-def get_access_token(client_id, client_secret):
-    '''
-    This function will get the access token from Cisco to be used in further queries
+            if any(entry.strip() for entry in row))
+    title = next(rows, '')
+    if title.lower() not in ['serial', 'pid']:
+        infile.close()
+        # The service reports this on the job, the console prints it
+        raise ValueError("The first line of " + os.path.basename(datafile) + " must be either 'serial' or 'pid'.")
 
-    :param client_id: the client id that was created on the apiconsole.cisco.com
-    :param client_secret: the client secret that was created in apiconsole.cisco.com
+    def devices():
+        with infile:
+            yield from rows
 
-    :return: access token to be used in other queries
-    '''
+    return title.lower(), devices()
 
-    url = "https://cloudsso.cisco.com/as/token.oauth2?grant_type=client_credentials&client_id=" + \
-        client_id + \
-        "&client_secret=" + \
-        client_secret
 
-    headers = {
-        'accept': "application/json",
-        'content-type': "application/x-www-form-urlencoded",
-        'cache-control': "no-cache"
-        }
+def get_eox_details(token, inputvalue, searchtype, pageindex=1):
+    ''' One page of EOX records for up to MAX_BATCH comma separated values, see supportapi.get_eox_details '''
+    return supportapi.get_eox_details(limiter, token, inputvalue, searchtype, pageindex, EOX_URL)
 
-    response = requests.request("POST", url, headers=headers)
 
-    if (response.status_code == 200):
-        return response.json()['access_token']
-    else:
-        response.raise_for_status()
+def get_eox_batch(token, batch, searchtype):
+    ''' Every EOX record of a batch of values, see supportapi.get_eox_batch '''
+    return supportapi.get_eox_batch(limiter, token, batch, searchtype, EOX_URL)
 
 
-def get_eox_details(access_token, inputvalue, searchtype):
+def print_eox_details(data, export):
     '''
-    This function will get the EOX record for a particular search
+    This function will parse the desired value from a particular search
 
-    :param access_token: Access Token retrieved from cisco to query the searchtypes
-    :param inputvalue: The serial number of pid that is used to query
-    :param searchtype: The type of search type to perform.   Either pid or serial
-    :return: json format of the retrieved data
+    :param data: the json data returned from the get_eox_detailsget_eox_details function
+    :param export: the user's y/n input for exporting all the results to a csv
+    :return: list of desired values from the device
     '''
-    if searchtype in ["pid"]:
-        url = "https://api.cisco.com/supporttools/eox/rest/5/EOXByProductID/1/" + inputvalue + "?responseencoding=json"
-    elif searchtype in ["serial"]:
-        url = "https://api.cisco.com/supporttools/eox/rest/5/EOXBySerialNumber/1/" + inputvalue + "?responseencoding=json"
-    else:
-        return
-
-    headers = {
-        'authorization': "Bearer " + access_token,
-        'accept': "application/json",
-    }
-
-    response = requests.request("POST", url, headers=headers)
-
-    if (response.status_code == 200):
-        # Uncomment to debug
-        # sys.stderr.write(response.text)
-        # print (response.text)
-        return json.loads(response.text)
-    else:
-        response.raise_for_status()
-        return
+    try:
+        return print_eox_record(data['EOXRecord'][0], export)
+    except Exception:
+        return None
 
 
-def print_eox_details(data, export):
+def print_eox_record(record, export):
     '''
-    This function will parse the desired value from a particular search
+    This function will parse the desired value from a single EOX record
 
-    :param data: the json data returned from the get_eox_detailsget_eox_details function
+    :param record: one entry of the EOXRecord list returned by the API
     :param export: the user's y/n input for exporting all the results to a csv
     :return: list of desired values from the device
     '''
     try:
-        EOLProductID = data['EOXRecord'][0]['EOLProductID']
+        EOLProductID = record['EOLProductID']
         if EOLProductID == "":
+            status = 'Lookup Failed' if record.get('LookupFailed') else 'Not Found'
             print("No Records Found!")
             if export == 'y':
-                devicedata = [data['EOXRecord'][0]['EOXInputValue'], 'Not Found', 'Not Found', 'Not Found',
-                              'Not Found', 'Not Found', 'Not Found', 'Not Found', 'Not Found', 'Not Found',
-                              'Not Found']
+                devicedata = [record['EOXInputValue']] + [status] * 10
                 return devicedata
             else:
                 return None
         else:
-            EOXInputValue = data['EOXRecord'][0]['EOXInputValue']
-
-            ProductIDDescr = data['EOXRecord'][0]['ProductIDDescription']
-            EOSDate = data['EOXRecord'][0]['EndOfSaleDate']['value']
-
-            EOSWMDate = data['EOXRecord'][0]['EndOfSWMaintenanceReleases']['value']
-            EOSSVulDate = data['EOXRecord'][0]['EndOfSecurityVulSupportDate']['value']
-            EORoutineFailureDate = data['EOXRecord'][0]['EndOfRoutineFailureAnalysisDate']['value']
-            EOSCRDate = data['EOXRecord'][0]['EndOfServiceContractRenewal']['value']
-            LDOSDate = data['EOXRecord'][0]['LastDateOfSupport']['value']
-            EOSvcAttachDate = data['EOXRecord'][0]['EndOfSvcAttachDate']['value']
-            MigrationDetails = data['EOXRecord'][0]['EOXMigrationDetails']['MigrationProductId']
+            EOXInputValue = record['EOXInputValue']
+
+            ProductIDDescr = record['ProductIDDescription']
+            EOSDate = record['EndOfSaleDate']['value']
+
+            EOSWMDate = record['EndOfSWMaintenanceReleases']['value']
+            EOSSVulDate = record['EndOfSecurityVulSupportDate']['value']
+            EORoutineFailureDate = record['EndOfRoutineFailureAnalysisDate']['value']
+            EOSCRDate = record['EndOfServiceContractRenewal']['value']
+            LDOSDate = record['LastDateOfSupport']['value']
+            EOSvcAttachDate = record['EndOfSvcAttachDate']['value']
+            MigrationDetails = record['EOXMigrationDetails']['MigrationProductId']
             print("Search Value: " + EOXInputValue)
             print("Product ID: " + EOLProductID)
             print("Product Description: " + ProductIDDescr)
@@ -163,8 +156,8 @@ def print_eox_details(data, export):
             print('\n')
             if export == 'y':
                 devicedata = [EOXInputValue, EOLProductID, ProductIDDescr, EOSDate,
-                              EOSWMDate, EOSSVulDate, EORoutineFailureDate, EOSCRDate,
-                              LDOSDate, EOSvcAttachDate, MigrationDetails]
+                EOSWMDate, EOSSVulDate, EORoutineFailureDate, EOSCRDate, LDOSDate,
+                EOSvcAttachDate, MigrationDetails]
                 return devicedata
             else:
                 return None
@@ -173,28 +166,25 @@ def print_eox_details(data, export):
 
 
 def getClient():
-    # Open up the configuration file and get all application defaults
+    # Open up the configuration file and get all application defaults.
+    # Raises ValueError rather than exiting, as the service calls this from its worker threads.
     config = configparser.ConfigParser()
-    config.read('/src/package_config.ini')
+    config.read(os.path.join(SRC, 'package_config.ini'))
 
     try:
         client_id = config.get("application", "client_id")
         client_secret = config.get("application", "client_secret")
     except configparser.NoOptionError:
-        print("package_config.ini is not formatted approriately!")
-        exit()
+        raise ValueError("package_config.ini is not formatted approriately!")
     except configparser.NoSectionError:
-        print('package_config.ini error. Does the file exist in this directory?')
-        exit()
-    except:
-        print("Unexpected Error")
-        exit()
+        raise ValueError('package_config.ini error. Does the file exist in this directory?')
 
-    access_token = get_access_token(client_id, client_secret)
-    return access_token
+    # Cached on disk between runs, and refreshed in the background mid-run
+    token = apitoken.TokenProvider(client_id, client_secret)
+    return token.start()
 
 
-def getdata(searchtype, device, access_token):
+def getdata(searchtype, device, token):
     try:
         if searchtype is None:
             data = input("Enter search string (ex: 'serial {serialnumber}' or 'pid {pid}' or 'quit'): ")
@@ -204,21 +194,83 @@ def getdata(searchtype, device, access_token):
             searchtype = searchtype.lower()
             if searchtype not in ['serial', 'pid']:
                 print("Unknown search type: " + searchtype + ". Please try again")
-                getdata(searchtype, device, access_token)
+                getdata(searchtype, device, token)
         else:
             inputstring = device
 
         print("Performing " + searchtype + " search for: '" + inputstring.upper() + "':")
-        order_text = get_eox_details(access_token, str(inputstring.upper()), searchtype)
+        order_text = get_eox_details(token, str(inputstring.upper()), searchtype)
         # print_eox_details(order_text)
         return order_text
 
-    except Exception:
-        print('Unknown Error. Sleeping for 10 seconds. Hoping things clear up.')
-        time.sleep(10)
+    except Exception as e:
+        print('Lookup failed: ' + str(e))
         return None
 
 
+def getbatch(searchtype, batch, token):
+    try:
+        print("Performing " + searchtype + " search for: '" + ','.join(batch) + "':")
+        return list(get_eox_batch(token, batch, searchtype))
+
+    except Exception as e:
+        # The limiter already retried, so report the batch as failed rather than dropping it
+        print('Lookup failed: ' + str(e))
+        return [failed_record(device) for device in batch]
+
+
+def batch_records(searchtype, batch, token):
+    '''
+    This function looks up a batch and returns one EOX record per value, in order,
+    as looking up each value on its own would
+
+    :param searchtype: pid or serial
+    :param batch: list of at most MAX_BATCH values
+    :param token: apitoken.TokenProvider handing out the access token used to query
+    :return: list of EOX records. A value the API didn't answer gets an empty record (Not Found).
+    '''
+    records = supportapi.eox_records_by_value(getbatch(searchtype, batch, token), batch)
+    # A record answering several values lists them all in EOXInputValue, so each row gets its own value
+    return [dict(records.get(device, {'EOLProductID': ''}), EOXInputValue=device) for device in batch]
+
+
+def failed_record(device):
+    ''' Stand-in EOX record for a value whose lookup failed '''
+    return {'EOXInputValue': device, 'EOLProductID': '', 'LookupFailed': True}
+
+
+def process_csv(datafile, token, outfile=None, progress=None):
+    '''
+    This function looks up every serial/pid in a CSV, writing the rows out as
+    each batch finishes so partial results are available straight away
+
+    :param datafile: CSV with a 'serial' or 'pid' header and one value per line
+    :param token: apitoken.TokenProvider handing out the access token used to query
+    :param outfile: open text file the results are written to as CSV, or None
+    :param progress: optional callable given the running count of values looked up
+    :return: the number of values looked up
+    '''
+    export = 'n' if outfile is None else 'y'
+    if outfile is not None:
+        writer = csv.writer(outfile)
+        writer.writerow(CSV_HEADER)
+        outfile.flush()
+
+    done = 0
+    searchtype, devices = get_csv(datafile)
+    for batch in supportapi.batched(supportapi.dedupe(devices), MAX_BATCH):
+        for record in batch_records(searchtype, batch, token):
+            devicedata = print_eox_record(record, export)
+            if devicedata is not None:
+                writer.writerow(devicedata)
+        if outfile is not None:
+            outfile.flush()
+        done += len(batch)
+        if progress is not None:
+            progress(done)
+    return done
+
+
 def ManualOrCSV():
     print('\n')
     print('Would you like to use a:')
@@ -234,8 +286,11 @@ def main():
 
     device = None
     searchtype = None
-    devicetable = []
-    access_token = getClient()
+    try:
+        token = getClient()
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
     SourceList = ManualOrCSV()
 
     # Defining date & time
@@ -249,65 +304,44 @@ def main():
             print('Open a browser and point to "http://127.0.0.1:5000" and upload the csv.')
             print("You may have to allow this through your computer's firewall.")
             print('\n')
-            # Start the flask web app.
-            # singlefileupload.app.run(host = '0.0.0.0')
-            proc = subprocess.Popen(["python", "/src/singlefileupload.py"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            # Start the flask web app in this process. The upload handler hands us the
+            # saved file through a queue, so nothing is polled while we wait.
+            server = make_server('0.0.0.0', 5000, singlefileupload.app)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
             print('Waiting until a file is uploaded.')
             print('\n')
 
-            while True:
-                uploadfile = glob.glob("/src/uploads/*.*")
-                if len(uploadfile) == 0:
-                    continue
-                else:
-                    filename = uploadfile[0].rsplit("/", 1)  # change for Windows
-                    datafile = filename[1]
-                    datafile = '/src/uploads/' + datafile
-                    print(f'Detected {datafile}')
-                    time.sleep(2)
-                    print('Killing the file upload web app...')
-                    proc.terminate()  # kill the flask app
-                    proc.wait()
-                    print('\n')
-
-                    break
+            datafile = singlefileupload.uploaded.get()
+            print(f'Detected {datafile}')
+            time.sleep(2)
+            print('Stopping the file upload web app...')
+            server.shutdown()
+            # Release port 5000, so the download app started below can bind to it
+            server.server_close()
+            print('\n')
 
             export = input('Would you like to save the results in a CSV? (y/n) ')
             if export == 'y':
                 csvExport = '/src/export/outfile.csv'
                 # Specifying the CSV export filename
-                writer = csv.writer(open(csvExport, 'w', newline=''))
-                writer.writerow(['Device', 'Product ID', 'Description', 'End of Sale',
-                                 'End of Software Maint', 'End of Security Vul Support',
-                                 'End of Routine Failure', 'End of Service Contract',
-                                 'Last Date of Support', 'End of Service Attach', 'Migratin PID'])
+                with open(csvExport, mode='w', newline='') as f:
+                    try:
+                        process_csv(datafile, token, f)
+                    except KeyboardInterrupt:
+                        print('Keyboard Interrupt. Exiting...\n')
+                    except ValueError as e:
+                        print(e)
+                        sys.exit(1)
             else:
-                export == 'n'
-
-            searchtype, devices = get_csv(datafile)
-            for device in devices:
                 try:
-                    order_text = getdata(searchtype, device, access_token)
+                    process_csv(datafile, token)
                 except KeyboardInterrupt:
                     print('Keyboard Interrupt. Exiting...\n')
-                    break
-                finally:
-                    devicedata = print_eox_details(order_text, export)
-                    devicetable.append(devicedata)
+                except ValueError as e:
+                    print(e)
+                    sys.exit(1)
 
             if export == 'y':
-                with open(csvExport, mode='w', newline='') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(['Device', 'Product ID', 'Description', 'End of Sale',
-                                     'End of Software Maint', 'End of Security Vul Support',
-                                     'End of Routine Failure', 'End of Service Contract',
-                                     'Last Date of Support', 'End of Service Attach', 'Migratin PID'])
-                    for item in devicetable:
-                        if item is None:
-                            # Accounts for a 'No records found'
-                            pass
-                        else:
-                            writer.writerow(item)
                 # print('\n')
                 # print(f'CSV saved at: {csvExport}')
                 print('\n')
@@ -328,12 +362,12 @@ def main():
         if SourceList.lower() == '2':
             export = 'n'
             done = False
-            order_text = getdata(searchtype, device, access_token)
+            order_text = getdata(searchtype, device, token)
             print_eox_details(order_text, export)
             while not done:
                 again = input('Run again?  (y/n)   ').lower()
                 if again.lower() == 'y':
-                    order_text = getdata(searchtype, device, access_token)
+                    order_text = getdata(searchtype, device, token)
                     print_eox_details(order_text, export)
                 else:
                     print('\n')
@@ -0,0 +1,429 @@
+#!/usr/local/bin/python3
+""" Summary: Long-running EOX lookup web service
+
+Description:
+    Uploads become jobs that a background worker pool looks up while the web
+    app keeps serving. Every job writes its own output file, so several teams
+    can submit inventories at the same time. The access token and the API
+    rate limiter stay warm between jobs.
+
+    Browse to http://127.0.0.1:5000 to upload a CSV, or use the API:
+
+        POST /jobs                  multipart form with a 'file' field
+        GET  /jobs                  every job and its progress
+        GET  /jobs/<id>             progress of one job
+        GET  /jobs/<id>/download    the results, streamed while the job runs
+
+        GET  /api/eox/<pid|serial>/<value>    EOX record of one pid or serial
+        POST /api/eox/<pid|serial>            {"values": [...]}, returns
+                                              {"results": {value: record}}
+
+    Downloads start straight away and rows are sent with chunked transfer
+    as soon as they are looked up. They are gzip compressed on the fly when
+    the client accepts it. Neither side ever holds the whole file in memory.
+    If the job fails part way, the connection is dropped without the final
+    chunk, so the client sees an incomplete transfer rather than a short file.
+
+    The single lookup answers 404 when Cisco has no EOX record for the value.
+    That answer is cached for EOX_NOT_FOUND_TTL seconds, shorter than records. A job whose worker process died is failed
+    once it has not been heard from for STALE_AFTER seconds.
+
+    The number of concurrent jobs can be set with the EOX_WORKERS
+    environment variable (default 4). A finished job, its upload and its
+    results are removed EOX_JOB_TTL seconds after it ended (default a day).
+
+    In the container the app is served by gunicorn with EOX_PROCESSES worker
+    processes. Lookup results and job state are kept in eoxstore, which every
+    process shares, and the API quota is split between the processes.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Production"
+
+
+""" Importing built-in modules """
+import os
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+""" Import external modules """
+from flask import Flask, Response, flash, request, redirect, render_template, jsonify, url_for
+from werkzeug.utils import secure_filename
+
+""" Import local modules """
+import eoxquery
+import eoxstore
+import ratelimit
+import supportapi
+
+
+UPLOAD_FOLDER = os.path.join(eoxquery.SRC, 'uploads')
+EXPORT_FOLDER = os.path.join(eoxquery.SRC, 'export')
+ALLOWED_EXTENSIONS = set(['txt', 'csv'])
+WORKERS = int(os.environ.get('EOX_WORKERS', 4))
+PROCESSES = int(os.environ.get('EOX_PROCESSES', 1))
+JOB_TTL = int(os.environ.get('EOX_JOB_TTL', 86400))
+# Seconds between two clean ups of expired jobs. Running jobs are touched as often.
+HOUSEKEEPING = 60
+# A running job not touched for this long belongs to a process that is gone
+STALE_AFTER = 300
+CHUNK_SIZE = 64 * 1024
+MAX_API_VALUES = 1000
+
+app = Flask(__name__)
+app.secret_key = "secret key"
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+
+for folder in (UPLOAD_FOLDER, EXPORT_FOLDER):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+# Jobs started by this process. Jobs of other processes are read from the store.
+jobs = {}
+jobs_lock = threading.Lock()
+pool = ThreadPoolExecutor(max_workers=WORKERS)
+store = eoxstore.Store()
+token = None
+token_lock = threading.Lock()
+
+# Every process gets its share of the API quota
+eoxquery.limiter = ratelimit.RateLimiter(eoxquery.limiter.second.rate / PROCESSES,
+                                         eoxquery.limiter.day.capacity / PROCESSES)
+
+
+class Job:
+    ''' One uploaded inventory and the progress of its lookup '''
+
+    def __init__(self, filename):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.datafile = os.path.join(UPLOAD_FOLDER, self.id + '.csv')
+        self.outfile = os.path.join(EXPORT_FOLDER, self.id + '.csv')
+        self.status = 'queued'
+        self.total = None
+        self.done = 0
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        # Heartbeat of the process running the job
+        self.updated = self.created
+        self.local = True
+        # Notified whenever rows are written or the job ends
+        self.changed = threading.Condition()
+
+    @classmethod
+    def load(cls, job_id):
+        ''' Rebuild a job another process is running from the store '''
+        fields = store.load_job(job_id)
+        if fields is None:
+            return None
+        job = cls(fields['filename'])
+        job.__dict__.update(fields)
+        job.datafile = os.path.join(UPLOAD_FOLDER, job.id + '.csv')
+        job.outfile = os.path.join(EXPORT_FOLDER, job.id + '.csv')
+        job.local = False
+        job.check_stale()
+        return job
+
+    def update(self, **kwargs):
+        with self.changed:
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+            self.updated = time.time()
+            store.save_job(self)
+            self.changed.notify_all()
+
+    def refresh(self):
+        ''' Re-read the state of a job that runs in another process '''
+        if not self.local:
+            self.__dict__.update(store.load_job(self.id) or {})
+            self.check_stale()
+
+    def check_stale(self):
+        ''' Fail a job of another process that has stopped sending its heartbeat '''
+        if self.running() and (self.updated or self.created) < time.time() - STALE_AFTER:
+            self.update(status='failed', error='The worker process running this job stopped',
+                        finished=time.time())
+
+    def running(self):
+        return self.status in ('queued', 'running')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'status': self.status,
+            'total': self.total,
+            'done': self.done,
+            'error': self.error,
+            'status_url': url_for('job_status', job_id=self.id),
+            'download_url': url_for('job_download', job_id=self.id),
+        }
+
+
+def count_rows(datafile):
+    ''' Number of non-blank lines after the header, for progress reporting '''
+    with open(datafile, 'r', newline='') as f:
+        return max(0, sum(1 for line in f if line.strip()) - 1)
+
+
+def get_token():
+    ''' The token provider is created on first use, once per process '''
+    global token
+    with token_lock:
+        if token is None:
+            token = eoxquery.getClient()
+        return token
+
+
+def run_job(job):
+    job.update(status='running')
+    try:
+        job.total = count_rows(job.datafile)
+        with open(job.outfile, mode='w', newline='') as f:
+            job.update()
+            eoxquery.process_csv(job.datafile, get_token(), f, progress=lambda done: job.update(done=done))
+        job.update(status='done', finished=time.time())
+    except Exception as e:
+        job.update(status='failed', error=str(e) or type(e).__name__, finished=time.time())
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def housekeeping():
+    '''
+    Touch the jobs this process is running, so other processes know it is alive.
+    Forget jobs that ended more than JOB_TTL ago, with their files, so the service doesn't grow.
+    '''
+    while True:
+        time.sleep(HOUSEKEEPING)
+        try:
+            with jobs_lock:
+                running = [job for job in jobs.values() if job.running()]
+            for job in running:
+                job.update()
+            cutoff = time.time() - JOB_TTL
+            for job_id in store.expire(cutoff):
+                remove_file(os.path.join(UPLOAD_FOLDER, job_id + '.csv'))
+                remove_file(os.path.join(EXPORT_FOLDER, job_id + '.csv'))
+            # Whichever process expired them in the store, every process frees its own copies
+            with jobs_lock:
+                for job_id, job in list(jobs.items()):
+                    if job.finished is not None and job.finished < cutoff:
+                        del jobs[job_id]
+        except Exception as e:
+            print('Housekeeping failed: ' + str(e))
+
+
+threading.Thread(target=housekeeping, daemon=True).start()
+
+
+class JobFailed(Exception):
+    pass
+
+
+def follow(job):
+    '''
+    Yield the job's output file as it grows, until the job has finished.
+    Raises JobFailed if the job fails, so the server drops the connection
+    instead of ending the chunked response as if the file were complete.
+    '''
+    with job.changed:
+        while job.running() and not os.path.exists(job.outfile):
+            job.changed.wait(timeout=1)
+            job.refresh()
+    if job.status == 'failed':
+        raise JobFailed('Job {} failed: {}'.format(job.id, job.error))
+    if not os.path.exists(job.outfile):
+        return
+    with open(job.outfile, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if chunk:
+                yield chunk
+                continue
+            with job.changed:
+                if not job.running():
+                    # Pick up whatever was written just before the job ended
+                    rest = f.read()
+                    if rest:
+                        yield rest
+                    if job.status == 'failed':
+                        raise JobFailed('Job {} failed: {}'.format(job.id, job.error))
+                    return
+                # Jobs of other processes are never notified here, so check back every second
+                job.changed.wait(timeout=5 if job.local else 1)
+                job.refresh()
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        # Sync flush so the client can decompress each chunk as it arrives
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def submit(file):
+    ''' Save an uploaded file and queue a job for it '''
+    job = Job(secure_filename(file.filename))
+    file.save(job.datafile)
+    with jobs_lock:
+        jobs[job.id] = job
+    store.save_job(job)
+    pool.submit(run_job, job)
+    return job
+
+
+def get_job(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    return job if job is not None else Job.load(job_id)
+
+
+def has_record(record):
+    ''' False for the answer to a value Cisco has no EOX record for '''
+    return not record.get('EOXError') and bool(record.get('EOLProductID'))
+
+
+def lookup(searchtype, values):
+    '''
+    Look up EOX records, answering from the shared cache where possible
+
+    :param searchtype: pid or serial
+    :param values: list of pids or serials
+    :return: dict of value to EOX record. Values Cisco has no record for are left out.
+    '''
+    values = list(dict.fromkeys(value.strip().upper() for value in values if value.strip()))
+    results = store.get_records(searchtype, values)
+    missing = [value for value in values if value not in results]
+    for batch in supportapi.batched(missing, eoxquery.MAX_BATCH):
+        answered = supportapi.eox_records_by_value(eoxquery.get_eox_batch(get_token(), batch, searchtype), batch)
+        fetched = {value: record for value, record in answered.items() if has_record(record)}
+        # Kept for a shorter time, so repeated lookups of unknown values don't all reach the API
+        not_found = {value: answered.get(value, {'EOXInputValue': value, 'EOLProductID': ''})
+                     for value in batch if value not in fetched}
+        store.put_records(searchtype, fetched)
+        store.put_records(searchtype, not_found, ttl=store.not_found_ttl)
+        results.update(fetched)
+        results.update(not_found)
+    return {value: record for value, record in results.items() if has_record(record)}
+
+
+def wants_json():
+    return request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'application/json'
+
+
+@app.route('/')
+def upload_form():
+    return render_template('upload.html')
+
+
+@app.route('/', methods=['POST'])
+def upload_file():
+    # check if the post request has the file part
+    if 'file' not in request.files:
+        flash('No file part')
+        return redirect(request.url)
+    file = request.files['file']
+    if file.filename == '':
+        flash('No file selected for uploading')
+        return redirect(request.url)
+    if not allowed_file(file.filename):
+        flash('Allowed file types are txt, csv')
+        return redirect(request.url)
+    job = submit(file)
+    return redirect(url_for('job_status', job_id=job.id))
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    file = request.files.get('file')
+    if file is None or file.filename == '' or not allowed_file(file.filename):
+        return jsonify({'error': 'Upload a txt or csv file in the "file" field'}), 400
+    job = submit(file)
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/jobs')
+def list_jobs():
+    return jsonify([job.to_dict() for job in map(get_job, store.job_ids()) if job is not None])
+
+
+@app.route('/api/eox/<searchtype>/<path:value>')
+def api_lookup(searchtype, value):
+    if searchtype not in ['pid', 'serial']:
+        return jsonify({'error': 'Search type must be pid or serial'}), 404
+    try:
+        record = lookup(searchtype, [value]).get(value.strip().upper())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 502
+    if record is None:
+        return jsonify({'error': 'No record found'}), 404
+    return jsonify(record)
+
+
+@app.route('/api/eox/<searchtype>', methods=['POST'])
+def api_lookup_batch(searchtype):
+    if searchtype not in ['pid', 'serial']:
+        return jsonify({'error': 'Search type must be pid or serial'}), 404
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({'error': 'Send {"values": [...]} with a list of strings'}), 400
+    values = body.get('values')
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        return jsonify({'error': 'Send {"values": [...]} with a list of strings'}), 400
+    if len(values) > MAX_API_VALUES:
+        return jsonify({'error': 'At most {} values per request'.format(MAX_API_VALUES)}), 413
+    try:
+        return jsonify({'results': lookup(searchtype, values)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 502
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if wants_json():
+        return jsonify(job.to_dict())
+    return render_template('job.html', job=job)
+
+
+@app.route('/jobs/<job_id>/download')
+def job_download(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.status == 'failed':
+        return jsonify(job.to_dict()), 409
+    name = os.path.splitext(job.filename)[0] + '-eox.csv'
+    # The body depends on Accept-Encoding, so caches must not hand a gzipped copy to other clients
+    headers = {'Content-Disposition': 'attachment; filename="{}"'.format(name), 'Vary': 'Accept-Encoding'}
+    chunks = follow(job)
+    # The quality is 0 when gzip isn't accepted, including gzip;q=0
+    if request.accept_encodings['gzip'] > 0 or request.args.get('gzip') == '1':
+        chunks = gzipped(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks, mimetype='text/csv', headers=headers, direct_passthrough=True)
+
+
+if __name__ == "__main__":
+    # Fetch the token once up front; it is refreshed in the background from then on
+    get_token().get()
+    app.run(host='0.0.0.0', threaded=True)
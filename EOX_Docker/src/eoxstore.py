@@ -0,0 +1,141 @@
+#!/usr/local/bin/python3
+""" Summary: State shared by every worker process of the EOX web service
+
+Description:
+    The service runs as several worker processes, so anything that has to
+    be seen by all of them lives in one SQLite database (in WAL mode, so
+    readers never block the writer):
+
+        - a cache of EOX records keyed by search type and serial/pid, so a
+          value looked up by any worker is answered from the cache by all
+          of them until the TTL runs out. Values Cisco has no record for
+          are cached too, for the shorter NOT_FOUND_TTL, so repeated
+          lookups of unknown pids don't all go to the API
+        - the state of every upload job, so any worker can report progress
+          and stream the results of a job another worker is running
+
+    Stale cache entries and finished jobs are removed by expire(), so the
+    database doesn't grow while the service runs.
+
+    The database location and cache TTLs can be set with the EOX_STORE,
+    EOX_CACHE_TTL and EOX_NOT_FOUND_TTL (seconds) environment variables.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Production"
+
+
+""" Importing built-in modules """
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+STORE_FILE = os.environ.get('EOX_STORE', os.path.join(os.environ.get('EOX_SRC', '/src'), 'cache', 'eox_store.db'))
+
+# EOX dates rarely change, a day old answer is good enough
+CACHE_TTL = int(os.environ.get('EOX_CACHE_TTL', 86400))
+
+# Cisco may add a record for an unknown pid or serial at any time, so that answer is kept for less
+NOT_FOUND_TTL = int(os.environ.get('EOX_NOT_FOUND_TTL', 3600))
+
+JOB_FIELDS = ['id', 'filename', 'status', 'total', 'done', 'error', 'created', 'finished', 'updated']
+
+
+class Store:
+    '''
+    :param dbfile: SQLite database shared by the worker processes
+    :param ttl: seconds a cached EOX record is served for
+    :param not_found_ttl: seconds a 'no record' answer is served for, never more than ttl
+    '''
+
+    def __init__(self, dbfile=STORE_FILE, ttl=CACHE_TTL, not_found_ttl=NOT_FOUND_TTL):
+        self.dbfile = dbfile
+        self.ttl = ttl
+        self.not_found_ttl = min(not_found_ttl, ttl)
+        self._local = threading.local()
+        folder = os.path.dirname(dbfile)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        db = self.db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS eox '
+                   '(searchtype TEXT, value TEXT, record TEXT, fetched REAL, expires REAL, '
+                   'PRIMARY KEY (searchtype, value))')
+        db.execute('CREATE TABLE IF NOT EXISTS jobs '
+                   '(id TEXT PRIMARY KEY, filename TEXT, status TEXT, total INTEGER, done INTEGER, '
+                   'error TEXT, created REAL, finished REAL, updated REAL)')
+        # Stores created before jobs had a heartbeat, and before records had their own expiry
+        for table, column in (('jobs', 'updated'), ('eox', 'expires')):
+            try:
+                db.execute('ALTER TABLE {} ADD COLUMN {} REAL'.format(table, column))
+            except sqlite3.OperationalError:
+                pass
+        db.commit()
+
+    def db(self):
+        ''' One connection per thread, as SQLite connections can't be shared between threads '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.dbfile, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get_records(self, searchtype, values):
+        ''' Return a dict of value to cached EOX record, for the values that are cached and fresh '''
+        found = {}
+        now = time.time()
+        db = self.db()
+        for value in values:
+            # Rows cached before there was an expiry column expire after the TTL
+            row = db.execute('SELECT record FROM eox WHERE searchtype = ? AND value = ? '
+                             'AND COALESCE(expires, fetched + ?) > ?',
+                             (searchtype, value, self.ttl, now)).fetchone()
+            if row:
+                found[value] = json.loads(row[0])
+        return found
+
+    def put_records(self, searchtype, records, ttl=None):
+        '''
+        Cache records, given as a dict of value to EOX record
+        :param ttl: seconds they are served for, default the store's ttl
+        '''
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        db = self.db()
+        db.executemany('INSERT OR REPLACE INTO eox (searchtype, value, record, fetched, expires) VALUES (?, ?, ?, ?, ?)',
+                       [(searchtype, value, json.dumps(record), now, expires) for value, record in records.items()])
+        db.commit()
+
+    def save_job(self, job):
+        db = self.db()
+        db.execute('INSERT OR REPLACE INTO jobs ({}) VALUES ({})'.format(', '.join(JOB_FIELDS),
+                                                                         ', '.join('?' * len(JOB_FIELDS))),
+                   [getattr(job, field) for field in JOB_FIELDS])
+        db.commit()
+
+    def load_job(self, job_id):
+        ''' Return the saved fields of a job as a dict, or None '''
+        row = self.db().execute('SELECT {} FROM jobs WHERE id = ?'.format(', '.join(JOB_FIELDS)),
+                                (job_id,)).fetchone()
+        return dict(zip(JOB_FIELDS, row)) if row else None
+
+    def job_ids(self):
+        return [row[0] for row in self.db().execute('SELECT id FROM jobs ORDER BY created')]
+
+    def expire(self, finished_before):
+        '''
+        Drop cache entries past the TTL, and jobs that finished before the given time
+        :return: the ids of the jobs that were dropped
+        '''
+        db = self.db()
+        expired = [row[0] for row in db.execute('SELECT id FROM jobs WHERE finished < ?', (finished_before,))]
+        db.executemany('DELETE FROM jobs WHERE id = ?', [(job_id,) for job_id in expired])
+        db.execute('DELETE FROM eox WHERE COALESCE(expires, fetched + ?) < ?', (self.ttl, time.time()))
+        db.commit()
+        return expired
@@ -1,6 +1,7 @@
 #!/usr/local/bin/python3
 
 import os
+import queue
 from flask import Flask, flash, request, redirect, render_template
 from werkzeug.utils import secure_filename
 
@@ -13,7 +14,7 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 path = os.getcwd()
 # file Upload
 UPLOAD_FOLDER = os.path.join(path, 'uploads')
-UPLOAD_FOLDER = '/src/uploads'
+UPLOAD_FOLDER = os.path.join(os.environ.get('EOX_SRC', '/src'), 'uploads')
 
 if not os.path.isdir(UPLOAD_FOLDER):
     os.mkdir(UPLOAD_FOLDER)
@@ -22,6 +23,9 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 ALLOWED_EXTENSIONS = set(['txt', 'csv'])
 
+# Saved uploads are announced here, so eoxquery.py can wait without polling
+uploaded = queue.Queue()
+
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -46,6 +50,7 @@ def upload_file():
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
             file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            uploaded.put(os.path.join(app.config['UPLOAD_FOLDER'], filename))
             flash('File successfully uploaded')
             return redirect('/')
         else:
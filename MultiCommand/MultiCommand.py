@@ -10,6 +10,14 @@ Description:
     Multithreading is used so that multiple devices can be configured at
     the same time. The user is asked how many threads are to be used so
     the python-hosted computer or network isn't saturated.
+
+    The output of each device is streamed to its own file in
+    output-<date>/ as it is read (outputsink.py), optionally gzip
+    compressed. The results CSV lists the file of each device. The output
+    can go to the deduplicated store in outputstore/ instead, where each
+    distinct output is kept once and every run gets a manifest
+    (outputstore.py). Runs in the store can be compared with the previous
+    one to find what changed (drift.py).
 """
 
 __author__ = "Brandon Rumer"
@@ -43,6 +51,11 @@ from netmiko import (
     NetmikoAuthenticationException,
 )
 
+""" Import local modules """
+import drift
+import outputsink
+import outputstore
+
 
 def ConnectIPs(startipInt, endipInt):
     """ Collects the IPs in the range the user specified  """
@@ -60,10 +73,12 @@ def ConnectIPs(startipInt, endipInt):
         return IPs
 
 
-def ssh_exec_command(commands, host, user, pw, user_timeout, output_q):
-    """ SSH to the device, send commands, and capture the output """
-    output = ''
-    output_list = {}
+def ssh_exec_command(commands, host, user, pw, user_timeout, output_q, outputfolder, compress, manifest):
+    """ SSH to the device, send commands, and stream the output to the device's file, or to the store when
+    there is a manifest """
+    output_list = []
+    sink = None
+    command = ''
 
     cisco_device = {
         'device_type': 'cisco_ios',
@@ -94,29 +109,26 @@ def ssh_exec_command(commands, host, user, pw, user_timeout, output_q):
                     conn.enable()
                 '''
 
-                for command in commands:
-                    # send_command waits for the prompt vs send_command_timing is time-based
-                    # output = ssh.send_command(command)
-
-                    # Doing a lot of work here to detect a question, but not freeze up if there's not
-                    output = ssh.send_command(
-                        command,
-                        expect_string=r"([#\?$>])",
-                        delay_factor=10,
-                        max_loops=1000)
-
-                    if ('[' in output) and (']' in output) and ('?' in output):
-                        output += ssh.send_command(
-                            '\n',
-                            expect_string=r"([#\?$>])",
-                            delay_factor=10,
-                            max_loops=1000)
-
-                    output_list[command] = output
-                    print('On ', host, ', done with command: ', command)
+                # The output goes straight to the file as it arrives, so nothing big is kept in memory
+                if manifest is not None:
+                    for command in commands:
+                        sink = manifest.store.writer()
+                        outputsink.stream_command(ssh, command, sink)
+                        manifest.add(host, command, sink.close(), sink.size)
+                        sink = None
+                        print('On ', host, ', done with command: ', command)
+                    outputfile = manifest.path
+                else:
+                    sink = outputsink.OutputSink(outputfolder, host, compress)
+                    for command in commands:
+                        sink.section(command)
+                        outputsink.stream_command(ssh, command, sink)
+                        print('On ', host, ', done with command: ', command)
+                    outputfile = sink.close()
+                    sink = None
 
                 # Put gathered info into a row
-                output_list = [host, output]
+                output_list = [host, 'Done', outputfile]
                 print('Adding this to report:', output_list)
                 output_q.put([output_list])
 
@@ -128,15 +140,15 @@ def ssh_exec_command(commands, host, user, pw, user_timeout, output_q):
             pass
         except ConnectionRefusedError as err:
             print(f"Connection Refused: {err}")
-            output_list = [host, 'Connection Refused']
+            output_list = [host, 'Connection Refused', failed_output(sink, manifest, host, command, 'Connection Refused')]
             output_q.put([output_list])
         except TimeoutError as err:
             print(f"Connection Refused: {err}")
-            output_list = [host, 'SSH Timeout']
+            output_list = [host, 'SSH Timeout', failed_output(sink, manifest, host, command, 'SSH Timeout')]
             output_q.put([output_list])
         except Exception as err:
             print(f"Oops! {err}")
-            output_list = [host, 'Error']
+            output_list = [host, 'Error', failed_output(sink, manifest, host, command, 'Error')]
             output_q.put([output_list])
         except (NetmikoTimeoutException, NetmikoAuthenticationException) as error:
             print(f"{error} on {host}")
@@ -150,6 +162,19 @@ def ssh_exec_command(commands, host, user, pw, user_timeout, output_q):
         threadLimiter.release()
 
 
+def failed_output(sink, manifest, host, command, status):
+    """ Keep what a failed device sent, and return what goes in its output file column.
+    In the store the partial output is saved like any other, with the failure as the status of its row. """
+    if manifest is None:
+        return sink.abort() if sink else ''
+    if sink is not None:
+        manifest.add(host, command, sink.close(), sink.size, status)
+    else:
+        # Failed before or between commands, so the row is for the device
+        manifest.add(host, '', '', 0, status)
+    return manifest.path
+
+
 def check_pingv2(host):
     """ Checks to see if the IP address responds to a single ping.  """
     with open(os.devnull, 'w') as DEVNULL:
@@ -165,12 +190,14 @@ def check_pingv2(host):
     return pingstatus
 
 
-def WorkIt(commands, host, user, pw, user_timeout, output_q):
+def WorkIt(commands, host, user, pw, user_timeout, output_q, outputfolder, compress, manifest):
     """ Placeholder function, primarily needed for multithreading  """
     pingstatus = check_pingv2(host)
     if pingstatus is True:
-        ssh_exec_command(commands, host, user, pw, user_timeout, output_q)
+        ssh_exec_command(commands, host, user, pw, user_timeout, output_q, outputfolder, compress, manifest)
     elif pingstatus is False:
+        if manifest is not None:
+            manifest.add(host, '', '', 0, 'Not Pingable')
         threadLimiter.release()
 
 
@@ -397,12 +424,29 @@ if __name__ == "__main__":
     threads = MaxThreads()
     threadLimiter = threading.BoundedSemaphore(threads)
 
+    # Defining date & time
+    today_str = str(datetime.date.today())
+    timestamp = str(today_str + '-' + (time.strftime('%H%M%S')))
+
+    # Each device's output is streamed to its own file in this folder, or to the deduplicated store
+    outputfolder = 'output-{}'.format(timestamp)
+    compress = False
+    store = None
+    manifest = None
+    if input('Save the output to the deduplicated store instead of one file per device? (y/N): ').strip().lower() == 'y':
+        store = outputstore.OutputStore()
+        manifest = outputstore.Manifest(store, timestamp)
+    else:
+        os.makedirs(outputfolder, exist_ok=True)
+        compress = input('Compress the output files with gzip? (y/N): ').strip().lower() == 'y'
+
     # Do the work, while limiting the number of threads
     for host in IPs:
         host = host.replace(' ', '')
         try:
             threadLimiter.acquire()
-            my_thread = threading.Thread(target=WorkIt, args=(commands, host, user, pw, user_timeout, output_q))
+            my_thread = threading.Thread(target=WorkIt, args=(commands, host, user, pw, user_timeout, output_q,
+                                                              outputfolder, compress, manifest))
             my_thread.start()
         except KeyboardInterrupt:
             print('\n Fine. Exiting')
@@ -414,14 +458,10 @@ if __name__ == "__main__":
         if some_thread != main_thread:
             some_thread.join()
 
-    # Defining date & time
-    today_str = str(datetime.date.today())
-    timestamp = str(today_str + '-' + (time.strftime('%H%M%S')))
-
     # Specifying the CSV export filename
     csvExport = 'results-{}.csv'.format(timestamp)
     writer = csv.writer(open(csvExport, 'w', newline=''))
-    writer.writerow(['Host', 'Results'])
+    writer.writerow(['Host', 'Results', 'Output File'])
 
     # Get everything from the queue
     while not output_q.empty():
@@ -431,6 +471,19 @@ if __name__ == "__main__":
 
     print('\n' * 3)
     print('Results saved as:', csvExport)
+    if manifest is not None:
+        manifest.close()
+        print('Output saved in:', store.folder, '- manifest:', manifest.path)
+        print(store.report())
+        previous = drift.previous_manifest(manifest.path)
+        if previous and input('Compare with the previous run, {}? (y/N): '.format(previous)).strip().lower() == 'y':
+            drifted = drift.compare(previous, manifest.path, store.folder)
+            drift.print_summary(drifted)
+            driftExport = drift.report_name(previous, manifest.path)
+            drift.write_report(drifted, driftExport)
+            print('Changes saved as:', driftExport)
+    else:
+        print('Output saved in:', outputfolder)
     print('\n')
     print("        Hint: Don't see all the devices?")
     print("              Maybe the device failed the ping test.")
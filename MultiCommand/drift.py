@@ -0,0 +1,170 @@
+#!/usr/local/bin/python3
+""" Summary: Finds what changed between two runs saved in the output store
+
+Description:
+    Compares the manifests of two runs, device by device and command by
+    command. The manifest holds the hash of every output, so outputs
+    that didn't change are skipped without being read. Only the changed
+    ones are read and diffed, spread over all the cores.
+
+    Devices that didn't finish every command in either run are left out,
+    so a failed session isn't reported as drift.
+
+    The report lists the changed, new and gone outputs with the number
+    of lines added and removed, followed by the diffs. Lines that change
+    on every run, such as uptime, can be left out with --ignore.
+
+    Usage:
+        python drift.py outputstore/runs/<old>.csv outputstore/runs/<new>.csv
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Production"
+
+
+""" Importing built-in modules """
+import argparse
+import difflib
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+""" Import local modules """
+import outputstore
+
+
+# Diff lines shown per output, the rest is only counted
+MAX_DIFF_LINES = 200
+
+# Lines of context around each change
+CONTEXT = 2
+
+
+def diff_blobs(job):
+    '''
+    Diff two blobs. Runs in a worker process.
+    :param job: (store folder, host, command, old blob, new blob, ignore regex or None)
+    :return: (host, command, lines added, lines removed, diff lines)
+    '''
+    folder, host, command, old, new, ignore = job
+    store = outputstore.OutputStore(folder)
+    before = store.read(old).splitlines()
+    after = store.read(new).splitlines()
+    if ignore:
+        pattern = re.compile(ignore)
+        before = [line for line in before if not pattern.search(line)]
+        after = [line for line in after if not pattern.search(line)]
+    diff = list(difflib.unified_diff(before, after, 'before', 'after', n=CONTEXT, lineterm=''))
+    added = sum(1 for line in diff if line.startswith('+') and not line.startswith('+++'))
+    removed = sum(1 for line in diff if line.startswith('-') and not line.startswith('---'))
+    return host, command, added, removed, diff[2:]
+
+
+def compare(oldmanifest, newmanifest, folder=outputstore.STORE_FOLDER, ignore=None, workers=None):
+    '''
+    :param oldmanifest: manifest of the earlier run
+    :param newmanifest: manifest of the later run
+    :param ignore: regex of lines to leave out of the diffs
+    :param workers: processes for the diffs, default one per core
+    :return: dict with the counts, the changes as (host, command, change, added, removed, diff lines),
+             and the hosts skipped as incomplete
+    '''
+    skipped = outputstore.incomplete_hosts(oldmanifest) | outputstore.incomplete_hosts(newmanifest)
+    old = {key: blob for key, blob in outputstore.load_manifest(oldmanifest).items() if key[0] not in skipped}
+    new = {key: blob for key, blob in outputstore.load_manifest(newmanifest).items() if key[0] not in skipped}
+
+    # Same hash, same output. These are never read.
+    jobs = [(folder, host, command, old[(host, command)], blob, ignore)
+            for (host, command), blob in new.items()
+            if (host, command) in old and old[(host, command)] != blob]
+    changes = []
+    for host, command in sorted(new.keys() - old.keys()):
+        changes.append((host, command, 'new', 0, 0, []))
+    for host, command in sorted(old.keys() - new.keys()):
+        changes.append((host, command, 'gone', 0, 0, []))
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for host, command, added, removed, diff in pool.map(diff_blobs, jobs,
+                                                                chunksize=max(1, len(jobs) // (4 * (os.cpu_count() or 1)))):
+                # Changes only in ignored lines don't count
+                if added or removed:
+                    changes.append((host, command, 'changed', added, removed, diff))
+
+    changes.sort(key=lambda change: (change[0], change[1]))
+    return {
+        'compared': len(new.keys() & old.keys()),
+        'unchanged': len(new.keys() & old.keys()) - sum(1 for change in changes if change[2] == 'changed'),
+        'changes': changes,
+        'devices': len(set(change[0] for change in changes)),
+        'skipped': sorted(skipped),
+    }
+
+
+def write_report(result, filename):
+    ''' Summary table first, then the diffs '''
+    changes = result['changes']
+    width = max([len('Host')] + [len(change[0]) for change in changes])
+    with open(filename, 'w') as f:
+        f.write('{} outputs compared, {} unchanged. {} changes on {} devices.\n'.format(
+            result['compared'], result['unchanged'], len(changes), result['devices']))
+        if result['skipped']:
+            f.write('Skipped, incomplete in a run: {}\n'.format(', '.join(result['skipped'])))
+        f.write('\n')
+        for host, command, change, added, removed, diff in changes:
+            f.write('{}  {:7}  +{:<5} -{:<5}  {}\n'.format(host.ljust(width), change, added, removed, command))
+        for host, command, change, added, removed, diff in changes:
+            if not diff:
+                continue
+            f.write('\n{} {}\n'.format('=' * 20, host))
+            f.write('{}\n'.format(command))
+            for line in diff[:MAX_DIFF_LINES]:
+                f.write(line + '\n')
+            if len(diff) > MAX_DIFF_LINES:
+                f.write('... {} more lines\n'.format(len(diff) - MAX_DIFF_LINES))
+
+
+def print_summary(result):
+    print('{} outputs compared, {} unchanged. {} changes on {} devices.'.format(
+        result['compared'], result['unchanged'], len(result['changes']), result['devices']))
+    if result['skipped']:
+        print('Skipped, incomplete in a run:', ', '.join(result['skipped']))
+    for host, command, change, added, removed, diff in result['changes']:
+        print('   ', host, change, '+{} -{}'.format(added, removed), command)
+
+
+def report_name(oldmanifest, newmanifest):
+    return 'drift-{}-to-{}.txt'.format(os.path.splitext(os.path.basename(oldmanifest))[0],
+                                       os.path.splitext(os.path.basename(newmanifest))[0])
+
+
+def previous_manifest(manifest):
+    ''' The run before this one in the same store, or None '''
+    folder = os.path.dirname(manifest)
+    runs = sorted(name for name in os.listdir(folder) if name.endswith('.csv'))
+    earlier = [name for name in runs if name < os.path.basename(manifest)]
+    return os.path.join(folder, earlier[-1]) if earlier else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare two runs saved in the output store')
+    parser.add_argument('old', help='manifest of the earlier run')
+    parser.add_argument('new', help='manifest of the later run')
+    parser.add_argument('--store', default=outputstore.STORE_FOLDER, help='folder of the output store')
+    parser.add_argument('--ignore', help='regex of lines to leave out, e.g. "uptime is|Last configuration change"')
+    parser.add_argument('--workers', type=int, help='processes for the diffs (default: one per core)')
+    args = parser.parse_args()
+
+    for manifest in (args.old, args.new):
+        if not os.path.exists(manifest):
+            print('No such manifest:', manifest)
+            sys.exit(1)
+
+    result = compare(args.old, args.new, args.store, args.ignore, args.workers)
+    print_summary(result)
+    reportExport = report_name(args.old, args.new)
+    write_report(result, reportExport)
+    print('Report saved as:', reportExport)
@@ -0,0 +1,152 @@
+#!/usr/local/bin/python3
+""" Summary: Streams the output of each device to its own file
+
+Description:
+    Output is written to the file as it is read from the device, so a
+    'show tech' or a full configuration is never held in memory. The
+    memory used per session stays the same whatever the size of the
+    output. The files can be gzip compressed on the fly.
+
+    A file is written under a temporary name and only renamed to its
+    final name once the device is done. A file with the final name is
+    always complete. Should the session fail, the partial output is kept
+    under the temporary name.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Production"
+
+
+""" Importing built-in modules """
+import gzip
+import os
+import re
+import time
+
+
+# Lines longer than this are written in pieces
+MAX_LINE = 64 * 1024
+
+# Seconds a show command may go without any new output. A 'show tech' can be quiet for minutes.
+IDLE_TIMEOUT = 600
+
+# Seconds any other command may go without any new output
+COMMAND_IDLE_TIMEOUT = 60
+
+# How often the channel is read while a command runs
+POLL_SECONDS = 0.2
+
+
+class OutputSink:
+    '''
+    :param folder: folder the output files are written to
+    :param host: device, used as the file name
+    :param compress: gzip the file as it is written
+    '''
+
+    def __init__(self, folder, host, compress=False):
+        name = re.sub(r'[^\w.-]', '_', host) + ('.txt.gz' if compress else '.txt')
+        self.path = os.path.join(folder, name)
+        self.partial = self.path + '.part'
+        self.raw = open(self.partial, 'wb')
+        self.file = gzip.GzipFile(fileobj=self.raw, mode='wb') if compress else self.raw
+        self.size = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.file.write(data)
+        self.size += len(data)
+
+    def section(self, command):
+        ''' Start the output of a command '''
+        self.write('{}\n{}\n'.format('=' * 20, command))
+        self.write('{}\n'.format('=' * 20))
+
+    def close(self):
+        ''' Finish the file and give it its final name. Returns the final path. '''
+        if self.file is not self.raw:
+            self.file.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        os.replace(self.partial, self.path)
+        return self.path
+
+    def abort(self):
+        ''' Keep what was written under the temporary name. Returns that path. '''
+        if self.file is not self.raw:
+            self.file.close()
+        self.raw.close()
+        return self.partial
+
+
+def is_question(line):
+    ''' The device wants an answer, e.g. Destination filename [startup-config]? '''
+    return '[' in line and ']' in line and '?' in line
+
+
+def prompt_pattern(base_prompt):
+    ''' Matches the device prompt in any mode, e.g. Switch1#, Switch1> and Switch1(config-if)# '''
+    return re.compile(re.escape(base_prompt) + r'(\(.*\))?[#>]\s*$')
+
+
+def idle_timeout_for(command):
+    ''' Only show commands are given long to answer '''
+    words = command.lower().split()
+    # IOS takes any abbreviation down to 'sh'
+    if words and len(words[0]) > 1 and 'show'.startswith(words[0]):
+        return IDLE_TIMEOUT
+    return COMMAND_IDLE_TIMEOUT
+
+
+def stream_command(ssh, command, sink, idle_timeout=None):
+    '''
+    Send a command and write its output to the sink until the prompt is back
+
+    Only complete lines are written, so the echoed command and the closing
+    prompt can be left out. Questions are answered with enter, which
+    accepts the default.
+
+    :param ssh: netmiko connection. Its base_prompt is the hostname, e.g. Switch1
+    :param command: command to send
+    :param sink: OutputSink
+    :param idle_timeout: seconds without output before giving up, by default from idle_timeout_for()
+    '''
+    if idle_timeout is None:
+        idle_timeout = idle_timeout_for(command)
+    prompt = prompt_pattern(ssh.base_prompt)
+    ssh.write_channel(ssh.normalize_cmd(command))
+    line = ''
+    echoed = False
+    last_output = time.monotonic()
+
+    while True:
+        text = ssh.read_channel()
+        if not text:
+            if time.monotonic() - last_output > idle_timeout:
+                raise TimeoutError('No output from {} for {} seconds'.format(command, idle_timeout))
+            time.sleep(POLL_SECONDS)
+            continue
+        last_output = time.monotonic()
+
+        lines = (line + text).split('\n')
+        line = lines.pop()
+        for complete in lines:
+            if not echoed:
+                # The first line is the command echoed back
+                echoed = True
+                continue
+            sink.write(complete.rstrip('\r') + '\n')
+        if len(line) > MAX_LINE:
+            sink.write(line)
+            line = ''
+
+        lastline = line.strip()
+        if prompt.match(lastline):
+            return
+        if is_question(lastline):
+            print('Question detected on', ssh.base_prompt, ':', lastline)
+            print('Sending enter to accept the default value')
+            ssh.write_channel(ssh.RETURN)
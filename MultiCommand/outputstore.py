@@ -0,0 +1,201 @@
+#!/usr/local/bin/python3
+""" Summary: Deduplicated store for the output of commands
+
+Description:
+    Across a fleet much of the output is the same from one device to the
+    next: the 'show version' of a model, interface templates, ACLs. Each
+    distinct output is stored once, gzip compressed, under the SHA-256 of
+    its text:
+
+        outputstore/objects/ab/abcdef...gz
+
+    Each run writes a manifest, outputstore/runs/<date>.csv, with the
+    blob of every device and command. An output that is already in the
+    store costs no disk writes at all. Output is hashed as it streams in,
+    and only an output larger than SPILL_SIZE is spilled to a temporary
+    file before its hash is known.
+
+    Every row of the manifest has a status. When a device fails part way,
+    the output it sent is still stored, and the row of the command it
+    failed on gets the reason instead of Done. A device that failed before
+    any command ran gets a row with no command.
+
+    The store is shared by all runs, so weekly collections mostly add a
+    manifest and the few outputs that changed.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Production"
+
+
+""" Importing built-in modules """
+import csv
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+
+STORE_FOLDER = 'outputstore'
+
+# Output kept in memory until its hash is known. Larger output goes to a temporary file.
+SPILL_SIZE = 1024 * 1024
+
+MANIFEST_COLUMNS = ['Host', 'Command', 'Blob', 'Bytes', 'Status']
+
+DONE = 'Done'
+
+
+class BlobWriter:
+    ''' Hashes output as it is written, and adds it to the store when closed '''
+
+    def __init__(self, store):
+        self.store = store
+        self.hash = hashlib.sha256()
+        self.buffer = io.BytesIO()
+        self.spill = None
+        self.size = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.hash.update(data)
+        self.size += len(data)
+        if self.spill is None:
+            self.buffer.write(data)
+            if self.buffer.tell() > SPILL_SIZE:
+                self.spill = self.store.temporary()
+                self.spill.write(self.buffer.getvalue())
+                self.buffer = None
+        else:
+            self.spill.write(data)
+
+    def close(self):
+        ''' Returns the blob name, the SHA-256 of the output '''
+        digest = self.hash.hexdigest()
+        path = self.store.path(digest)
+        if os.path.exists(path):
+            self.abort()
+            self.store.count(self.size, new=False)
+            return digest
+        if self.spill is None:
+            self.spill = self.store.temporary()
+            self.spill.write(self.buffer.getvalue())
+            self.buffer = None
+        self.spill.close()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Two devices may write the same new blob at once. Either copy is fine.
+        os.replace(self.spill.name, path)
+        self.store.count(self.size, new=True)
+        return digest
+
+    def abort(self):
+        if self.spill is not None:
+            self.spill.close()
+            os.remove(self.spill.name)
+            self.spill = None
+        self.buffer = None
+
+
+class OutputStore:
+    '''
+    :param folder: root of the store
+    '''
+
+    def __init__(self, folder=STORE_FOLDER):
+        self.folder = folder
+        self.tmp = os.path.join(folder, 'tmp')
+        os.makedirs(self.tmp, exist_ok=True)
+        self.lock = threading.Lock()
+        self.outputs = 0
+        self.new_blobs = 0
+        self.new_bytes = 0
+        self.deduplicated_bytes = 0
+
+    def path(self, digest):
+        return os.path.join(self.folder, 'objects', digest[:2], digest + '.gz')
+
+    def temporary(self):
+        ''' A gzip file in the store's tmp folder, its path is .name '''
+        raw = tempfile.NamedTemporaryFile(dir=self.tmp, suffix='.gz', delete=False)
+        return GzipSpill(raw)
+
+    def writer(self):
+        return BlobWriter(self)
+
+    def count(self, size, new):
+        with self.lock:
+            self.outputs += 1
+            if new:
+                self.new_blobs += 1
+                self.new_bytes += size
+            else:
+                self.deduplicated_bytes += size
+
+    def read(self, digest):
+        ''' The text of a blob '''
+        with gzip.open(self.path(digest), 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def report(self):
+        return '{} outputs, {} new in the store ({:.1f} MB), {:.1f} MB already there'.format(
+            self.outputs, self.new_blobs, self.new_bytes / 1000000, self.deduplicated_bytes / 1000000)
+
+
+class GzipSpill:
+    ''' gzip stream over a named temporary file '''
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.name = raw.name
+        self.file = gzip.GzipFile(fileobj=raw, mode='wb', mtime=0)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        if not self.raw.closed:
+            self.file.close()
+            self.raw.close()
+
+
+class Manifest:
+    '''
+    Blob of every device and command of one run, written as it goes
+    :param store: OutputStore
+    :param run: name of the run, e.g. the timestamp
+    '''
+
+    def __init__(self, store, run):
+        self.store = store
+        folder = os.path.join(store.folder, 'runs')
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, '{}.csv'.format(run))
+        self.file = open(self.path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(MANIFEST_COLUMNS)
+        self.lock = threading.Lock()
+
+    def add(self, host, command, digest, size, status=DONE):
+        with self.lock:
+            self.writer.writerow([host, command, digest, size, status])
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load_manifest(path):
+    ''' Return a dict of (host, command) to blob '''
+    with open(path, 'r', newline='') as f:
+        return {(row['Host'], row['Command']): row['Blob'] for row in csv.DictReader(f)}
+
+
+def incomplete_hosts(path):
+    ''' Return the set of hosts that didn't finish every command in a run '''
+    with open(path, 'r', newline='') as f:
+        # Manifests written before there was a status only list finished commands
+        return {row['Host'] for row in csv.DictReader(f) if (row.get('Status') or DONE) != DONE}
@@ -16,70 +16,75 @@ __status__ = "Production"
 
 """ Importing built-in modules"""
 import json
+import os
 import sys
 import csv
 import datetime
 import time
+import concurrent.futures
 
 """ Import external modules """
-import requests
 import configparser
 
+""" Import local modules """
+# The API helpers shared by the tools live in the common folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import apitoken
+import ratelimit
+import supportapi
+import suggestcache
 
-def get_csv(datafile):
-    devices = []
-    print('Using' + datafile + ' as version input file.')
-    print('')
-    with open(datafile, 'r', newline='') as infile:
-        for row in csv.reader(infile):
-            # Remove any blank lines
-            if any(entry.strip() for entry in row):
-                devices.append(row[0])
-    return devices
 
+# The Software Suggestion API accepts up to 10 comma separated pids per request
+MAX_BATCH = 10
 
-def get_access_token(client_id, client_secret):
-    '''
-    This function will get the access token from Cisco to be used in further queries
-    :param client_id: the client id that was created on the apiconsole.cisco.com
-    :param client_secret: the client secret that was created in apiconsole.cisco.com
-    :return: access token to be used in other queries
-    '''
+# Result pages of one batch fetched at the same time
+PAGE_WORKERS = 4
 
-    url = "https://cloudsso.cisco.com/as/token.oauth2?grant_type=client_credentials&client_id=" + \
-        client_id + \
-        "&client_secret=" + \
-        client_secret
+# Shared by every call so the API's per-second and per-day quotas are respected
+limiter = ratelimit.from_config()
 
-    headers = {
-        'accept': "application/json",
-        'content-type': "application/x-www-form-urlencoded",
-        'cache-control': "no-cache"
-    }
+# Suggestions are kept between runs, keyed by base pid
+cache = suggestcache.from_config()
 
-    response = requests.request("POST", url, headers=headers)
+CSV_HEADER = ['Product ID', 'Description', 'Software Type',
+              'Recommended Software Version', 'Software Release Date',
+              'Software Release Cycle', 'Universal Image Filename',
+              'Image Size', 'Required DRAM Size', 'Required Flash Size']
 
-    if (response.status_code == 200):
-        return response.json()['access_token']
-    else:
-        response.raise_for_status()
+
+def get_csv(datafile):
+    '''
+    This function streams the input CSV rather than loading it into memory
+    :param datafile: CSV with one pid per line
+    :return: generator of pids
+    '''
+    print('Using ' + datafile + ' as version input file.')
+    print('')
+    with open(datafile, 'r', newline='') as infile:
+        for row in csv.reader(infile):
+            # Remove any blank lines, and the optional 'pid' header
+            if any(entry.strip() for entry in row) and row[0].strip().lower() != 'pid':
+                yield row[0].strip()
 
 
-def get_softver_details(access_token, device):
+def get_softver_details(token, device, pageindex=1):
     '''
     This function will get the Recommended Software record for a particular search
-    :param access_token: Access Token retrieved from cisco to query
+    :param token: apitoken.TokenProvider handing out the access token used to query
+    :param device: the pid to look for. Up to MAX_BATCH pids may be comma separated.
+    :param pageindex: the page of results to return
     :return: json format of the retrieved data
     '''
 
-    url = f"https://api.cisco.com/software/suggestion/v2/suggestions/software/productIds/{device}?pageIndex=1"
+    url = f"https://api.cisco.com/software/suggestion/v2/suggestions/software/productIds/{device}?pageIndex={pageindex}"
 
     headers = {
-        'authorization': "Bearer " + access_token,
         'accept': "application/json",
     }
 
-    response = requests.request("GET", url, headers=headers)
+    # Throttled to the API quota, with retries on 429/503 and transient errors
+    response = ratelimit.request(limiter, "GET", url, token=token, headers=headers, timeout=60)
 
     if (response.status_code == 200):
         # Uncomment to debug
@@ -90,13 +95,70 @@ def get_softver_details(access_token, device):
         # Uncomment to debug
         # sys.stderr.write(response.text)
         # print (response.text)
-        response.text = ''
-        return json.loads(response.text)
+        # An empty product is reported as 'Not Found'
+        return {'productList': [{'product': ''}]}
     else:
         response.raise_for_status()
         return
 
 
+def software_key(item):
+    ''' The (basePID, softwareType) an item of the productList answers for '''
+    product = item.get('product') or {}
+    return product.get('basePID', '').upper(), product.get('softwareType', '')
+
+
+def get_softver_batch(token, batch):
+    '''
+    This function will get the Recommended Software records for a batch of pids
+    with as few requests as possible. Every page after the first is fetched
+    concurrently. A pid may be answered once per software type (IOS XE and
+    ROMMON, for example). As with a single lookup, the first answer on the
+    first page is used, and only its suggestions from later pages are merged.
+    :param token: apitoken.TokenProvider handing out the access token used to query
+    :param batch: list of at most MAX_BATCH pids
+    :return: dict of pid to data in the format get_softver_details returns for one pid
+    '''
+    productids = ','.join(batch)
+    pages = [get_softver_details(token, productids)]
+    lastindex = int(pages[0].get('paginationResponseRecord', {}).get('lastIndex', 1))
+    if lastindex > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(PAGE_WORKERS, lastindex - 1)) as pool:
+            pages += pool.map(lambda pageindex: get_softver_details(token, productids, pageindex),
+                              range(2, lastindex + 1))
+
+    results = {}
+    unmatched = []
+    for page in pages:
+        for item in page.get('productList', []):
+            product = item.get('product') or {}
+            pid = product.get('basePID', '').upper()
+            if pid == '':
+                continue
+            if pid not in batch:
+                # A variant answered under a different base pid. Matched up below.
+                unmatched.append(item)
+                continue
+            if pid not in results:
+                results[pid] = {'productList': [dict(item, suggestions=list(item.get('suggestions', [])))]}
+            elif software_key(item) == software_key(results[pid]['productList'][0]):
+                # The same answer, continued on a later page
+                results[pid]['productList'][0]['suggestions'] += item.get('suggestions', [])
+
+    missing = [device for device in batch if device not in results]
+    if len(missing) == 1 and unmatched:
+        suggestions = [s for item in unmatched if software_key(item) == software_key(unmatched[0])
+                       for s in item.get('suggestions', [])]
+        results[missing[0]] = {'productList': [dict(unmatched[0], suggestions=suggestions)]}
+    elif len(batch) > 1:
+        # Can't tell which pid these belong to, so ask for each of them on its own
+        for device in missing:
+            results[device] = get_softver_batch(token, [device]).get(device)
+    elif missing:
+        results[missing[0]] = {'productList': [{'product': ''}]}
+    return results
+
+
 def print_soft_details(data, export, device):
     '''
     This function will parse the desired value from a particular search
@@ -179,21 +241,54 @@ def getClient():
         print("Unexpected Error")
         sys.exit(1)
 
-    access_token = get_access_token(client_id, client_secret)
-    return access_token
+    # Cached on disk between runs, and refreshed in the background mid-run
+    token = apitoken.TokenProvider(client_id, client_secret)
+    return token.start()
+
+
+def getbatch(batch, token):
+    # Answer what we can from the cache, and only ask once for pids sharing a base pid
+    results = {}
+    live = {}
+    for device in batch:
+        order_text = cache.get(device)
+        if order_text is not None:
+            results[device] = order_text
+        else:
+            live.setdefault(cache.key(device), []).append(device)
+    if not live:
+        return results
+
+    try:
+        print(f"Performing PID search for:         {','.join(live)}")
+        fetched = get_softver_batch(token, list(live))
+    except Exception as e:
+        print('Lookup failed: ' + str(e))
+        return results
+
+    for key, devices in live.items():
+        order_text = fetched.get(key)
+        if order_text is None:
+            continue
+        for device in devices:
+            cache.put(device, order_text)
+            results[device] = order_text
+    return results
 
 
-def getdata(device, access_token):
+def getdata(device, token):
     try:
+        order_text = cache.get(device)
+        if order_text is not None:
+            return order_text
         print(f"Performing PID search for:         {device}")
-        order_text = get_softver_details(access_token, device)
+        order_text = get_softver_details(token, device)
+        cache.put(device, order_text)
+        cache.save()
         return order_text
 
     except Exception as e:
-        print(e)
-        print('\n')
-        print('Error. Sleeping for 10 seconds. Hoping things clear up.')
-        time.sleep(10)
+        print('Lookup failed: ' + str(e))
         return None
 
 
@@ -215,8 +310,7 @@ def main():
     ########################################################################
 
     device = None
-    devicetable = []
-    access_token = getClient()
+    token = getClient()
     SourceList = ManualOrCSV()
 
     # Defining date & time
@@ -227,43 +321,46 @@ def main():
         # Use a CSV for the source. This also allows the results to be exported to a CSV.
         if SourceList.lower() == '1':
             export = input('Would you like to save the results in a CSV? (y/n) ')
+            if export != 'y':
+                export = 'n'
+
+            f = None
             if export == 'y':
                 csvExport = 'outfile-{}.csv'.format(timestamp)
                 # Specifying the CSV export filename
-                writer = csv.writer(open(csvExport, 'w', newline=''))
-                writer.writerow(['Device', 'Product ID', 'Description', 'End of Sale',
-                                 'End of Software Maint', 'End of Security Vul Support',
-                                 'End of Routine Failure', 'End of Service Contract',
-                                 'Last Date of Support', 'End of Service Attach',
-                                 'Migratin PID'])
-            else:
-                export == 'n'
-
-            devices = get_csv(datafile)
-            for device in devices:
-                try:
-                    order_text = getdata(device, access_token)
-                    # print(json.dumps(order_text))
-                except KeyboardInterrupt:
-                    print('Keyboard Interrupt. Exiting...\n')
-                    break
-                finally:
-                    devicedata = print_soft_details(order_text, export, device)
-                    devicetable.append(devicedata)
-
+                f = open(csvExport, mode='w', newline='')
+                writer = csv.writer(f)
+                writer.writerow(CSV_HEADER)
+
+            try:
+                # Rows stream through in batches, and each batch is written as soon as
+                # it is looked up so partial results survive an interrupted run.
+                for batch in supportapi.batched(supportapi.dedupe(get_csv(datafile)), MAX_BATCH):
+                    try:
+                        results = getbatch(batch, token)
+                        for device in batch:
+                            order_text = results.get(device)
+                            # print(json.dumps(order_text))
+                            if order_text is None:
+                                # The limiter already retried, so report the pid rather than dropping it
+                                devicedata = [device] + ['Lookup Failed'] * 9
+                            else:
+                                devicedata = print_soft_details(order_text, export, device)
+                            if devicedata is not None and export == 'y':
+                                writer.writerow(devicedata)
+                    except KeyboardInterrupt:
+                        print('Keyboard Interrupt. Exiting...\n')
+                        break
+                    finally:
+                        cache.save()
+                        if f is not None:
+                            f.flush()
+            finally:
+                if f is not None:
+                    f.close()
+
+            print(f'Answered {cache.hits} pids from the cache, looked up {cache.misses}.')
             if export == 'y':
-                with open(csvExport, mode='w', newline='') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(['Product ID', 'Description', 'Software Type',
-                                     'Recommended Software Version', 'Software Release Date',
-                                     'Software Release Cycle', 'Universal Image Filename',
-                                     'Image Size', 'Required DRAM Size', 'Required Flash Size'])
-                    for item in devicetable:
-                        if item is None:
-                            # Accounts for a 'No records found'
-                            pass
-                        else:
-                            writer.writerow(item)
                 print(f'CSV saved at: {csvExport}')
             sys.exit(0)
 
@@ -272,13 +369,13 @@ def main():
             export = 'n'
             done = False
             device = input('Type PID to look for: ').upper()
-            order_text = getdata(device, access_token)
+            order_text = getdata(device, token)
             print_soft_details(order_text, export)
             while not done:
                 again = input('Run again?  (y/n)   ').lower()
                 if again.lower() == 'y':
                     device = input('Type PID to look for: ').upper()
-                    order_text = getdata(device, access_token)
+                    order_text = getdata(device, token)
                     print_soft_details(order_text, export)
                 else:
                     print('\n')
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+""" Summary: Persistent cache of Software Suggestion results
+
+Description:
+    Suggestions are stored once per base PID. Every PID that has been
+    answered under that base PID (PoE/uplink variants of the same switch,
+    for example) is remembered as an alias, so all siblings are answered
+    from one fetched entry and refreshing the entry refreshes them all.
+
+    Entries older than the TTL are fetched again. A PID Cisco has no
+    suggestion for is only kept for a day, so a product added later is
+    picked up quickly. Both can be set in package_config.ini:
+
+        [cache]
+        ttl_days = 35
+        not_found_ttl_days = 1
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Production"
+
+
+""" Importing built-in modules """
+import json
+import os
+import time
+
+""" Import external modules """
+import configparser
+
+
+CACHE_FILE = 'suggestion_cache.json'
+
+# Long enough that the monthly report is served from the cache
+TTL_DAYS = 35
+
+# 'Not Found' answers are asked again the next day
+NOT_FOUND_TTL_DAYS = 1
+
+
+class SuggestionCache:
+    '''
+    :param cachefile: JSON file the cache is kept in
+    :param ttl_days: days before an entry is fetched again
+    :param not_found_ttl_days: days before a 'Not Found' answer is fetched again
+    '''
+
+    def __init__(self, cachefile=CACHE_FILE, ttl_days=TTL_DAYS, not_found_ttl_days=NOT_FOUND_TTL_DAYS):
+        self.cachefile = cachefile
+        self.ttl = ttl_days * 86400
+        self.not_found_ttl = not_found_ttl_days * 86400
+        self.entries = {}
+        self.aliases = {}
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(cachefile, 'r') as f:
+                data = json.load(f)
+            self.entries = data.get('entries', {})
+            self.aliases = data.get('aliases', {})
+        except (OSError, ValueError):
+            pass
+
+    def key(self, pid):
+        ''' The base PID a pid is cached under, once it has been seen '''
+        return self.aliases.get(pid.upper(), pid.upper())
+
+    def get(self, pid):
+        ''' Return the cached suggestion data for a pid, or None when missing or stale '''
+        entry = self.entries.get(self.key(pid))
+        if entry is not None:
+            ttl = self.ttl if entry['item'].get('product') else self.not_found_ttl
+        if entry is None or time.time() - entry['fetched'] > ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {'productList': [entry['item']]}
+
+    def put(self, pid, data):
+        '''
+        Cache the data returned for pid and learn its alias
+        :param pid: the pid that was asked for
+        :param data: suggestion data in the format get_softver_details returns for one pid
+        '''
+        item = data['productList'][0]
+        product = item.get('product') or {}
+        basepid = product.get('basePID', '').upper() or pid.upper()
+        self.aliases[pid.upper()] = basepid
+        self.entries[basepid] = {'fetched': time.time(), 'item': item}
+
+    def save(self):
+        ''' Write the cache atomically so an interrupted run keeps what it fetched '''
+        tmpfile = self.cachefile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump({'entries': self.entries, 'aliases': self.aliases}, f)
+        os.replace(tmpfile, self.cachefile)
+
+
+def from_config(configfile='package_config.ini'):
+    ''' Build a SuggestionCache using the optional [cache] section of the config file '''
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    cachefile = config.get('cache', 'file', fallback=CACHE_FILE)
+    ttl_days = config.getfloat('cache', 'ttl_days', fallback=TTL_DAYS)
+    not_found_ttl_days = config.getfloat('cache', 'not_found_ttl_days', fallback=NOT_FOUND_TTL_DAYS)
+    return SuggestionCache(cachefile, ttl_days, not_found_ttl_days)
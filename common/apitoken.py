@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+""" Summary: Cached OAuth token provider for the Cisco support APIs
+
+Description:
+    Fetches client-credential tokens from Cisco SSO and caches them on disk
+    until shortly before they expire, so repeated runs skip the SSO round
+    trip. The cache file is shared by every tool in this repository and is
+    written with owner-only permissions.
+
+    A background thread refreshes the token before it expires, so long
+    batch jobs never stall on an expired token.
+
+    This is the one copy used by the EOX, RecommendedVersion and openVulnAPI
+    scripts, which add this folder to sys.path. The EOX_Docker image gets a
+    copy at build time. Only built-in modules are used.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Production"
+
+
+""" Importing built-in modules """
+import json
+import os
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+
+TOKEN_URL = "https://cloudsso.cisco.com/as/token.oauth2"
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cisco_api_token.json')
+
+# Refresh this many seconds before the token expires
+REFRESH_MARGIN = 300
+
+
+class TokenProvider:
+    '''
+    Hands out a valid access token, fetching a new one only when needed.
+
+    :param client_id: the client id that was created on the apiconsole.cisco.com
+    :param client_secret: the client secret that was created in apiconsole.cisco.com
+    :param cachefile: where cached tokens are kept, keyed by client id
+    :param margin: seconds before expiry at which the token is refreshed
+    '''
+
+    def __init__(self, client_id, client_secret, cachefile=CACHE_FILE, margin=REFRESH_MARGIN):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.cachefile = cachefile
+        self.margin = margin
+        self.access_token = None
+        self.expires_at = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._load_cache()
+
+    def get(self):
+        ''' Return a token that is valid for at least the refresh margin '''
+        with self._lock:
+            if self.access_token is None or time.time() >= self.expires_at - self.margin:
+                self._refresh()
+            return self.access_token
+
+    def invalidate(self):
+        ''' Drop the current token, e.g. after the API answered 401 '''
+        with self._lock:
+            self.access_token = None
+            self.expires_at = 0
+
+    def start(self):
+        ''' Start refreshing the token in the background '''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            wait = self.expires_at - self.margin - time.time()
+            if self._stop.wait(max(wait, 1)):
+                return
+            try:
+                with self._lock:
+                    if time.time() >= self.expires_at - self.margin:
+                        self._refresh()
+            except Exception as e:
+                # get() will try again in the foreground if this keeps failing
+                print('Background token refresh failed: ' + str(e))
+                self._stop.wait(30)
+
+    def _refresh(self):
+        query = urllib.parse.urlencode({
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+        })
+        req = urllib.request.Request(TOKEN_URL + '?' + query, data=b'', method='POST')
+        req.add_header('accept', 'application/json')
+        req.add_header('content-type', 'application/x-www-form-urlencoded')
+        req.add_header('cache-control', 'no-cache')
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            data = json.loads(resp.read().decode('utf-8'))
+        self.access_token = data['access_token']
+        self.expires_at = time.time() + int(data.get('expires_in', 3599))
+        self._save_cache()
+
+    def _read_cache(self):
+        try:
+            with open(self.cachefile, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _load_cache(self):
+        entry = self._read_cache().get(self.client_id)
+        if entry and entry.get('expires_at', 0) - self.margin > time.time():
+            self.access_token = entry['access_token']
+            self.expires_at = entry['expires_at']
+
+    def _save_cache(self):
+        cache = self._read_cache()
+        # Drop expired tokens of other clients while we are here
+        cache = {k: v for k, v in cache.items() if v.get('expires_at', 0) > time.time()}
+        cache[self.client_id] = {'access_token': self.access_token, 'expires_at': self.expires_at}
+        tmpfile = '{}.{}.tmp'.format(self.cachefile, os.getpid())
+        try:
+            fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmpfile, self.cachefile)
+        except OSError as e:
+            # A read-only home directory only costs us the cache
+            print('Unable to cache the access token: ' + str(e))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+""" Summary: Client-side rate limiting for the Cisco support APIs
+
+Description:
+    The support APIs allow a fixed number of calls per second and per day,
+    and some also per minute. RateLimiter enforces the quotas with token buckets so requests go out
+    at the highest allowed rate. request() sends a call through the limiter,
+    honors Retry-After on 429 and 503 responses and retries other transient
+    failures with jittered exponential backoff.
+
+    This is the one copy used by the API tools of this repository, see
+    apitoken.py.
+
+    The quotas can be overridden in package_config.ini:
+
+        [limits]
+        per_second = 10
+        per_day = 5000
+        per_minute = 30
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Production"
+
+
+""" Importing built-in modules """
+import email.utils
+import random
+import threading
+import time
+
+""" Import external modules """
+import requests
+import configparser
+
+
+# Documented default quotas for the support APIs
+PER_SECOND = 10
+PER_DAY = 5000
+
+RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+
+class TokenBucket:
+    '''
+    Classic token bucket: holds up to capacity tokens, refilled at rate per second.
+    '''
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _fill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        ''' Seconds until a token is available '''
+        self._fill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimiter:
+    '''
+    Enforces the per-second, per-minute and per-day quotas. Safe to share between threads.
+
+    :param per_second: calls allowed per second
+    :param per_day: calls allowed per day
+    :param per_minute: calls allowed per minute, or None when the API has no such quota
+    '''
+
+    def __init__(self, per_second=PER_SECOND, per_day=PER_DAY, per_minute=None):
+        self.second = TokenBucket(per_second, per_second)
+        self.day = TokenBucket(per_day, per_day / 86400)
+        self.minute = TokenBucket(per_minute, per_minute / 60) if per_minute else None
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        ''' Block until a call is allowed, then use up one call of each quota '''
+        while True:
+            with self._lock:
+                wait = max(self.second.wait_time(), self.day.wait_time(),
+                           self.minute.wait_time() if self.minute else 0,
+                           self.paused_until - time.monotonic())
+                if wait <= 0:
+                    self.second.take()
+                    self.day.take()
+                    if self.minute:
+                        self.minute.take()
+                    return
+            if wait > 60:
+                print('API quota reached. Waiting {:.0f} seconds.'.format(wait))
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        ''' Hold every caller back, e.g. when the API asked us to via Retry-After '''
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def from_config(configfile='package_config.ini'):
+    ''' Build a RateLimiter from the optional [limits] section of the config file '''
+    config = configparser.ConfigParser()
+    config.read(configfile)
+    per_second = config.getfloat('limits', 'per_second', fallback=PER_SECOND)
+    per_day = config.getfloat('limits', 'per_day', fallback=PER_DAY)
+    per_minute = config.getfloat('limits', 'per_minute', fallback=None)
+    return RateLimiter(per_second, per_day, per_minute)
+
+
+def retry_after(response):
+    ''' Return the Retry-After header of a response in seconds, or None '''
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt):
+    ''' Full jitter exponential backoff '''
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def request(limiter, method, url, token=None, session=requests, retries=RETRIES, **kwargs):
+    '''
+    Send a request through the limiter, retrying throttled and transient failures
+
+    :param limiter: RateLimiter shared by every caller of the same API
+    :param method: HTTP method
+    :param url: URL to call
+    :param token: optional apitoken.TokenProvider; its token is added as the
+                  authorization header and refreshed once if the API answers 401
+    :param session: requests module or a requests.Session to send with
+    :param retries: how many times a failed call is retried
+    :return: the last response received. Raises once retries are used up on
+             a connection error.
+    '''
+    headers = kwargs.pop('headers', {})
+    refreshed = False
+    attempt = 0
+    while True:
+        limiter.acquire()
+        if token is not None:
+            headers['authorization'] = "Bearer " + token.get()
+        try:
+            response = session.request(method, url, headers=headers, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries:
+                raise
+            wait = backoff(attempt)
+            print('Connection problem ({}). Retrying in {:.1f} seconds.'.format(e, wait))
+            time.sleep(wait)
+            attempt += 1
+            continue
+
+        if response.status_code == 401 and token is not None and not refreshed:
+            token.invalidate()
+            refreshed = True
+            continue
+        if response.status_code not in (429, 500, 502, 503, 504) or attempt >= retries:
+            return response
+
+        wait = None
+        if response.status_code in (429, 503):
+            wait = retry_after(response)
+        if wait is None:
+            wait = backoff(attempt)
+        else:
+            # Everyone sharing the limiter has to back off, not just this call
+            wait += random.uniform(0, 1)
+            limiter.pause(wait)
+        print('API returned {}. Retrying in {:.1f} seconds.'.format(response.status_code, wait))
+        time.sleep(wait)
+        attempt += 1
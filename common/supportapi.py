@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+""" Summary: Lookup helpers shared by the Cisco support API tools
+
+Description:
+    The EOX and RecommendedVersion tools read long lists of serials and
+    pids. The values are streamed through dedupe() and batched() so that
+    each one is only looked up once, in as few calls as the API allows.
+
+    get_eox_details() and get_eox_batch() query the EOX API, following
+    every page of the results. Calls go through a ratelimit.RateLimiter.
+    eox_records_by_value() matches the records of a batch back to the
+    values that were asked for.
+"""
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Production"
+
+
+""" Importing built-in modules """
+import collections
+import itertools
+import json
+
+""" Import local modules """
+import ratelimit
+
+
+EOX_URL = "https://api.cisco.com/supporttools/eox/rest/5/"
+
+# The EOX API accepts up to 20 comma separated serials/pids per request
+EOX_MAX_BATCH = 20
+
+
+def dedupe(devices, maxsize=100000):
+    '''
+    This function drops repeated values while keeping memory bounded
+
+    Only the most recent maxsize values are remembered, so a duplicate that
+    is further apart than that in the input is simply looked up again.
+
+    :param devices: iterable of serials/pids
+    :param maxsize: the most values to remember at once
+    :return: generator of values not seen recently
+    '''
+    seen = collections.OrderedDict()
+    for device in devices:
+        device = device.upper()
+        if device in seen:
+            seen.move_to_end(device)
+            continue
+        seen[device] = None
+        if len(seen) > maxsize:
+            seen.popitem(last=False)
+        yield device
+
+
+def batched(devices, size):
+    '''
+    This function groups an iterable into lists of at most size items
+
+    :param devices: iterable of serials/pids
+    :param size: the number of values per batch
+    :return: generator of lists
+    '''
+    devices = iter(devices)
+    while True:
+        batch = list(itertools.islice(devices, size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_eox_details(limiter, token, inputvalue, searchtype, pageindex=1, baseurl=EOX_URL):
+    '''
+    This function will get the EOX record for a particular search
+
+    :param limiter: ratelimit.RateLimiter shared by every call to the API
+    :param token: apitoken.TokenProvider handing out the access token used to query the searchtypes
+    :param inputvalue: The serial number of pid that is used to query. Up to
+                       EOX_MAX_BATCH values may be comma separated.
+    :param searchtype: The type of search type to perform.   Either pid or serial
+    :param pageindex: The page of results to return
+    :param baseurl: the EOX API, ending with a slash
+    :return: json format of the retrieved data
+    '''
+    if searchtype in ["pid"]:
+        url = baseurl + "EOXByProductID/" + str(pageindex) + "/" + inputvalue + "?responseencoding=json"
+    elif searchtype in ["serial"]:
+        url = baseurl + "EOXBySerialNumber/" + str(pageindex) + "/" + inputvalue + "?responseencoding=json"
+    else:
+        return
+
+    headers = {
+        'accept': "application/json",
+    }
+
+    # Throttled to the API quota, with retries on 429/503 and transient errors
+    response = ratelimit.request(limiter, "POST", url, token=token, headers=headers, timeout=60)
+
+    if (response.status_code == 200):
+        return json.loads(response.text)
+    else:
+        response.raise_for_status()
+        return
+
+
+def eox_records_by_value(records, batch):
+    '''
+    This function matches the records of a batch back to the values asked for
+
+    One record can answer several values, its EOXInputValue then lists them
+    comma separated. Only the first record of each value is kept, as a lookup
+    of the value on its own would use.
+
+    :param records: EOX records returned for the batch
+    :param batch: list of the serial numbers or pids asked for, upper case
+    :return: dict of value to EOX record, for the values that were answered
+    '''
+    results = {}
+    for record in records:
+        for value in record.get('EOXInputValue', '').split(','):
+            value = value.strip().upper()
+            if value in batch and value not in results:
+                results[value] = record
+    return results
+
+
+def get_eox_batch(limiter, token, batch, searchtype, baseurl=EOX_URL):
+    '''
+    This function will get the EOX records for a batch of values in as few
+    requests as possible, following every page of the results
+
+    :param limiter: ratelimit.RateLimiter shared by every call to the API
+    :param token: apitoken.TokenProvider handing out the access token used to query the searchtypes
+    :param batch: list of at most EOX_MAX_BATCH serial numbers or pids
+    :param searchtype: The type of search type to perform.   Either pid or serial
+    :param baseurl: the EOX API, ending with a slash
+    :return: generator of EOX records
+    '''
+    pageindex = 1
+    lastindex = 1
+    while pageindex <= lastindex:
+        data = get_eox_details(limiter, token, ','.join(batch), searchtype, pageindex, baseurl)
+        if data is None:
+            return
+        yield from data.get('EOXRecord', [])
+        lastindex = int(data.get('PaginationResponseRecord', {}).get('LastIndex', 1))
+        pageindex += 1
@@ -13,31 +13,52 @@ Description:
 Usage:
     ios_checker.py --file [filename]
         Where [filename] is a single column list of IOS and IOS-XE versions to check.
+    ios_checker.py --sync
+        Download new and updated advisories into the local mirror.
+    ios_checker.py --file [filename] --offline
+        Check versions against the local mirror only.
 
 Requirements:
-    oauth2, argparse
+    argparse, requests, apitoken.py and ratelimit.py (in the common folder of this repository)
 """
 
 
 """  Importing built-in modules """
-import json
-import urllib.request
+import os
+import urllib.error
+import threading
+import concurrent.futures
 import sys
 import datetime
 import time
 import csv
 
 """  Importing third-party modules """
-import oauth2 as oauth
 import argparse
+import requests
+
+"""  Importing local modules """
+# The API helpers shared by the tools live in the common folder of this repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import apitoken
+import psirtmirror
+import ratelimit
 
 
 __author__ = "Sean Sutherland, Brandon Rumer"
-__version__ = "1.3"
+__version__ = "1.4"
 __email__ = "sesuther@cisco.com, brumer@cisco.com"
 __status__ = "Production"
 
 
+API_URL = 'https://api.cisco.com/security/advisories/'
+
+# openVuln allows 5 calls a second, 30 a minute and 5000 a day. Shared by every worker.
+limiter = ratelimit.RateLimiter(per_second=5, per_day=5000, per_minute=30)
+
+# One keep-alive session to api.cisco.com per worker thread
+sessions = threading.local()
+
 def process_args():
     parser = argparse.ArgumentParser(
         description='Checks Cisco for pSIRTs on specific IOS/IOS-XE code.',
@@ -47,7 +68,7 @@ def process_args():
         '--file',
         action='store',
         metavar='file',
-        required=True,
+        required=False,
         help='Input CSV file of IOS Versions:'
     )
     parser.add_argument(
@@ -56,7 +77,39 @@ def process_args():
         required=False,
         help='Save results as a CSV.'
     )
-    return parser.parse_args()
+    parser.add_argument(
+        '--sync',
+        action='store_true',
+        required=False,
+        help='Sync the local advisory mirror before checking.'
+    )
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        required=False,
+        help='Answer from the local advisory mirror, without the network.'
+    )
+    parser.add_argument(
+        '--workers',
+        action='store',
+        metavar='workers',
+        type=int,
+        default=8,
+        help='Concurrent API queries (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--mirror',
+        action='store',
+        metavar='mirror',
+        default=psirtmirror.MIRROR_FILE,
+        help='Local advisory mirror database (default: %(default)s)'
+    )
+    args = parser.parse_args()
+    if args.file is None and not args.sync:
+        parser.error('--file is required unless only syncing with --sync')
+    if args.sync and args.offline:
+        parser.error('--sync needs the network, it cannot be used with --offline')
+    return args
 
 
 def YorN():
@@ -75,6 +128,51 @@ def YorN():
         YesOrNo = YorN()
 
 
+def version_type(version):
+    """ IOS versions are 12.x and 15.x, everything else is IOS-XE """
+    if (version.startswith('12')) or (version.startswith('15')):
+        return "ios"
+    return "iosxe"
+
+
+def query_version(version, type, token):
+    """ Ask the openVuln API for the advisories affecting a single version.
+        Calls go through the shared limiter, which also retries 429s after their Retry-After.
+        Each worker thread reuses its own keep-alive session. """
+    session = getattr(sessions, 'session', None)
+    if session is None:
+        session = sessions.session = requests.Session()
+    response = ratelimit.request(limiter, 'GET', API_URL + type, token=token, session=session,
+                                 params={'version': version}, headers={'Accept': 'application/json'}, timeout=60)
+    try:
+        advdata = response.json()
+    except ValueError:
+        advdata = {}
+    if response.status_code != 200 and 'errorCode' not in advdata:
+        response.raise_for_status()
+    return advdata
+
+
+def check_versions(versions, mirror, token, workers):
+    """ Look up every distinct version once, concurrently unless answering from the mirror.
+        Returns a dict of version to the API's answer, or to the error raised. """
+    def lookup(version):
+        try:
+            if mirror is not None:
+                return mirror.check(version, version_type(version))
+            return query_version(version, version_type(version), token)
+        except (requests.RequestException, urllib.error.URLError, OSError) as err:
+            return err
+
+    unique = list(dict.fromkeys(versions))
+    print('Checking {} distinct versions from {} lines.'.format(len(unique), len(versions)))
+    if mirror is not None:
+        # The mirror is a local lookup, and its SQLite connection belongs to this thread
+        return {version: lookup(version) for version in unique}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(unique, pool.map(lookup, unique)))
+
+
 def main():
     args = process_args()
 
@@ -84,25 +182,43 @@ def main():
     openvuln_secret = ''
     #################################################################################################
 
-    # Check that the clientid & secret are filled in
-    if openvuln_clientid == '':
-        print('There is no clientid entered in the script. Please check README for details.')
-        sys.exit(0)
-    if openvuln_secret == '':
-        print('There is no secret entered in the script. Please check README for details.')
-        sys.exit(0)
-
     #  Define date & time
     today_str = str(datetime.date.today())
     timestamp = str(today_str + '-' + (time.strftime('%H%M%S')))
 
-    try:
-        consumer = oauth.Consumer(key=openvuln_clientid, secret=openvuln_secret)
-        request_token_url = "https://cloudsso.cisco.com/as/token.oauth2?grant_type=client_credentials&client_id=" + openvuln_clientid + "&client_secret=" + openvuln_secret
-        client = oauth.Client(consumer)
-        resp, content = client.request(request_token_url, "POST")
-    except Exception:
-        sys.stderr.write("Unable to retrieve access token.")
+    # With --sync or --offline, versions are checked against the local mirror
+    mirror = None
+    if args.sync or args.offline:
+        mirror = psirtmirror.Mirror(args.mirror)
+
+    if not args.offline:
+        # Check that the clientid & secret are filled in
+        if openvuln_clientid == '':
+            print('There is no clientid entered in the script. Please check README for details.')
+            sys.exit(0)
+        if openvuln_secret == '':
+            print('There is no secret entered in the script. Please check README for details.')
+            sys.exit(0)
+
+        try:
+            # The token is cached on disk between runs and refreshed in the background mid-run
+            token = apitoken.TokenProvider(openvuln_clientid, openvuln_secret)
+            token.get()
+            token.start()
+        except Exception:
+            sys.stderr.write("Unable to retrieve access token.")
+            sys.exit(1)
+
+    if args.sync:
+        try:
+            mirror.sync(token)
+        except urllib.error.URLError as err:
+            print('Unable to sync the advisory mirror: ' + str(err))
+            sys.exit(1)
+        if args.file is None:
+            sys.exit(0)
+    elif args.offline and mirror.last_sync() is None:
+        print('The advisory mirror is empty. Run with --sync first.')
         sys.exit(1)
 
     print('_____________________________________________________________')
@@ -120,55 +236,41 @@ def main():
         # Catches error on user input, and just outputs to screen
         YesOrNo == 'n'
 
-    versionfile = str(sys.argv[2])
+    versionfile = args.file
     print('Using ' + versionfile + ' as version input file.')
     print('')
     with open(versionfile, 'r') as infile:
-        reader = csv.reader(infile)
-
-        for version in reader:
-            if (version[0].startswith('12')) or (version[0].startswith('15')):
-                type = "ios"
-            else:
-                type = "iosxe"
-
-            j = json.loads(content.decode('utf-8'))
-
-            print('Checking version ', version[0])
-
-            try:
-                req = urllib.request.Request('https://api.cisco.com/security/advisories/' + type + '?version=' + version[0])
-                req.add_header('Accept', 'application/json')
-                req.add_header('Authorization', 'Bearer ' + j['access_token'])
-
-                try:
-                    resp = urllib.request.urlopen(req)
-                    adv = resp.read()
-                    advdata = json.loads(adv.decode('utf-8'))
-
-                    #  Checking for invalid code versions
-                    if 'errorCode' in advdata:
-                        print(advdata['errorMessage'])
-                        pass
-                    else:
-                        if YesOrNo == 'y':
-                            print('Saving to CSV:')
-                        for advisory in advdata['advisories']:
-                            if YesOrNo == 'n':
-                                print(version[0], ',', advisory['advisoryId'], ',', advisory['advisoryTitle'], ',', advisory['sir'])
-                                print("")
-                            elif YesOrNo == 'y':
-                                writer.writerow([version[0], advisory['advisoryId'], advisory['advisoryTitle'], advisory['sir']])
-                                print(version[0], ',', advisory['advisoryId'], ',', advisory['advisoryTitle'], ',', advisory['sir'])
-                                print("")
-                            else:
-                                continue
-                except KeyboardInterrupt:
-                    print('\n User Interrupt. Exiting.')
-                    sys.exit(0)
-
-            except urllib.error.HTTPError as err:
-                print(version[0] + ",Error")
+        versions = [row[0].strip() for row in csv.reader(infile) if row and row[0].strip()]
+
+    try:
+        results = check_versions(versions, mirror, None if args.offline else token, args.workers)
+    except KeyboardInterrupt:
+        print('\n User Interrupt. Exiting.')
+        sys.exit(0)
+
+    # Fan the answers back out to every input line, in the original order
+    for version in versions:
+        print('Checking version ', version)
+        advdata = results[version]
+
+        if isinstance(advdata, Exception):
+            print(version + ",Error")
+        #  Checking for invalid code versions
+        elif 'errorCode' in advdata:
+            print(advdata['errorMessage'])
+        else:
+            if YesOrNo == 'y':
+                print('Saving to CSV:')
+            for advisory in advdata['advisories']:
+                if YesOrNo == 'n':
+                    print(version, ',', advisory['advisoryId'], ',', advisory['advisoryTitle'], ',', advisory['sir'])
+                    print("")
+                elif YesOrNo == 'y':
+                    writer.writerow([version, advisory['advisoryId'], advisory['advisoryTitle'], advisory['sir']])
+                    print(version, ',', advisory['advisoryId'], ',', advisory['advisoryTitle'], ',', advisory['sir'])
+                    print("")
+                else:
+                    continue
 
 
 if __name__ == "__main__":
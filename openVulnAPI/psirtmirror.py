@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Summary:
+     Local mirror of the Cisco PSIRT openVuln advisories.
+Description:
+    The first sync downloads every advisory. Later syncs only fetch the
+    advisories published or updated since the last sync. Advisories are
+    kept in a SQLite database so IOS and IOS-XE versions can be checked
+    without touching the network.
+
+    Alongside the advisories the mirror keeps an index from normalized
+    version to advisory IDs, updated for just the advisories each sync
+    changes. Checking a whole fleet is then one hash lookup per version.
+
+    Only IOS and IOS-XE advisories are kept, since that is all
+    ios_checker.py asks about.
+"""
+
+
+"""  Importing built-in modules """
+import datetime
+import json
+import re
+import sqlite3
+import urllib.error
+import urllib.request
+
+
+__author__ = "Brandon Rumer"
+__version__ = "1.0"
+__email__ = "brumer@cisco.com"
+__status__ = "Production"
+
+
+MIRROR_FILE = 'psirt_mirror.db'
+API_URL = 'https://api.cisco.com/security/advisories/'
+
+# Matches the product names of IOS and IOS-XE advisories,
+# e.g. 'Cisco IOS 15.2(4)E10' or 'Cisco IOS XE Software 16.6.4'
+PRODUCT_RE = re.compile(r'^Cisco IOS (XE )?(?:Software )?(\S+)$')
+
+# Overlap each incremental sync by a day so nothing published around midnight is missed
+SYNC_OVERLAP = datetime.timedelta(days=1)
+
+
+def normalize_version(version):
+    '''
+    Normalize a version so the spellings used by devices, image names and
+    advisories compare equal, e.g. '16.06.04' and '16.6.4', or '15.2(4)e10'
+    and '15.2(4)E10'
+    '''
+    return '.'.join(str(int(part)) if part.isdigit() else part
+                    for part in version.strip().upper().split('.'))
+
+
+def affected_versions(advisory):
+    '''
+    Return the (type, version) pairs an advisory lists as affected,
+    where type is 'ios' or 'iosxe' as used by ios_checker.py
+    '''
+    versions = set()
+    for name in advisory.get('productNames') or []:
+        match = PRODUCT_RE.match(name.strip())
+        if match:
+            versions.add(('iosxe' if match.group(1) else 'ios', normalize_version(match.group(2))))
+    for version in advisory.get('iosRelease') or []:
+        versions.add(('ios', normalize_version(version)))
+    return versions
+
+
+class Mirror:
+    '''
+    :param dbfile: SQLite file the advisories are stored in
+    '''
+
+    def __init__(self, dbfile=MIRROR_FILE):
+        self.db = sqlite3.connect(dbfile)
+        self.db.execute('CREATE TABLE IF NOT EXISTS advisories '
+                        '(advisoryId TEXT PRIMARY KEY, lastUpdated TEXT, advisory TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS version_index '
+                        '(type TEXT, version TEXT, advisoryId TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS version_index_version ON version_index (type, version)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS version_index_advisory ON version_index (advisoryId)')
+        self.db.commit()
+        self._index = None
+        self._advisories = {}
+        if self._meta('index') is None:
+            # Mirror created before the index existed
+            self.reindex(row[0] for row in self.db.execute('SELECT advisoryId FROM advisories'))
+
+    def _meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def reindex(self, advisory_ids):
+        ''' Rebuild the version index entries of the given advisories '''
+        for advisory_id in advisory_ids:
+            self.db.execute('DELETE FROM version_index WHERE advisoryId = ?', (advisory_id,))
+            row = self.db.execute('SELECT advisory FROM advisories WHERE advisoryId = ?',
+                                  (advisory_id,)).fetchone()
+            if row is None:
+                continue
+            self.db.executemany('INSERT INTO version_index VALUES (?, ?, ?)',
+                                [(type, version, advisory_id)
+                                 for type, version in affected_versions(json.loads(row[0]))])
+            self._advisories.pop(advisory_id, None)
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('index', '1')")
+        self.db.commit()
+        self._index = None
+
+    def last_sync(self):
+        value = self._meta('last_sync')
+        return datetime.date.fromisoformat(value) if value else None
+
+    def fetch(self, token, path):
+        req = urllib.request.Request(API_URL + path)
+        req.add_header('Accept', 'application/json')
+        req.add_header('Authorization', 'Bearer ' + token.get())
+        try:
+            with urllib.request.urlopen(req, timeout=300) as resp:
+                data = json.loads(resp.read().decode('utf-8'))
+        except urllib.error.HTTPError as err:
+            # The API answers 404 when nothing was published in the date range
+            if err.code == 404:
+                return []
+            raise
+        return data.get('advisories', [])
+
+    def sync(self, token):
+        '''
+        Bring the mirror up to date, fully the first time and incrementally after that
+
+        :param token: apitoken.TokenProvider
+        :return: list of the advisory IDs that were added or changed
+        '''
+        today = datetime.date.today()
+        since = self.last_sync()
+        if since is None:
+            print('Downloading all advisories. This only happens once.')
+            advisories = self.fetch(token, 'all')
+        else:
+            start = since - SYNC_OVERLAP
+            print('Fetching advisories updated since ' + str(start))
+            advisories = self.fetch(token, 'all/lastpublished?startDate={}&endDate={}'.format(start, today))
+
+        changed = []
+        for advisory in advisories:
+            if not affected_versions(advisory):
+                continue
+            row = self.db.execute('SELECT lastUpdated FROM advisories WHERE advisoryId = ?',
+                                  (advisory['advisoryId'],)).fetchone()
+            if row and row[0] == advisory.get('lastUpdated'):
+                continue
+            self.db.execute('INSERT OR REPLACE INTO advisories VALUES (?, ?, ?)',
+                            (advisory['advisoryId'], advisory.get('lastUpdated'), json.dumps(advisory)))
+            changed.append(advisory['advisoryId'])
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('last_sync', ?)", (str(today),))
+        self.db.commit()
+        self.reindex(changed)
+        print('{} advisories added or updated.'.format(len(changed)))
+        return changed
+
+    def advisories(self):
+        for (advisory,) in self.db.execute('SELECT advisory FROM advisories'):
+            yield json.loads(advisory)
+
+    def advisory(self, advisory_id):
+        if advisory_id not in self._advisories:
+            row = self.db.execute('SELECT advisory FROM advisories WHERE advisoryId = ?',
+                                  (advisory_id,)).fetchone()
+            self._advisories[advisory_id] = json.loads(row[0])
+        return self._advisories[advisory_id]
+
+    def load_index(self):
+        ''' Load the version index into memory for hash lookups '''
+        self._index = {}
+        for type, version, advisory_id in self.db.execute('SELECT type, version, advisoryId FROM version_index'):
+            self._index.setdefault((type, version), []).append(advisory_id)
+
+    def check(self, version, type):
+        '''
+        Answer a version check from the mirror, in the same format as the API
+
+        :param version: IOS or IOS-XE version
+        :param type: 'ios' or 'iosxe'
+        :return: dict with an 'advisories' list
+        '''
+        if self._index is None:
+            self.load_index()
+        advisory_ids = self._index.get((type, normalize_version(version)), [])
+        return {'advisories': [self.advisory(advisory_id) for advisory_id in sorted(advisory_ids)]}